@@ -2,6 +2,8 @@
 
 const SOOT_MIME_KEYWORD = 'soot-json';
 const MASH_SERVER_URL = 'http://localhost:8000';
+export const MASH_SESSION_HEADER = 'X-Mash-Session';
+export const MASH_SESSION_KEY = 'mashSessionId';
 
 function parseSootClipboardData(jsonString) {
   try {
@@ -94,14 +96,19 @@ export async function processSootClipboard() {
 
   try {
     console.log('[SOOT] 🔁 Sending metadata to backend...');
+    const sessionId = sessionStorage.getItem(MASH_SESSION_KEY);
     const res = await fetch(`${MASH_SERVER_URL}/api/mash/process-entries`, {
       method: 'POST',
       headers: {
-        'Content-Type': 'application/json'
+        'Content-Type': 'application/json',
+        ...(sessionId ? { [MASH_SESSION_HEADER]: sessionId } : {})
       },
       body: JSON.stringify(payloads.map(p => p.metadata))
     });
 
+    const issuedSessionId = res.headers.get(MASH_SESSION_HEADER);
+    if (issuedSessionId) sessionStorage.setItem(MASH_SESSION_KEY, issuedSessionId);
+
     const data = await res.json();
     console.log('[SOOT] ✅ Backend responded with', data.length, 'items');
 
@@ -1,5 +1,7 @@
 //scripts/prompt.js
 
+import { MASH_SESSION_HEADER, MASH_SESSION_KEY } from './clipboard.js';
+
 let MASH_SERVER_URL = null;
 
 async function loadConfig() {
@@ -13,10 +15,14 @@ async function loadConfig() {
 
 export async function sendPromptToBackend(promptText) {
   const baseUrl = await loadConfig();
+  const sessionId = sessionStorage.getItem(MASH_SESSION_KEY);
   try {
     const res = await fetch(`${baseUrl}/user-prompt`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers: {
+        'Content-Type': 'application/json',
+        ...(sessionId ? { [MASH_SESSION_HEADER]: sessionId } : {})
+      },
       body: JSON.stringify({ prompt: promptText })
     });
 
@@ -1,7 +1,17 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from utils.log import configure_logging
+from utils import metrics
 from fastapi.middleware.cors import CORSMiddleware
 from mash.routes import router as mash_router 
 from soot.routes import router as soot_router
+from debug.routes import router as debug_router
+from soot.operations import validate_operations
+from soot.subscriptions import subscriptions
+
+configure_logging()
+# Fail fast if an operation sent to SOOT no longer matches the bundled schema
+validate_operations()
+subscriptions.warn_if_unavailable()
 
 app = FastAPI()
 
@@ -11,7 +21,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  
     allow_headers=["*"],  
+    expose_headers=["X-Mash-Session", "X-Trace-Id"],
 )
 
 app.include_router(mash_router, prefix="/api/mash", tags=["Mash"])
 app.include_router(soot_router, prefix="/api/soot")
+app.include_router(debug_router, prefix="/debug", tags=["Debug"])
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,312 @@
+"""
+Load generator for the FastAPI app: concurrent clients paste clipboard
+batches, send a mix of prompts and poll /descriptions, against the mock
+upstreams.
+
+Run from the server directory, e.g.:
+
+    python -m bench.load --clients 50 --duration 120
+    python -m bench.load --mix "mash=1,tag=2,variation=1,prompt=4" --gemini realistic
+    python -m bench.load --target http://localhost:8000 --duration 60   # already-running server
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from .mock_servers import PROFILES, start_mock_upstreams, stop_mock_upstreams, upstream_environment, upstream_stats
+from .stats import summarize
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SESSION_HEADER = "X-Mash-Session"
+
+# Prompt kinds and the prompts sent for each
+PROMPTS = {
+    "mash": ["mash:", "mash: style from 1, content from 2", "mash: sunset colors"],
+    "tag": ["tag: mood", "tag: color palette", "tag: season"],
+    "describe": ["describe: lighting", "describe: composition"],
+    "edit": ["edit: make it brighter", "edit: convert to black and white"],
+    "variation": ["variation:[2]", "variation:[3]"],
+    "prompt": ["make it look like a vintage photograph", "a vibrant landscape at sunset",
+               "add soft pastel tones", "turn it into a watercolor painting"],
+}
+DEFAULT_MIX = "prompt=4,tag=2,describe=1,edit=1,mash=1,variation=1,poll=6,paste=1"
+
+
+class Recorder:
+    """Thread-safe latency and error bookkeeping per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, duration: float) -> Dict[str, Dict]:
+        with self._lock:
+            report = {}
+            for endpoint, latencies in sorted(self.latencies.items()):
+                summary = summarize(latencies)
+                summary["errors"] = self.errors[endpoint]
+                summary["errorRate"] = round(self.errors[endpoint] / len(latencies), 4)
+                summary["throughputPerSec"] = round(len(latencies) / duration, 3)
+                report[endpoint] = summary
+            return report
+
+
+class ResourceSampler:
+    """Samples CPU, RSS and thread count of a local process from /proc, and the server's /metrics"""
+
+    def __init__(self, pid: Optional[int], metrics_url: str, interval: float = 1.0):
+        self.pid = pid
+        self.metrics_url = metrics_url
+        self.interval = interval
+        self.samples: List[Dict] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="resource-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Dict:
+        self._stop.set()
+        self._thread.join()
+        return self.summary()
+
+    def _proc_sample(self) -> Optional[Tuple[float, int, int]]:
+        """(cpu seconds, rss bytes, threads) of the process, or None without /proc"""
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks = os.sysconf("SC_CLK_TCK")
+            cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+            threads = int(fields[17])
+            rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+            return cpu, rss, threads
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _metrics_sample(self) -> Dict[str, float]:
+        wanted = ("gemini_queue_depth", "gemini_requests_inflight", "process_threads")
+        try:
+            text = requests.get(self.metrics_url, timeout=2).text
+        except requests.RequestException:
+            return {}
+        values = {}
+        for line in text.splitlines():
+            name, _, value = line.partition(" ")
+            if name in wanted:
+                values[name] = float(value)
+        return values
+
+    def _loop(self):
+        previous = None
+        while not self._stop.wait(self.interval):
+            sample: Dict[str, float] = {"time": time.time()}
+            proc = self._proc_sample() if self.pid else None
+            if proc is not None:
+                cpu, rss, threads = proc
+                if previous is not None:
+                    sample["cpuPercent"] = round((cpu - previous[0]) / (sample["time"] - previous[1]) * 100, 1)
+                sample["rssBytes"] = rss
+                sample["threads"] = threads
+                previous = (cpu, sample["time"])
+            sample.update(self._metrics_sample())
+            self.samples.append(sample)
+
+    def summary(self) -> Dict:
+        summary = {"samples": len(self.samples)}
+        keys = sorted({key for sample in self.samples for key in sample if key != "time"})
+        for key in keys:
+            values = [sample[key] for sample in self.samples if key in sample]
+            summary[key] = {"mean": round(sum(values) / len(values), 2), "max": max(values)}
+        return summary
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, weight = item.partition("=")
+        if kind not in PROMPTS and kind not in ("poll", "paste"):
+            raise ValueError(f"Unknown action in mix: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class Client:
+    """One simulated user with its own HTTP session and mash session ID"""
+
+    def __init__(self, base_url: str, soot_mock, recorder: Recorder, images: int, mix: Dict[str, float],
+                 think_time: float, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.soot_mock = soot_mock
+        self.recorder = recorder
+        self.images = images
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.think_time = think_time
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.session_id: Optional[str] = None
+
+    def _call(self, endpoint: str, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        headers = kwargs.pop("headers", {})
+        if self.session_id:
+            headers[SESSION_HEADER] = self.session_id
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, headers=headers, timeout=self.timeout, **kwargs)
+            ok = response.status_code < 400
+            if ok and response.headers.get("content-type", "").startswith("application/json"):
+                body = response.json()
+                ok = not (isinstance(body, dict) and "error" in body)
+        except (requests.RequestException, ValueError):
+            response, ok = None, False
+        self.recorder.record(endpoint, time.perf_counter() - start, ok)
+        return response
+
+    def paste(self):
+        """Send a clipboard batch shaped like the Metadata model"""
+        batch = [{
+            "imageURL": self.soot_mock.image_url(f"load-{uuid.uuid4().hex[:10]}") if self.soot_mock
+            else f"https://example.invalid/{uuid.uuid4().hex}.png",
+            "instanceId": str(uuid.uuid4()),
+            "filename": f"clip-{i}.png",
+            "spaceId": "load-space",
+            "operation": 0,
+        } for i in range(self.images)]
+        response = self._call("process-entries", "POST", "/api/mash/process-entries", json=batch)
+        if response is not None and response.headers.get(SESSION_HEADER):
+            self.session_id = response.headers[SESSION_HEADER]
+
+    def run(self, deadline: float):
+        self.paste()
+        while time.time() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            if action == "poll":
+                self._call("descriptions", "GET", "/api/mash/descriptions")
+            elif action == "paste":
+                self.paste()
+            else:
+                self._call(f"user-prompt:{action}", "POST", "/api/mash/user-prompt",
+                           json={"prompt": random.choice(PROMPTS[action])})
+            if self.think_time > 0:
+                time.sleep(random.expovariate(1 / self.think_time))
+
+
+def _start_app(env: Dict[str, str], port: int, workdir: str) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", SERVER_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env={**os.environ, **env},
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return process
+        except requests.RequestException:
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start within 30s")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    profiles = ", ".join(PROFILES)
+    parser = argparse.ArgumentParser(description="Load-test the mash API with concurrent simulated users")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent users")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of load after ramp-up starts")
+    parser.add_argument("--ramp", type=float, default=10, help="Seconds over which clients are started")
+    parser.add_argument("--images", type=int, default=4, help="Images per clipboard paste")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"Action weights ({', '.join(list(PROMPTS) + ['poll', 'paste'])})")
+    parser.add_argument("--think", type=float, default=1.0, help="Mean think time between actions (seconds)")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout (seconds)")
+    parser.add_argument("--target", help="Base URL of an already-running server (mocks are not wired in)")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the spawned server")
+    parser.add_argument("--gemini", default="realistic", help=f"Gemini mock profile ({profiles}, or key=value list)")
+    parser.add_argument("--soot", default="fast", help="SOOT mock profile")
+    parser.add_argument("--imgur", default="fast", help="Imgur mock profile")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mix = parse_mix(args.mix)
+    servers = None
+    process = None
+    base_url = args.target
+
+    if not base_url:
+        servers = start_mock_upstreams(args.gemini, args.soot, args.imgur)
+        env = upstream_environment(servers)
+        env.setdefault("LOG_LEVEL", "WARNING")
+        workdir = tempfile.mkdtemp(prefix="mash-load-")
+        process = _start_app(env, args.port, workdir)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    recorder = Recorder()
+    sampler = ResourceSampler(process.pid if process else None, f"{base_url.rstrip('/')}/metrics")
+    sampler.start()
+
+    start = time.time()
+    deadline = start + args.duration
+    threads = []
+    try:
+        for i in range(args.clients):
+            client = Client(base_url, servers["soot"] if servers else None, recorder, args.images, mix,
+                            args.think, args.timeout)
+            thread = threading.Thread(target=client.run, args=(deadline,), name=f"load-client-{i}", daemon=True)
+            thread.start()
+            threads.append(thread)
+            if args.ramp > 0 and args.clients > 1:
+                time.sleep(args.ramp / (args.clients - 1))
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.time() - start
+        resources = sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        upstreams = upstream_stats(servers) if servers else None
+        if servers:
+            stop_mock_upstreams(servers)
+
+    report = {
+        "clients": args.clients,
+        "durationSeconds": round(elapsed, 1),
+        "mix": mix,
+        "profiles": {"gemini": args.gemini, "soot": args.soot, "imgur": args.imgur} if servers else None,
+        "endpoints": recorder.report(elapsed),
+        "serverResources": resources,
+        "upstreams": upstreams,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
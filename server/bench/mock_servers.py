@@ -0,0 +1,411 @@
+"""
+Local stand-ins for Gemini generateContent, the SOOT GraphQL API (and image
+downloads) and the Imgur upload API, each with a configurable latency, error
+and rate-limit profile.
+"""
+
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from base64 import b64encode
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+# Named profiles; any field can be overridden with "name,key=value,..."
+PROFILES = {
+    "fast": {},
+    "realistic": {"latency": 0.8, "jitter": 0.4},
+    "slow": {"latency": 4.0, "jitter": 2.0},
+    "flaky": {"latency": 0.3, "jitter": 0.2, "errors": 0.05, "rate_limit": 0.1, "retry_after": 1},
+}
+
+
+class Profile:
+    """
+    Latency and failure behaviour of a mock upstream
+
+    Args:
+        latency: Mean added latency in seconds
+        jitter: Uniform +/- jitter in seconds
+        errors: Fraction of requests answered with HTTP 500
+        rate_limit: Fraction of requests answered with HTTP 429
+        retry_after: Retry-After seconds sent with 429 responses (omitted if 0)
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, errors: float = 0.0,
+                 rate_limit: float = 0.0, retry_after: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+
+    @classmethod
+    def parse(cls, spec: str) -> "Profile":
+        """Parse "realistic", "latency=0.5,errors=0.01" or "flaky,latency=2" """
+        values: Dict[str, float] = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            if "=" in item:
+                key, value = item.split("=", 1)
+                values[key.strip()] = float(value)
+            elif item in PROFILES:
+                values.update(PROFILES[item])
+            else:
+                raise ValueError(f"Unknown profile: {item}")
+        return cls(**values)
+
+    def delay(self):
+        latency = self.latency + random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def failure(self) -> Optional[Tuple[int, Dict[str, str]]]:
+        """Status and headers of an injected failure, or None to answer normally"""
+        roll = random.random()
+        if roll < self.rate_limit:
+            headers = {"Retry-After": f"{self.retry_after:g}"} if self.retry_after else {}
+            return 429, headers
+        if roll < self.rate_limit + self.errors:
+            return 500, {}
+        return None
+
+
+def make_png(seed: int, size: int = 64) -> bytes:
+    """Small deterministic PNG whose colours and pattern depend on the seed"""
+    rng = random.Random(seed)
+    base = [rng.randrange(256) for _ in range(3)]
+    step = [rng.randrange(1, 8) for _ in range(3)]
+    stripe = rng.randrange(2, 16)
+    rows = []
+    for y in range(size):
+        row = bytearray([0])  # Filter type 0
+        for x in range(size):
+            band = ((x // stripe) + (y // stripe)) % 2
+            row.extend((base[c] + step[c] * (x + y) + band * 64) % 256 for c in range(3))
+        rows.append(bytes(row))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows))) + chunk(b"IEND", b"")
+
+
+class MockServer:
+    """Threaded HTTP server on a free local port that counts requests per route"""
+
+    name = "mock"
+
+    def __init__(self, profile: Optional[Profile] = None):
+        self.profile = profile or Profile()
+        self.requests: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"{self.name}-server", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "injectedFailures": dict(self.failures),
+                "bytesReceived": self.bytes_received,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.failures.clear()
+            self.bytes_received = 0
+
+    def handle(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, str], bytes]:
+        """Return (status, headers, body) for a request; overridden by each mock"""
+        raise NotImplementedError
+
+    def route_name(self, method: str, path: str, body: bytes) -> str:
+        return f"{method} {path.split('?')[0]}"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                route = server.route_name(method, self.path, body)
+                with server._lock:
+                    server.requests[route] += 1
+                    server.bytes_received += len(body)
+
+                server.profile.delay()
+                failure = server.profile.failure()
+                if failure is not None:
+                    status, headers = failure
+                    with server._lock:
+                        server.failures[f"{route} {status}"] += 1
+                    payload = json.dumps({"error": {"code": status, "message": "Injected failure"}}).encode()
+                else:
+                    status, headers, payload = server.handle(method, self.path, body)
+
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                if "Content-Type" not in headers:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+            def log_message(self, format, *args):
+                pass  # Keep benchmark output clean
+
+        return Handler
+
+
+def _json(payload: Dict, status: int = 200) -> Tuple[int, Dict[str, str], bytes]:
+    return status, {"Content-Type": "application/json"}, json.dumps(payload).encode()
+
+
+class MockGemini(MockServer):
+    """
+    Emulates POST /models/{model}:generateContent
+
+    Text requests get a description, a JSON tag array or a relevance score
+    depending on the prompt; requests with an IMAGE response modality get
+    candidateCount generated PNGs.
+    """
+
+    name = "gemini"
+    _path = re.compile(r"^/models/([^/:]+):generateContent")
+
+    def route_name(self, method: str, path: str, body: bytes) -> str:
+        match = self._path.match(path)
+        return f"generateContent {match.group(1)}" if match else super().route_name(method, path, body)
+
+    def handle(self, method, path, body):
+        match = self._path.match(path)
+        if method != "POST" or not match:
+            return _json({"error": {"code": 404, "message": "Not found"}}, 404)
+        request = json.loads(body or b"{}")
+        config = request.get("generationConfig") or {}
+        modalities = config.get("responseModalities") or config.get("response_modalities") or []
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        prompt = " ".join(part.get("text", "") for part in parts)
+        digest = int(hashlib.sha256(body).hexdigest()[:8], 16)
+
+        if "IMAGE" in modalities:
+            candidates = []
+            for index in range(int(config.get("candidateCount", 1))):
+                image = b64encode(make_png(digest + index)).decode()
+                candidates.append({"content": {"role": "model", "parts": [
+                    {"text": f"Generated image {index + 1} for: {prompt[:60]}"},
+                    {"inlineData": {"mimeType": "image/png", "data": image}},
+                ]}, "finishReason": "STOP", "index": index})
+            return _json({"candidates": candidates})
+
+        if "JSON array" in prompt:
+            words = ["portrait", "landscape", "vibrant", "muted", "high contrast", "soft light",
+                     "minimalist", "vintage", "urban", "nature", "warm tones", "cool tones"]
+            rng = random.Random(digest)
+            text = json.dumps(rng.sample(words, 8))
+        elif "Return only a number" in prompt:
+            text = str(digest % 11)
+        else:
+            text = f"A synthetic benchmark image #{digest % 1000} with bold stripes and vibrant colors, in a minimalist style."
+        return _json({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                      "finishReason": "STOP", "index": 0}]})
+
+
+class MockSoot(MockServer):
+    """
+    Emulates the SOOT GraphQL operations used by the server (shapes from
+    schema.json) and serves image downloads from GET /images/{id}.png
+    """
+
+    name = "soot"
+
+    def __init__(self, profile: Optional[Profile] = None, publications_per_space: int = 20):
+        super().__init__(profile)
+        self.publications_per_space = publications_per_space
+        self.upload_intents: Dict[str, Dict] = {}
+
+    def image_url(self, image_id: str) -> str:
+        return f"{self.url}/images/{image_id}.png"
+
+    def route_name(self, method, path, body):
+        if method == "POST":
+            return f"graphql {self._operation(body)}"
+        return "GET /images" if path.startswith("/images/") else super().route_name(method, path, body)
+
+    @staticmethod
+    def _operation(body: bytes) -> str:
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return "invalid"
+        if request.get("operationName"):
+            return request["operationName"]
+        query = request.get("query", "")
+        for field in ("createUploadIntent", "uploadFromUrl", "completeUploadIntent", "getUploadIntentById",
+                      "getSpacePublicationById", "getSpaceById", "viewer"):
+            if field in query:
+                return field
+        return "unknown"
+
+    def handle(self, method, path, body):
+        if method == "GET" and path.startswith("/images/"):
+            image_id = path[len("/images/"):].split(".")[0]
+            seed = int(hashlib.sha256(image_id.encode()).hexdigest()[:8], 16)
+            return 200, {"Content-Type": "image/png"}, make_png(seed)
+        if method != "POST":
+            return _json({"errors": [{"message": "Not found"}]}, 404)
+
+        request = json.loads(body or b"{}")
+        query = request.get("query", "")
+        variables = (request.get("variables") or {}).get("request", {})
+
+        if "createUploadIntent" in query:
+            intent_id = str(uuid.uuid4())
+            with self._lock:
+                self.upload_intents[intent_id] = {"files": 0, "completed": False, "created": time.time()}
+            return _json({"data": {"createUploadIntent": {
+                "__typename": "CreateUploadIntentResult", "uploadIntent": {"id": intent_id}}}})
+        if "uploadFromUrl" in query:
+            with self._lock:
+                intent = self.upload_intents.get(variables.get("uploadIntent"))
+                if intent is not None:
+                    intent["files"] += len(variables.get("urls", []))
+            typename = "UploadFromUrlResult" if intent is not None else "ValidationError"
+            return _json({"data": {"uploadFromUrl": {"__typename": typename}}})
+        if "completeUploadIntent" in query:
+            intent_id = variables.get("uploadIntent")
+            with self._lock:
+                if intent_id in self.upload_intents:
+                    self.upload_intents[intent_id]["completed"] = True
+            return _json({"data": {"completeUploadIntent": {
+                "__typename": "CompleteUploadIntentResult", "uploadIntent": {"id": intent_id}}}})
+        if "getUploadIntentById" in query:
+            # Batched reads alias one field per intent: r0: getUploadIntentById(request: $request0)
+            aliases = re.findall(r"(\w+): getUploadIntentById\(request: \$(\w+)\)", query)
+            if aliases:
+                all_variables = request.get("variables") or {}
+                return _json({"data": {alias: self._upload_intent_result((all_variables.get(name) or {}).get("id"))
+                                       for alias, name in aliases}})
+            return _json({"data": {"getUploadIntentById": self._upload_intent_result(variables.get("id"))}})
+        if "getSpacePublicationById" in query:
+            publication_id = variables.get("id") or self._inline_id(query)
+            return _json({"data": {"getSpacePublicationById": {
+                "__typename": "GetSpacePublicationByIdResult",
+                "spacePublication": {"id": publication_id, "snapshotUrl": self.image_url(publication_id)}}}})
+        if "getSpaceById" in query:
+            space_id = variables.get("id") or self._inline_id(query)
+            return _json({"data": {"getSpaceById": self._space_result(space_id, request.get("variables") or {})}})
+        if "viewer" in query:
+            return _json({"data": {"viewer": {"spaces": [
+                {"id": f"space-{i}", "displayName": f"Bench space {i}"} for i in range(3)]}}})
+        return _json({"errors": [{"message": "Unsupported operation"}]})
+
+    @staticmethod
+    def _inline_id(query: str) -> Optional[str]:
+        match = re.search(r'id:\s*"([^"]+)"', query)
+        return match.group(1) if match else None
+
+    def _space_result(self, space_id: str, variables: Dict) -> Dict:
+        first = int((variables.get("filter") or {}).get("first") or self.publications_per_space)
+        after = (variables.get("filter") or {}).get("after")
+        start = int(after) + 1 if after is not None else 0
+        end = min(start + first, self.publications_per_space)
+        edges = [{"cursor": str(i), "node": {
+            "id": f"{space_id}-pub-{i}", "operation": 0, "dateCreated": "2025-01-01T00:00:00Z",
+            "snapshotUrl": self.image_url(f"{space_id}-pub-{i}")}} for i in range(start, end)]
+        return {"__typename": "GetSpaceByIdResult", "space": {"id": space_id, "publications": {
+            "edges": edges,
+            "pageInfo": {"endCursor": edges[-1]["cursor"] if edges else None,
+                         "hasNextPage": end < self.publications_per_space},
+            "totalCount": self.publications_per_space}}}
+
+    def _upload_intent_result(self, intent_id: str) -> Dict:
+        with self._lock:
+            intent = self.upload_intents.get(intent_id)
+        if intent is None:
+            return {"__typename": "NotFoundError", "entity": "UploadIntent"}
+        if intent["completed"]:
+            state = {"__typename": "UploadIntentCompletedState", "dateCompleted": "2025-01-01T00:00:00Z",
+                     "elapsedMilliseconds": int((time.time() - intent["created"]) * 1000),
+                     "filesUploaded": intent["files"]}
+        else:
+            state = {"__typename": "UploadIntentInProgressState", "percentUploaded": 50.0,
+                     "uploadedFiles": intent["files"], "erroredFiles": 0, "processedFiles": intent["files"]}
+        return {"__typename": "GetUploadIntentByIdResult", "uploadIntent": {"id": intent_id, "state": state}}
+
+
+class MockImgur(MockServer):
+    """Emulates POST /3/image with base64 form uploads"""
+
+    name = "imgur"
+
+    def handle(self, method, path, body):
+        if method != "POST" or not path.startswith("/3/image"):
+            return _json({"success": False, "status": 404, "data": {"error": "Not found"}}, 404)
+        image_id = uuid.uuid4().hex[:7]
+        return _json({"success": True, "status": 200, "data": {
+            "id": image_id, "link": f"{self.url}/i/{image_id}.png", "deletehash": uuid.uuid4().hex[:15]}})
+
+
+def start_mock_upstreams(gemini: str = "fast", soot: str = "fast", imgur: str = "fast") -> Dict[str, MockServer]:
+    """Start all three mocks with the given profile specs"""
+    return {
+        "gemini": MockGemini(Profile.parse(gemini)).start(),
+        "soot": MockSoot(Profile.parse(soot)).start(),
+        "imgur": MockImgur(Profile.parse(imgur)).start(),
+    }
+
+
+def upstream_environment(servers: Dict[str, MockServer]) -> Dict[str, str]:
+    """Environment variables pointing the server's clients at the mocks"""
+    return {
+        "GEMINI_API_BASE": servers["gemini"].url,
+        "GEMINI_API_KEY": "bench",
+        "SOOT_API_URL": f"{servers['soot'].url}/graphql",
+        "SOOT_ACCESS_TOKEN": "bench",
+        "IMGUR_API_URL": f"{servers['imgur'].url}/3/image",
+    }
+
+
+def upstream_stats(servers: Dict[str, MockServer]) -> Dict[str, Dict]:
+    return {name: server.stats() for name, server in servers.items()}
+
+
+def stop_mock_upstreams(servers: Dict[str, MockServer]):
+    for server in servers.values():
+        server.stop()
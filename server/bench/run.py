@@ -0,0 +1,99 @@
+"""
+Offline benchmarks against local mock upstreams.
+
+Run from the server directory, e.g.:
+
+    python -m bench.run
+    python -m bench.run ingestion upload --images 50 --gemini realistic --imgur flaky
+    python -m bench.run mash_all --images 6 --output bench-results.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .mock_servers import PROFILES, start_mock_upstreams, stop_mock_upstreams, upstream_environment, upstream_stats
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIO_NAMES = ["ingestion", "matching", "mash_all", "variation", "upload", "soot_reads"]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    profiles = ", ".join(PROFILES)
+    parser = argparse.ArgumentParser(description="Run offline benchmarks against mock Gemini, SOOT and Imgur servers")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"Scenarios to run: {', '.join(SCENARIO_NAMES)} (default: all)")
+    parser.add_argument("--images", type=int, help="Images per scenario (scenario default if omitted)")
+    parser.add_argument("--prompts", type=int, default=10, help="Prompts for the matching scenario")
+    parser.add_argument("--variations", type=int, default=4, help="Variations per image for the variation scenario")
+    parser.add_argument("--uploads", type=int, default=20, help="Uploads for the upload scenario")
+    parser.add_argument("--reads", type=int, default=200, help="Reads for the soot_reads scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent uploads or reads for the upload and soot_reads scenarios")
+    parser.add_argument("--gemini", default="fast", help=f"Gemini mock profile ({profiles}, or key=value list)")
+    parser.add_argument("--soot", default="fast", help="SOOT mock profile")
+    parser.add_argument("--imgur", default="fast", help="Imgur mock profile")
+    parser.add_argument("--rpm", type=int, default=100000,
+                        help="Per-model requests-per-minute budget given to the Gemini scheduler")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIO_NAMES]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_path = os.path.abspath(args.output) if args.output else None
+    servers = start_mock_upstreams(args.gemini, args.soot, args.imgur)
+
+    # Point the server at the mocks before any server module is imported
+    os.environ.update(upstream_environment(servers))
+    for name in ("GEMINI_TEXT_RPM", "GEMINI_IMAGE_RPM"):
+        os.environ[name] = str(args.rpm)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    # Keep cache/ and artifacts/ out of the working tree
+    workdir = tempfile.mkdtemp(prefix="mash-bench-")
+    sys.path.insert(0, SERVER_DIR)
+    os.chdir(workdir)
+
+    from utils.log import configure_logging
+    configure_logging()
+    from .scenarios import SCENARIOS
+
+    params = {"prompts": args.prompts, "variations": args.variations,
+              "uploads": args.uploads, "reads": args.reads, "concurrency": args.concurrency}
+    if args.images is not None:
+        params["images"] = args.images
+
+    report = {
+        "startedAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "profiles": {"gemini": args.gemini, "soot": args.soot, "imgur": args.imgur},
+        "workdir": workdir,
+        "results": [],
+    }
+    try:
+        for name in args.scenarios or SCENARIO_NAMES:
+            for server in servers.values():
+                server.reset()
+            result = SCENARIOS[name](servers, **params)
+            result["upstreams"] = upstream_stats(servers)
+            report["results"].append(result)
+            print(f"{name}: {result['wallSeconds']}s, {result['throughputPerSec']}/s, "
+                  f"{result['errors']} error(s)", file=sys.stderr)
+    finally:
+        stop_mock_upstreams(servers)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
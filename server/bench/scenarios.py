@@ -0,0 +1,192 @@
+"""
+Benchmark scenarios run in-process against the mock upstreams.
+
+Import this module only after the environment points at the mocks (see
+bench.run), since the server modules read their upstream URLs at import time.
+"""
+
+import base64
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from mash import processor
+from mash.image_store import image_store
+from mash.records import ImageRecord
+from mash.session_store import Session, create_session, get_session, new_session_id
+from mash.upload_utils import upload_image_to_soot
+from soot.connector import get_publication_snapshot_url, get_space_items, get_user_spaces
+
+from .mock_servers import MockServer, make_png
+from .stats import summarize
+
+BENCH_SPACE_ID = "bench-space"
+ENRICHMENT_TIMEOUT_SECONDS = 300
+
+PROMPTS = [
+    "make it look like a vintage photograph",
+    "a vibrant landscape at sunset",
+    "high contrast black and white portrait",
+    "soft pastel minimalist composition",
+    "urban street scene with warm tones",
+]
+
+
+def _result(name: str, params: Dict, wall: float, latencies: List[float], errors: int, items: int) -> Dict:
+    return {
+        "scenario": name,
+        "params": params,
+        "wallSeconds": round(wall, 3),
+        "throughputPerSec": round(items / wall, 3) if wall > 0 else None,
+        "errors": errors,
+        "latency": summarize(latencies),
+    }
+
+
+def _seeded_session(images: int) -> Session:
+    """A session already holding enriched records, so scenarios skip ingestion"""
+    session = create_session()
+    for i in range(images):
+        session.put(ImageRecord(
+            instance_id=str(uuid.uuid4()),
+            metadata={"imageURL": "", "instanceId": "", "filename": f"seed-{i}.png",
+                      "spaceId": BENCH_SPACE_ID, "operation": 0},
+            image=image_store.put(base64.b64encode(make_png(i)).decode("utf-8")),
+            description=f"Synthetic benchmark image {i} with bold stripes and vibrant colors.",
+            tags=["synthetic", "stripes", "vibrant" if i % 2 else "muted", f"image{i}"],
+        ))
+    return session
+
+
+def ingestion(servers: Dict[str, MockServer], images: int = 20, **_) -> Dict:
+    """Paste a batch of images and wait until every one is described and tagged"""
+    session_id = new_session_id()
+    metadata = [
+        processor.Metadata(
+            imageURL=servers["soot"].image_url(f"ingest-{uuid.uuid4().hex[:8]}"),
+            instanceId=str(uuid.uuid4()),
+            filename=f"ingest-{i}.png",
+            spaceId=BENCH_SPACE_ID,
+            operation=0,
+        )
+        for i in range(images)
+    ]
+
+    start = time.perf_counter()
+    payloads = processor.process_metadata_entries(metadata, session_id)
+    request_seconds = time.perf_counter() - start
+
+    # Poll the session for enriched records to get per-image completion times
+    session = get_session(session_id)
+    completed: Dict[str, float] = {}
+    deadline = start + ENRICHMENT_TIMEOUT_SECONDS
+    while session is not None and len(completed) < len(payloads) and time.perf_counter() < deadline:
+        now = time.perf_counter()
+        for instance_id in session.items():
+            completed.setdefault(instance_id, now - start)
+        time.sleep(0.02)
+    wall = time.perf_counter() - start
+
+    errors = images - len(completed)
+    if session is not None:
+        errors += sum(1 for record in session.records() if record.enrichment_error)
+    result = _result("ingestion", {"images": images}, wall, list(completed.values()), errors, images)
+    result["requestSeconds"] = round(request_seconds, 3)
+    return result
+
+
+def matching(servers: Dict[str, MockServer], images: int = 20, prompts: int = 10, **_) -> Dict:
+    """Find the best match for free-form prompts over a session of enriched images"""
+    session = _seeded_session(images)
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for i in range(prompts):
+        call_start = time.perf_counter()
+        if processor.find_best_matching_image(session, PROMPTS[i % len(PROMPTS)]) is None:
+            errors += 1
+        latencies.append(time.perf_counter() - call_start)
+    wall = time.perf_counter() - start
+    return _result("matching", {"images": images, "prompts": prompts}, wall, latencies, errors, prompts)
+
+
+def mash_all(servers: Dict[str, MockServer], images: int = 4, **_) -> Dict:
+    """Run `mash:` (every ordered pair) including the uploads"""
+    session = _seeded_session(images)
+    start = time.perf_counter()
+    result = processor.handle_mash_all_images(session)
+    wall = time.perf_counter() - start
+    combinations = result.get("combinations", [])
+    errors = sum(1 for combo in combinations if "error" in combo)
+    errors += sum(1 for combo in combinations if not combo.get("sootUploadResult", {}).get("success", True))
+    # Combinations run one after another, so only the mean per combination is meaningful here
+    result = _result("mash_all", {"images": images}, wall, [], errors, len(combinations))
+    result["meanPerItemMs"] = round(wall / len(combinations) * 1000, 2) if combinations else None
+    return result
+
+
+def variation(servers: Dict[str, MockServer], images: int = 3, variations: int = 4, **_) -> Dict:
+    """Run `variation:[n]` over every image in a session, including uploads"""
+    session = _seeded_session(images)
+    parsed = processor.parse_user_command(f"variation:[{variations}]")
+    start = time.perf_counter()
+    result = processor.handle_variation_command(session, parsed)
+    wall = time.perf_counter() - start
+    generated = result.get("variations", [])
+    total = images * variations
+    errors = total - len(generated) + sum(1 for item in generated if "error" in item)
+    result = _result("variation", {"images": images, "variations": variations}, wall, [], errors, total)
+    result["meanPerItemMs"] = round(wall / total * 1000, 2)
+    return result
+
+
+def upload(servers: Dict[str, MockServer], uploads: int = 20, concurrency: int = 4, **_) -> Dict:
+    """Upload generated images through Imgur and the SOOT upload-intent mutations"""
+    images = [base64.b64encode(make_png(1000 + i)).decode("utf-8") for i in range(uploads)]
+
+    def upload_one(image_base64: str):
+        call_start = time.perf_counter()
+        outcome = upload_image_to_soot(image_base64, BENCH_SPACE_ID, is_base64=True, verbose=False)
+        return time.perf_counter() - call_start, outcome["success"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(upload_one, images))
+    wall = time.perf_counter() - start
+    latencies = [latency for latency, _ in outcomes]
+    errors = sum(1 for _, success in outcomes if not success)
+    return _result("upload", {"uploads": uploads, "concurrency": concurrency}, wall, latencies, errors, uploads)
+
+
+def soot_reads(servers: Dict[str, MockServer], reads: int = 200, concurrency: int = 4, **_) -> Dict:
+    """Browse spaces, their items and snapshot URLs the way /api/soot/* does"""
+    spaces = [f"bench-read-{i}" for i in range(3)]
+
+    def read_one(i: int):
+        call_start = time.perf_counter()
+        space_id = spaces[i % len(spaces)]
+        if i % 3 == 0:
+            data = get_user_spaces()
+        elif i % 3 == 1:
+            data = get_space_items(space_id)
+        else:
+            data = get_publication_snapshot_url(f"{space_id}-pub-{i % 5}")
+        return time.perf_counter() - call_start, "error" in data or "errors" in data
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(read_one, range(reads)))
+    wall = time.perf_counter() - start
+    latencies = [latency for latency, _ in outcomes]
+    errors = sum(1 for _, failed in outcomes if failed)
+    return _result("soot_reads", {"reads": reads, "concurrency": concurrency}, wall, latencies, errors, reads)
+
+
+SCENARIOS: Dict[str, Callable[..., Dict]] = {
+    "ingestion": ingestion,
+    "matching": matching,
+    "mash_all": mash_all,
+    "variation": variation,
+    "upload": upload,
+    "soot_reads": soot_reads,
+}
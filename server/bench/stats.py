@@ -0,0 +1,25 @@
+import math
+from typing import Dict, List, Sequence
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile (pct in 0-100) of an unsorted sequence"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float]) -> Dict:
+    """Count, mean, p50/p95/p99 and max of a list of latencies, in milliseconds"""
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "meanMs": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95Ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+        "maxMs": round(max(latencies) * 1000, 2),
+    }
@@ -0,0 +1,66 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from bench.load import SESSION_HEADER, Client, Recorder, parse_mix
+
+
+class _App(BaseHTTPRequestHandler):
+    """Issues a session on paste and fails prompts sent without it"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.endswith("/process-entries"):
+            self._reply({"status": "ok"}, {SESSION_HEADER: "session-1"})
+        elif self.headers.get(SESSION_HEADER) == "session-1":
+            self._reply({"status": "received"})
+        else:
+            self._reply({"error": "Missing session"})
+
+    def _reply(self, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def app_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _App)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://%s:%s" % server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+
+
+def test_mix_weights_are_parsed_and_validated():
+    assert parse_mix("prompt=4,poll,tag=0.5") == {"prompt": 4.0, "poll": 1.0, "tag": 0.5}
+    with pytest.raises(ValueError):
+        parse_mix("launch=1")
+
+
+def test_report_has_error_rate_and_throughput():
+    recorder = Recorder()
+    for ok in (True, True, True, False):
+        recorder.record("user-prompt:tag", 0.1, ok)
+    report = recorder.report(duration=2)["user-prompt:tag"]
+    assert (report["count"], report["errors"], report["errorRate"], report["throughputPerSec"]) == (4, 1, 0.25, 2.0)
+
+
+def test_clients_keep_the_session_they_were_issued(app_url):
+    recorder = Recorder()
+    client = Client(app_url, None, recorder, images=2, mix={"prompt": 1}, think_time=0, timeout=5)
+    client.run(deadline=time.time() + 0.2)
+    assert client.session_id == "session-1"
+    assert recorder.latencies["user-prompt:prompt"]
+    assert recorder.errors["user-prompt:prompt"] == 0
@@ -0,0 +1,51 @@
+import base64
+
+import pytest
+import requests
+
+from bench.mock_servers import MockGemini, Profile, make_png
+from bench.stats import percentile, summarize
+
+
+@pytest.fixture
+def gemini():
+    server = MockGemini().start()
+    yield server
+    server.stop()
+
+
+def test_profiles_parse_named_and_overridden_fields():
+    profile = Profile.parse("flaky,latency=2")
+    assert (profile.latency, profile.errors, profile.retry_after) == (2.0, 0.05, 1)
+    with pytest.raises(ValueError):
+        Profile.parse("nonexistent")
+
+
+def test_generated_images_are_deterministic_pngs():
+    assert make_png(1) == make_png(1) != make_png(2)
+    assert make_png(1).startswith(b"\x89PNG")
+
+
+def test_mock_gemini_returns_one_image_per_candidate(gemini):
+    response = requests.post(f"{gemini.url}/models/image-model:generateContent", json={
+        "contents": [{"parts": [{"text": "a variation"}]}],
+        "generationConfig": {"responseModalities": ["TEXT", "IMAGE"], "candidateCount": 3},
+    }).json()
+    images = [part["inlineData"]["data"] for candidate in response["candidates"]
+              for part in candidate["content"]["parts"] if "inlineData" in part]
+    assert len(images) == 3 and all(base64.b64decode(image).startswith(b"\x89PNG") for image in images)
+    assert gemini.stats()["requests"] == {"generateContent image-model": 1}
+
+
+def test_injected_rate_limits_carry_retry_after(gemini):
+    gemini.profile = Profile(rate_limit=1, retry_after=2)
+    response = requests.post(f"{gemini.url}/models/text-model:generateContent", json={})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+
+def test_latency_summaries_use_nearest_rank_percentiles():
+    latencies = [i / 1000 for i in range(1, 101)]
+    assert percentile(latencies, 95) == 0.095
+    assert summarize(latencies)["p50Ms"] == 50.0
+    assert summarize([]) == {"count": 0}
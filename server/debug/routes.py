@@ -0,0 +1,64 @@
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import PlainTextResponse
+
+from utils.profiling import ADMIN_TOKEN, PROFILER_ENABLED, ProfilerBusyError, collapsed, lock_report, sample_stacks
+from utils.tracing import dropped_spans, get_trace, recent_traces
+
+router = APIRouter()
+
+
+def _access_error(x_admin_token: str | None):
+    """Why a debug endpoint may not be used (None if it may): they expose prompts and internals"""
+    if not PROFILER_ENABLED:
+        return {"error": "Debug endpoints disabled; set MASH_PROFILER_ENABLED=1"}
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        return {"error": "Invalid admin token"}
+    return None
+
+
+@router.get("/traces")
+def list_traces(limit: int = Query(20, ge=1, le=200), x_admin_token: str | None = Header(default=None)):
+    """Most recent traces, newest first"""
+    return _access_error(x_admin_token) or recent_traces(limit)
+
+
+@router.get("/traces/{job}")
+def get_job_trace(job: str, x_admin_token: str | None = Header(default=None)):
+    """All spans of one request (the traceId returned by /api/mash endpoints)"""
+    error = _access_error(x_admin_token)
+    if error:
+        return error
+    spans = get_trace(job)
+    if spans is None:
+        return {"error": "Unknown or expired trace", "traceId": job}
+    return {"traceId": job, "spans": spans, "droppedSpans": dropped_spans(job)}
+
+
+@router.get("/profile")
+def get_profile(
+    seconds: float = Query(10, gt=0, le=60),
+    interval: float = Query(0.01, ge=0.001, le=1),
+    format: str = Query("collapsed", pattern="^(collapsed|json)$"),
+    x_admin_token: str | None = Header(default=None),
+):
+    """
+    Sample every thread's stack for `seconds` and return the collapsed stacks
+    (feed to flamegraph.pl or speedscope), or the top stacks as JSON
+    """
+    error = _access_error(x_admin_token)
+    if error:
+        return error
+    try:
+        stacks = sample_stacks(seconds, interval)
+    except ProfilerBusyError as e:
+        return {"error": str(e)}
+    if format == "json":
+        return {"seconds": seconds, "interval": interval, "samples": sum(stacks.values()),
+                "stacks": [{"stack": stack, "count": count} for stack, count in stacks.most_common(200)]}
+    return PlainTextResponse(collapsed(stacks), headers={"Content-Disposition": "attachment; filename=profile.folded"})
+
+
+@router.get("/locks")
+def get_lock_report(x_admin_token: str | None = Header(default=None)):
+    """Contention on cache_lock and the session locks since startup"""
+    return _access_error(x_admin_token) or lock_report()
@@ -1,8 +1,11 @@
 import os
+import sys
 import requests
 import json
 from dotenv import load_dotenv
 
+from soot.operations import schema_index, validate_document
+
 load_dotenv()
 
 SOOT_API_URL = os.getenv("SOOT_API_URL")
@@ -13,7 +16,15 @@ HEADERS = {
     "Content-Type": "application/json",
 }
 
-def introspect_type(type_name: str):
+def introspect_type(type_name: str, live: bool = False):
+    """
+    Describe a schema type from the bundled schema.json (or from the live API with live=True)
+    """
+    if not live:
+        data = schema_index()["types"].get(type_name)
+        print(json.dumps(data, indent=2))
+        return data
+
     query = """
     query IntrospectType($typeName: String!) {
       __type(name: $typeName) {
@@ -41,5 +52,17 @@ def introspect_type(type_name: str):
     print(json.dumps(data, indent=2))
     return data
 
+def check_document(path: str):
+    """Validate a GraphQL operation file against the bundled schema"""
+    with open(path) as f:
+        errors = validate_document(f.read())
+    for error in errors:
+        print(error)
+    return errors
+
 if __name__ == "__main__":
-    introspect_type("SpacePublication")
+    # python inspector.py [TypeName] [--live] | python inspector.py --check operation.graphql
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--check" in sys.argv:
+        sys.exit(1 if check_document(args[0]) else 0)
+    introspect_type(args[0] if args else "SpacePublication", live="--live" in sys.argv)
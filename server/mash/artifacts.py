@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import queue
+import random
+import threading
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+# Generated images and debug dumps go here instead of the working directory
+ARTIFACT_DIR = os.getenv("MASH_ARTIFACT_DIR", "artifacts")
+ARTIFACT_MAX_BYTES = int(os.getenv("MASH_ARTIFACT_MAX_BYTES", str(512 * 1024 * 1024)))  # Oldest files are deleted beyond this
+# Fraction of Gemini responses dumped for debugging (0 disables dumps, 1 dumps every response)
+DEBUG_DUMP_RATE = float(os.getenv("MASH_DEBUG_DUMP_RATE", "0"))
+ARTIFACT_QUEUE_SIZE = 256
+
+
+def strip_inline_data(value):
+    """Copy a Gemini response with every inlineData payload replaced by its size"""
+    if isinstance(value, dict):
+        stripped = {}
+        for key, item in value.items():
+            if key == "inlineData" and isinstance(item, dict) and "data" in item:
+                stripped[key] = dict(item, data=f"<{len(item['data'])} base64 chars>")
+            else:
+                stripped[key] = strip_inline_data(item)
+        return stripped
+    if isinstance(value, list):
+        return [strip_inline_data(item) for item in value]
+    return value
+
+
+class ArtifactSink:
+    """
+    Writes generated images and debug dumps from a background thread into a
+    managed directory, deleting the oldest files once it exceeds its byte budget.
+    """
+
+    def __init__(self, directory: str = ARTIFACT_DIR, max_bytes: int = ARTIFACT_MAX_BYTES,
+                 debug_dump_rate: float = DEBUG_DUMP_RATE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.debug_dump_rate = debug_dump_rate
+        self._queue: "queue.Queue[Tuple[str, str, object]]" = queue.Queue(maxsize=ARTIFACT_QUEUE_SIZE)
+        self._files: Deque[Tuple[str, int]] = deque()  # (path, size), oldest first
+        self._total_bytes = 0
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            # Pick up files left by earlier runs so they count towards the budget
+            existing = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    existing.append((stat.st_mtime, path, stat.st_size))
+            for _, path, size in sorted(existing):
+                self._files.append((path, size))
+                self._total_bytes += size
+            threading.Thread(target=self._writer_loop, name="artifact-writer", daemon=True).start()
+            self._started = True
+
+    def write_image(self, filename: str, image_base64: str) -> str:
+        """
+        Queue a base64 image for writing
+
+        Returns:
+            The path the image will be written to
+        """
+        self._start()
+        path = os.path.join(self.directory, filename)
+        self._enqueue(("image", path, image_base64))
+        return path
+
+    def dump_debug(self, filename: str, result_json: Dict):
+        """Queue a (sampled) debug dump of a Gemini response, without image payloads"""
+        if self.debug_dump_rate <= 0 or random.random() >= self.debug_dump_rate:
+            return
+        self._start()
+        self._enqueue(("json", os.path.join(self.directory, filename), result_json))
+
+    def _enqueue(self, item: Tuple[str, str, object]):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            logger.warning("Artifact queue full, dropping %s", os.path.basename(item[1]))
+
+    def _writer_loop(self):
+        while True:
+            kind, path, payload = self._queue.get()
+            try:
+                if kind == "image":
+                    data = base64.b64decode(payload)
+                else:
+                    data = json.dumps(strip_inline_data(payload)).encode("utf-8")
+                with open(path, "wb") as f:
+                    f.write(data)
+                self._files.append((path, len(data)))
+                self._total_bytes += len(data)
+                self._enforce_budget()
+            except Exception as e:
+                logger.error("Failed to write artifact %s: %s", path, e)
+            finally:
+                self._queue.task_done()
+
+    def _enforce_budget(self):
+        while self._total_bytes > self.max_bytes and len(self._files) > 1:
+            path, size = self._files.popleft()
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """Block until every queued artifact has been written"""
+        if self._started:
+            self._queue.join()
+
+
+artifact_sink = ArtifactSink()
@@ -0,0 +1,312 @@
+import contextvars
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from utils.log import get_logger
+from utils.metrics import counter, gauge
+
+logger = get_logger(__name__)
+
+# Metered resources: image-model calls, text-model calls and tokens (as reported by the model)
+RESOURCES = ("generations", "text_calls", "tokens")
+# Rough tokens per call (inputs and output), for estimating a command before it runs
+ESTIMATED_TOKENS = {"generations": 2000, "text_calls": 600}
+
+# Budgets apply to usage over a rolling window
+BUDGET_WINDOW_SECONDS = int(os.getenv("MASH_BUDGET_WINDOW_SECONDS", str(24 * 3600)))
+# "resource=amount,..." per window; resources not listed are unlimited
+GLOBAL_BUDGET = os.getenv("MASH_BUDGET_GLOBAL", "")
+SESSION_BUDGET = os.getenv("MASH_BUDGET_SESSION", "")
+# Share of the global budget batch commands may not use, kept for interactive commands
+INTERACTIVE_RESERVE = float(os.getenv("MASH_BUDGET_INTERACTIVE_RESERVE", "0.2"))
+# Batch commands running at once while a global budget is set (0 = no limit); more wait up to
+# BATCH_QUEUE_SECONDS for a slot, then are shed
+BATCH_MAX_IN_FLIGHT = int(os.getenv("MASH_BUDGET_BATCH_MAX_IN_FLIGHT", "0"))
+BATCH_QUEUE_SECONDS = float(os.getenv("MASH_BUDGET_BATCH_QUEUE_SECONDS", "0"))
+
+BUDGET_USAGE = counter("mash_budget_usage_total", "Model usage charged to budgets by resource", ["resource"])
+BUDGET_ADMISSIONS = counter("mash_budget_admissions_total",
+                            "Commands by admission decision (admitted, deferred, rejected_budget, rejected_load)",
+                            ["command", "decision"])
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """Parse "resource=amount,..." into a dict"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        resource, _, amount = item.partition("=")
+        resource = resource.strip()
+        if resource not in RESOURCES:
+            raise ValueError(f"Unknown budget resource: {resource}")
+        limits[resource] = int(amount)
+    return limits
+
+
+def estimate(generations: int = 0, text_calls: int = 0) -> Dict[str, int]:
+    """Cost of a command making the given number of model calls"""
+    return {
+        "generations": generations,
+        "text_calls": text_calls,
+        "tokens": generations * ESTIMATED_TOKENS["generations"] + text_calls * ESTIMATED_TOKENS["text_calls"],
+    }
+
+
+class _Usage:
+    """Usage of one account within the rolling window"""
+
+    def __init__(self):
+        self.events: Deque[Tuple[float, str, int]] = deque()
+        self.totals: Counter = Counter()
+
+    def add(self, now: float, resource: str, amount: int):
+        self.events.append((now, resource, amount))
+        self.totals[resource] += amount
+
+    def prune(self, cutoff: float):
+        while self.events and self.events[0][0] < cutoff:
+            _, resource, amount = self.events.popleft()
+            self.totals[resource] -= amount
+
+    def freed_after(self, resource: str, amount: int, now: float, window_seconds: int) -> Optional[float]:
+        """Seconds until at least `amount` of a resource has left the window (None if it never will)"""
+        freed = 0
+        for when, event_resource, event_amount in self.events:
+            if event_resource == resource:
+                freed += event_amount
+                if freed >= amount:
+                    return max(0.0, when + window_seconds - now)
+        return None
+
+
+class Ticket:
+    """
+    An admitted command. Its estimated cost stays reserved while it runs,
+    less whatever it has already used, so concurrent commands cannot
+    overcommit the budget.
+
+    Entering the ticket makes it the account that model calls in the
+    current context (including run_bulk workers) are charged to.
+    """
+
+    def __init__(self, ledger: "BudgetLedger", session_id: Optional[str], command: str,
+                 cost: Dict[str, int], batch: bool):
+        self.ledger = ledger
+        self.session_id = session_id
+        self.command = command
+        self.cost = cost
+        self.batch = batch
+        self.used: Counter = Counter()
+        self._token = None
+
+    def outstanding(self, resource: str) -> int:
+        return max(0, self.cost.get(resource, 0) - self.used[resource])
+
+    def __enter__(self) -> "Ticket":
+        self._token = _current_ticket.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current_ticket.reset(self._token)
+        self.ledger.release(self)
+
+
+_current_ticket: contextvars.ContextVar[Optional[Ticket]] = contextvars.ContextVar("budget_ticket", default=None)
+
+
+class BudgetLedger:
+    """
+    Model usage per session and in total over a rolling window, with
+    admission control for commands based on their estimated cost.
+    """
+
+    def __init__(self, window_seconds: int, global_limits: Dict[str, int], session_limits: Dict[str, int],
+                 interactive_reserve: float = 0.0, batch_max_in_flight: int = 0, batch_queue_seconds: float = 0.0):
+        self.window_seconds = window_seconds
+        self.global_limits = global_limits
+        self.session_limits = session_limits
+        self.interactive_reserve = interactive_reserve
+        self.batch_max_in_flight = batch_max_in_flight
+        self.batch_queue_seconds = batch_queue_seconds
+        self.batch_in_flight = 0
+        self._global = _Usage()
+        self._sessions: Dict[str, _Usage] = {}
+        self._tickets: List[Ticket] = []
+        self._cond = threading.Condition()
+
+    def _prune(self, now: float):
+        cutoff = now - self.window_seconds
+        self._global.prune(cutoff)
+        for session_id, usage in list(self._sessions.items()):
+            usage.prune(cutoff)
+            if not usage.events:
+                del self._sessions[session_id]
+
+    def _check(self, usage: Optional[_Usage], limits: Dict[str, int], tickets: List[Ticket],
+               cost: Dict[str, int], share: float, now: float) -> Optional[Tuple[str, int, Optional[float]]]:
+        """First resource the cost does not fit in: (resource, available, seconds until it fits or None)"""
+        for resource, limit in limits.items():
+            needed = cost.get(resource, 0)
+            if not needed:
+                continue
+            used = usage.totals[resource] if usage else 0
+            reserved = sum(ticket.outstanding(resource) for ticket in tickets)
+            available = int(limit * share) - used - reserved
+            if needed <= available:
+                continue
+            retry_after = None
+            if needed <= int(limit * share) - reserved and usage is not None:
+                retry_after = usage.freed_after(resource, needed - available, now, self.window_seconds)
+            return resource, max(0, available), retry_after
+        return None
+
+    def admit(self, session_id: Optional[str], command: str, cost: Dict[str, int],
+              batch: bool = False, speculative: bool = False) -> Tuple[Optional[Ticket], Optional[Dict]]:
+        """
+        Admit a command if its estimated cost fits the session and global budgets
+
+        Batch commands may not use the interactive reserve of the global
+        budget. When a global budget is set, only batch_max_in_flight of them
+        run at once; others wait for a slot for up to batch_queue_seconds
+        before being shed. Speculative work (e.g. enriching prefetched
+        images) is held to the batch share too, but never takes or waits for
+        a batch slot: it is turned away at once while the slots are full.
+
+        Args:
+            session_id: Session running the command
+            command: Command type, for metrics
+            cost: Estimated cost from estimate()
+            batch: Whether the command scales with the session (mash-all, variation, ...)
+            speculative: Whether the work was not asked for by a user
+
+        Returns:
+            (ticket to run the command under, None) or (None, error response)
+        """
+        with self._cond:
+            if batch and self.batch_max_in_flight and self.global_limits:
+                deadline = time.monotonic() + self.batch_queue_seconds
+                if self.batch_in_flight >= self.batch_max_in_flight:
+                    BUDGET_ADMISSIONS.inc(command=command, decision="deferred")
+                while self.batch_in_flight >= self.batch_max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        BUDGET_ADMISSIONS.inc(command=command, decision="rejected_load")
+                        logger.warning("Shedding %s command: %s batch commands already running", command, self.batch_in_flight)
+                        return None, {
+                            "error": "Too many batch commands running, try again shortly",
+                            "budget": {"estimate": cost, "retryAfterSeconds": self.batch_queue_seconds},
+                        }
+                    self._cond.wait(timeout=remaining)
+            if (speculative and self.batch_max_in_flight and self.global_limits
+                    and self.batch_in_flight >= self.batch_max_in_flight):
+                BUDGET_ADMISSIONS.inc(command=command, decision="rejected_load")
+                return None, {"error": "Batch commands are running, not starting speculative work",
+                              "budget": {"estimate": cost, "retryAfterSeconds": None}}
+
+            now = time.time()
+            self._prune(now)
+            session_usage = self._sessions.get(session_id)
+            session_tickets = [ticket for ticket in self._tickets if ticket.session_id == session_id]
+            share = 1.0 - self.interactive_reserve if batch or speculative else 1.0
+            for scope, shortfall in (
+                ("session", self._check(session_usage, self.session_limits, session_tickets, cost, 1.0, now)),
+                ("global", self._check(self._global, self.global_limits, self._tickets, cost, share, now)),
+            ):
+                if shortfall is None:
+                    continue
+                resource, available, retry_after = shortfall
+                BUDGET_ADMISSIONS.inc(command=command, decision="rejected_budget")
+                logger.warning("Rejecting %s command over the %s %s budget (needs %s, %s available)",
+                               command, scope, resource, cost[resource], available)
+                return None, {
+                    "error": f"Command would exceed the {scope} {resource} budget "
+                             f"(needs about {cost[resource]}, {available} left)",
+                    "budget": {"scope": scope, "resource": resource, "estimate": cost, "available": available,
+                               "retryAfterSeconds": round(retry_after) if retry_after is not None else None},
+                }
+
+            ticket = Ticket(self, session_id, command, cost, batch)
+            self._tickets.append(ticket)
+            if batch:
+                self.batch_in_flight += 1
+        BUDGET_ADMISSIONS.inc(command=command, decision="admitted")
+        return ticket, None
+
+    def release(self, ticket: Ticket):
+        """Return a finished command's unused reservation (and its batch slot)"""
+        with self._cond:
+            if ticket in self._tickets:
+                self._tickets.remove(ticket)
+                if ticket.batch:
+                    self.batch_in_flight -= 1
+                self._cond.notify_all()
+
+    def record(self, session_id: Optional[str], amounts: Dict[str, int], ticket: Optional[Ticket] = None):
+        """Charge usage to the global budget and the session's"""
+        now = time.time()
+        with self._cond:
+            session_usage = self._sessions.setdefault(session_id, _Usage()) if session_id else None
+            for resource, amount in amounts.items():
+                if not amount:
+                    continue
+                self._global.add(now, resource, amount)
+                if session_usage is not None:
+                    session_usage.add(now, resource, amount)
+                if ticket is not None:
+                    ticket.used[resource] += amount
+                BUDGET_USAGE.inc(amount, resource=resource)
+
+    def report(self, session_id: Optional[str] = None) -> Dict:
+        """Usage, limits and reservations for the window (and for a session, if given)"""
+        with self._cond:
+            self._prune(time.time())
+            report = {
+                "windowSeconds": self.window_seconds,
+                "global": {
+                    "used": {resource: self._global.totals[resource] for resource in RESOURCES},
+                    "reserved": {resource: sum(t.outstanding(resource) for t in self._tickets) for resource in RESOURCES},
+                    "limits": dict(self.global_limits),
+                },
+                "batchInFlight": self.batch_in_flight,
+            }
+            if session_id:
+                usage = self._sessions.get(session_id)
+                tickets = [t for t in self._tickets if t.session_id == session_id]
+                report["session"] = {
+                    "used": {resource: usage.totals[resource] if usage else 0 for resource in RESOURCES},
+                    "reserved": {resource: sum(t.outstanding(resource) for t in tickets) for resource in RESOURCES},
+                    "limits": dict(self.session_limits),
+                }
+        return report
+
+
+budget_ledger = BudgetLedger(BUDGET_WINDOW_SECONDS, parse_limits(GLOBAL_BUDGET), parse_limits(SESSION_BUDGET),
+                             INTERACTIVE_RESERVE, BATCH_MAX_IN_FLIGHT, BATCH_QUEUE_SECONDS)
+
+gauge("mash_budget_batch_in_flight", "Batch commands currently admitted", callback=lambda: budget_ledger.batch_in_flight)
+
+
+def record_usage(generations: int = 0, text_calls: int = 0, tokens: int = 0):
+    """Charge model usage to the command running in the current context"""
+    ticket = _current_ticket.get()
+    budget_ledger.record(ticket.session_id if ticket else None,
+                         {"generations": generations, "text_calls": text_calls, "tokens": tokens}, ticket)
+
+
+@contextmanager
+def charge_to(session_id: Optional[str]) -> Iterator[None]:
+    """
+    Charge model usage in this context to a session without admission
+    (e.g. jobs resumed after a restart); no-op inside an admitted command
+    """
+    if _current_ticket.get() is not None:
+        yield
+        return
+    token = _current_ticket.set(Ticket(budget_ledger, session_id, "unadmitted", {}, False))
+    try:
+        yield
+    finally:
+        _current_ticket.reset(token)
@@ -0,0 +1,31 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence
+
+from utils.tracing import bind_context
+
+# Maximum number of images a bulk command (tag:, describe:, edit:) processes at once
+BULK_COMMAND_CONCURRENCY = int(os.getenv("MASH_BULK_CONCURRENCY", "8"))
+
+
+def run_bulk(items: Sequence[Any], fn: Callable[[int, Any], Any], max_workers: Optional[int] = None) -> List[Any]:
+    """
+    Apply fn to every item with bounded concurrency
+
+    The model calls themselves are still rate limited by the Gemini
+    scheduler; this only bounds how many items are in progress at once.
+
+    Args:
+        items: Items to process
+        fn: Called as fn(index, item); should handle its own per-item errors
+        max_workers: Concurrency limit (defaults to BULK_COMMAND_CONCURRENCY, 1 runs serially)
+
+    Returns:
+        fn's results in the same order as items
+    """
+    max_workers = max_workers or BULK_COMMAND_CONCURRENCY
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(i, item) for i, item in enumerate(items)]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="mash-bulk") as executor:
+        return list(executor.map(bind_context(fn), range(len(items)), items))
@@ -0,0 +1,186 @@
+import json
+import os
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+import requests
+from dotenv import load_dotenv
+
+from .budget import record_usage
+from .gemini_scheduler import (
+    GeminiScheduler,
+    RateLimitedError,
+    RetryableError,
+    PRIORITY_INTERACTIVE,
+)
+from .singleflight import SingleFlight, fingerprint
+from utils.log import get_logger
+from utils.metrics import counter, gauge, histogram
+from utils.tracing import bind_context, span
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "120"))
+
+IMAGE_PART_TOKENS = 258  # Gemini bills each inline image as a fixed number of tokens
+
+scheduler = GeminiScheduler(
+    max_workers=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "5")),
+)
+
+# Identical requests in flight at the same time share one upstream call
+inflight_requests = SingleFlight()
+
+GEMINI_REQUEST_SECONDS = histogram("gemini_request_seconds", "Latency of Gemini generateContent calls", ["model", "status"])
+GEMINI_REQUESTS_INFLIGHT = gauge("gemini_requests_inflight", "Gemini HTTP requests currently in flight")
+gauge("gemini_queue_depth", "Gemini calls queued or backing off in the scheduler", callback=scheduler.queue_depth)
+counter("gemini_coalesced_requests_total", "Gemini calls served by an identical in-flight request",
+        callback=lambda: inflight_requests.coalesced)
+
+
+class GeminiRequestError(Exception):
+    """Raised when a Gemini request fails for good (non-retryable error or retries exhausted)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(parts: List[Dict]) -> int:
+    """Rough input token count for a request (about 4 characters per text token)"""
+    tokens = 0
+    for part in parts:
+        if "inlineData" in part:
+            tokens += IMAGE_PART_TOKENS
+        elif "text" in part:
+            tokens += len(part["text"]) // 4 + 1
+    return tokens
+
+
+def generates_images(generation_config: Optional[Dict]) -> bool:
+    """Whether a request asks the model for image output"""
+    config = generation_config or {}
+    modalities = config.get("response_modalities") or config.get("responseModalities") or []
+    return any(str(modality).upper() == "IMAGE" for modality in modalities)
+
+
+def request_fingerprint(model_name: str, parts: List[Dict], generation_config: Optional[Dict] = None) -> str:
+    """Fingerprint of a generateContent request (model, parts in order, generation config)"""
+    chunks = [model_name, json.dumps(generation_config or {}, sort_keys=True)]
+    for part in parts:
+        if "inlineData" in part:
+            chunks.append(part["inlineData"].get("mimeType", ""))
+            chunks.append(part["inlineData"].get("data", ""))
+        else:
+            chunks.append(part.get("text", ""))
+    return fingerprint(*chunks)
+
+
+def _post_generate_content(model_name: str, payload: Dict) -> Dict:
+    url = f"{GEMINI_API_BASE}/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
+    start = time.perf_counter()
+    GEMINI_REQUESTS_INFLIGHT.inc()
+    with span("gemini.http", model=model_name) as http_span:
+        try:
+            response = requests.post(url, headers={"Content-Type": "application/json"}, json=payload,
+                                     timeout=GEMINI_REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model_name, status="network_error")
+            raise RetryableError(f"Request to {model_name} failed: {e}")
+        finally:
+            GEMINI_REQUESTS_INFLIGHT.dec()
+        http_span.set_attribute("status", response.status_code)
+        http_span.set_attribute("bytesReceived", len(response.content))
+    GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model_name, status=str(response.status_code))
+
+    if response.status_code in (429, 503):
+        raise RateLimitedError(f"API error: {response.status_code}",
+                               retry_after=_parse_retry_after(response.headers.get("Retry-After")))
+    if response.status_code in (500, 502, 504):
+        raise RetryableError(f"API error: {response.status_code}")
+    if response.status_code != 200:
+        logger.error("Error details: %s", response.text)
+        raise GeminiRequestError(f"API error: {response.status_code}", status_code=response.status_code)
+
+    return response.json()
+
+
+def generate_content(model_name: str, parts: List[Dict], generation_config: Optional[Dict] = None,
+                     priority: int = PRIORITY_INTERACTIVE, group: Any = None, coalesce: bool = True) -> Dict:
+    """
+    Call Gemini generateContent through the shared rate-limited scheduler
+
+    Args:
+        model_name: Gemini model name
+        parts: Request parts (inlineData and text parts)
+        generation_config: Optional generationConfig for the request
+        priority: Scheduler priority class
+        group: Optional cancellation group (e.g. the session the call belongs to)
+        coalesce: Share one upstream call with identical requests already in flight
+
+    Returns:
+        The parsed JSON response
+
+    Raises:
+        GeminiRequestError: If the request failed or retries were exhausted
+        concurrent.futures.CancelledError: If the call was cancelled while queued
+    """
+    payload: Dict[str, Any] = {"contents": [{"parts": parts}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+
+    def send() -> Dict:
+        try:
+            result = scheduler.call(
+                model_name,
+                # Runs on a scheduler thread; keep HTTP attempts under this request's span
+                bind_context(lambda: _post_generate_content(model_name, payload)),
+                priority=priority,
+                tokens=estimate_tokens(parts),
+                group=group,
+            )
+        except (RateLimitedError, RetryableError) as e:
+            raise GeminiRequestError(str(e))
+        # Charged once per upstream call (coalesced callers share it); the model's own count when it reports one
+        image_output = generates_images(generation_config)
+        record_usage(generations=int(image_output), text_calls=int(not image_output),
+                     tokens=(result.get("usageMetadata") or {}).get("totalTokenCount") or estimate_tokens(parts))
+        return result
+
+    bytes_sent = sum(len(part["inlineData"].get("data", "")) if "inlineData" in part else len(part.get("text", ""))
+                     for part in parts)
+    with span("gemini.generateContent", model=model_name, parts=len(parts), bytesSent=bytes_sent,
+              priority=priority, coalesce=coalesce):
+        if not coalesce:
+            return send()
+        return inflight_requests.do(request_fingerprint(model_name, parts, generation_config), send)
+
+
+def response_text(result_json: Dict) -> str:
+    """Concatenate the text parts of the first candidate"""
+    for candidate in result_json.get("candidates") or []:
+        parts = candidate.get("content", {}).get("parts", [])
+        texts = [part["text"] for part in parts if "text" in part]
+        if texts:
+            return "".join(texts)
+    raise GeminiRequestError(f"No text in response: {result_json.get('promptFeedback', result_json)}")
@@ -0,0 +1,257 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+# Priority classes (lower runs first)
+PRIORITY_INTERACTIVE = 0  # User prompts and commands
+PRIORITY_BACKGROUND = 10  # Enrichment of freshly pasted images
+
+
+class RateLimitedError(Exception):
+    """Raised by a scheduled call when the upstream asks us to slow down (HTTP 429/503)"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RetryableError(Exception):
+    """Raised by a scheduled call for transient failures (timeouts, 5xx) worth retrying"""
+
+
+class TokenBucket:
+    """Refilling token bucket sized for a per-minute budget"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0  # Tokens per second
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)"""
+        self._refill(now)
+        # Requests larger than the bucket are allowed once it is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+class _ModelLimits:
+    def __init__(self, rpm: Optional[int], tpm: Optional[int]):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0  # Set from Retry-After so the whole model backs off
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        wait = max(0.0, self.blocked_until - now)
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def consume(self, tokens: int, now: float):
+        if self.requests:
+            self.requests.consume(1, now)
+        if self.tokens:
+            self.tokens.consume(tokens, now)
+
+
+class _Job:
+    def __init__(self, seq: int, model_name: str, fn: Callable[[], Any], priority: int, tokens: int, group: Any):
+        self.seq = seq
+        self.model_name = model_name
+        self.fn = fn
+        self.priority = priority
+        self.tokens = tokens
+        self.group = group
+        self.future: Future = Future()
+        self.attempt = 0
+        self.not_before = 0.0
+        self.started = False
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GeminiScheduler:
+    """
+    Central queue for model calls with per-model RPM/TPM token buckets,
+    Retry-After-aware exponential backoff and priority classes.
+
+    Calls are submitted as zero-argument callables; the callable should raise
+    RateLimitedError or RetryableError for failures that are worth retrying.
+    """
+
+    def __init__(self, max_workers: int = 8, max_retries: int = 5,
+                 base_backoff: float = 1.0, max_backoff: float = 60.0):
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._limits: Dict[str, _ModelLimits] = {}
+        self._queue: List[_Job] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini")
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="gemini-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def configure_model(self, model_name: str, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        """Set the requests-per-minute and tokens-per-minute budgets for a model"""
+        with self._cond:
+            self._limits[model_name] = _ModelLimits(rpm, tpm)
+            self._cond.notify_all()
+
+    def submit(self, model_name: str, fn: Callable[[], Any], priority: int = PRIORITY_INTERACTIVE,
+               tokens: int = 0, group: Any = None) -> Future:
+        """
+        Queue a model call
+
+        Args:
+            model_name: Model whose rate limits apply to the call
+            fn: Zero-argument callable performing the request
+            priority: PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND
+            tokens: Estimated tokens consumed by the call (for the TPM bucket)
+            group: Optional key (e.g. a session) used by cancel_group()
+
+        Returns:
+            Future resolving to the callable's return value
+        """
+        job = _Job(next(self._seq), model_name, fn, priority, tokens, group)
+        with self._cond:
+            heapq.heappush(self._queue, job)
+            self._cond.notify_all()
+        return job.future
+
+    def call(self, model_name: str, fn: Callable[[], Any], priority: int = PRIORITY_INTERACTIVE,
+             tokens: int = 0, group: Any = None) -> Any:
+        """Submit a call and block until it completes, re-raising its final error"""
+        return self.submit(model_name, fn, priority=priority, tokens=tokens, group=group).result()
+
+    def cancel_group(self, group: Any) -> int:
+        """Cancel every queued (or backing-off) call submitted with the given group"""
+        cancelled = 0
+        with self._cond:
+            remaining = []
+            for job in self._queue:
+                if job.group is not None and job.group == group:
+                    if job.started:
+                        job.future.set_exception(CancelledError())
+                    else:
+                        job.future.cancel()
+                    cancelled += 1
+                else:
+                    remaining.append(job)
+            heapq.heapify(remaining)
+            self._queue = remaining
+        if cancelled:
+            logger.info("Cancelled %s queued Gemini call(s)", cancelled)
+        return cancelled
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def _next_ready_job(self, now: float) -> tuple[Optional[_Job], float]:
+        """Pick the highest-priority job whose model has budget; otherwise how long to wait"""
+        wait = None
+        for job in sorted(self._queue):
+            if job.future.cancelled():
+                continue
+            limits = self._limits.get(job.model_name)
+            job_wait = max(job.not_before - now, limits.wait_time(job.tokens, now) if limits else 0.0)
+            if job_wait <= 0:
+                return job, 0.0
+            wait = job_wait if wait is None else min(wait, job_wait)
+        return None, wait if wait is not None else 1.0
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                # Drop cancelled jobs
+                if any(job.future.cancelled() for job in self._queue):
+                    self._queue = [job for job in self._queue if not job.future.cancelled()]
+                    heapq.heapify(self._queue)
+
+                if not self._queue or self._slots <= 0:
+                    self._cond.wait()
+                    continue
+
+                now = time.monotonic()
+                job, wait = self._next_ready_job(now)
+                if job is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+
+                self._queue.remove(job)
+                heapq.heapify(self._queue)
+                if not job.started and not job.future.set_running_or_notify_cancel():
+                    continue
+                job.started = True
+                limits = self._limits.get(job.model_name)
+                if limits:
+                    limits.consume(job.tokens, now)
+                self._slots -= 1
+
+            self._executor.submit(self._run, job)
+
+    def _run(self, job: _Job):
+        try:
+            result = job.fn()
+        except (RateLimitedError, RetryableError) as e:
+            self._retry_or_fail(job, e)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            with self._cond:
+                self._slots += 1
+                self._cond.notify_all()
+
+    def _retry_or_fail(self, job: _Job, error: Exception):
+        job.attempt += 1
+        if job.attempt > self.max_retries or job.future.done():
+            logger.error("Gemini call on %s failed after %s attempt(s): %s", job.model_name, job.attempt, error)
+            if not job.future.done():
+                job.future.set_exception(error)
+            return
+
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is None:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** (job.attempt - 1)))
+            delay += random.uniform(0, delay / 2)  # Jitter so retries do not stampede
+        else:
+            delay = retry_after
+        logger.warning("Gemini call on %s retrying in %.1fs (attempt %s): %s", job.model_name, delay, job.attempt, error)
+
+        with self._cond:
+            now = time.monotonic()
+            job.not_before = now + delay
+            limits = self._limits.get(job.model_name)
+            if limits and isinstance(error, RateLimitedError):
+                # A 429 applies to the model, not just this request
+                limits.blocked_until = max(limits.blocked_until, now + delay)
+            heapq.heappush(self._queue, job)
+            self._cond.notify_all()
@@ -0,0 +1,135 @@
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from .artifacts import artifact_sink
+from .generation_cache import generation_cache
+from .records import ImageRecord
+from .upload_utils import upload_image_to_soot
+from utils.log import get_logger, get_item_logger
+
+logger = get_logger(__name__)
+item_logger = get_item_logger(__name__)  # Per-image messages, sampled
+
+# Default generationConfig for the image model
+IMAGE_GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "topK": 32,
+    "topP": 1,
+    "response_modalities": ["TEXT", "IMAGE"],
+    "maxOutputTokens": 2048
+}
+
+
+# Add function to generate unique filenames
+def generate_unique_filename(prefix: str, extension: str = "png") -> str:
+    """Generate unique filename to avoid conflicts"""
+    timestamp = int(time.time())
+    unique_id = str(uuid.uuid4())[:8]
+    return f"{prefix}_{timestamp}_{unique_id}.{extension}"
+
+
+def build_operation_parts(image_record: ImageRecord, prompt: str, source_images: Dict = None) -> List[Dict]:
+    """
+    Build the request parts for an image operation: base image, mash sources, then the prompt
+
+    Args:
+        image_record: The base image record
+        prompt: Prompt for the operation
+        source_images: Optional dict of source images for mash operations
+
+    Returns:
+        List of generateContent parts
+    """
+    # Force MIME type to JPEG regardless of what it's detected as
+    # This avoids the "Unsupported MIME type" error
+    parts = [{
+        "inlineData": {
+            "mimeType": "image/jpeg",
+            "data": image_record.image_base64
+        }
+    }]
+
+    # Add source images for mash operations
+    if source_images:
+        for feature, source_image in source_images.items():
+            if feature != "base" and source_image.image is not None:
+                parts.append({
+                    "inlineData": {
+                        "mimeType": "image/jpeg",
+                        "data": source_image.image_base64
+                    }
+                })
+
+    # Add the text prompt at the end
+    parts.append({"text": prompt})
+    return parts
+
+
+def extract_generated_outputs(result_json: Dict) -> List[Dict]:
+    """
+    Collect the generated images and text from every candidate of a response
+
+    Returns:
+        One dict per candidate, with "imageBase64" and/or "description"
+    """
+    outputs = []
+    for candidate in result_json.get("candidates") or []:
+        output = {}
+        for part in candidate.get("content", {}).get("parts", []):
+            # Image data is Base64 encoded
+            if "inlineData" in part and "data" in part["inlineData"]:
+                output["imageBase64"] = part["inlineData"]["data"]
+            if "text" in part:
+                output["description"] = part["text"]
+        if output:
+            outputs.append(output)
+    return outputs
+
+
+def save_debug_response(result_json: Dict, image_record: ImageRecord):
+    """Dump the response for debugging (sampled, off by default, image data stripped)"""
+    debug_filename = generate_unique_filename(f"gemini_response_{image_record.instance_id[:6]}", "json")
+    artifact_sink.dump_debug(debug_filename, result_json)
+
+
+def save_generated_image(generated_image_base64: str, image_record: ImageRecord, prompt: str) -> str:
+    """
+    Queue a generated image for writing to the artifact directory with a unique name
+
+    Returns:
+        The local filename (written asynchronously)
+    """
+    # Generate unique filename
+    original_id = image_record.instance_id[:6]
+    safe_prompt = "".join(c for c in prompt[:20] if c.isalnum() or c.isspace()).replace(" ", "_")
+    filename = artifact_sink.write_image(generate_unique_filename(f"generated_{original_id}_{safe_prompt}"), generated_image_base64)
+    item_logger.debug("Saving generated image to %s", filename)
+    return filename
+
+
+def upload_generated_image(generated_image_base64: str, image_record: ImageRecord) -> Optional[Dict]:
+    """
+    Upload a generated image to the SOOT space of the image it was derived from
+
+    Returns:
+        The upload result, or None if the record has no spaceId
+    """
+    space_id = image_record.space_id
+    if not space_id:
+        return None
+
+    item_logger.info("Uploading generated image to SOOT space: %s", space_id)
+    # Skipped if the same image (e.g. a cached generation) was already uploaded there
+    upload_result = generation_cache.upload_once(generated_image_base64, space_id, lambda: upload_image_to_soot(
+        image_data=generated_image_base64,
+        space_id=space_id,
+        is_base64=True,
+        verbose=True
+    ))
+
+    if upload_result["success"]:
+        item_logger.info("Generated image successfully uploaded to SOOT")
+    else:
+        logger.error("Failed to upload generated image: %s", upload_result['message'])
+    return upload_result
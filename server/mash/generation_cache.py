@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .image_store import image_digest
+from .records import ImageRecord
+from utils.log import get_logger
+from utils.metrics import counter, gauge
+
+logger = get_logger(__name__)
+
+# Opt-in: identical image-model requests return the earlier result instead of calling the model
+GENERATION_CACHE_ENABLED = os.getenv("MASH_GENERATION_CACHE", "0") in ("1", "true", "True")
+GENERATION_CACHE_MAX_BYTES = int(os.getenv("MASH_GENERATION_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+# Per command: "reuse" serves cached results, "fresh" always generates (and refreshes the cache)
+GENERATION_CACHE_POLICY = os.getenv("MASH_GENERATION_CACHE_POLICY", "mash=reuse,edit=reuse,prompt=reuse")
+UPLOAD_MEMO_MAX_ENTRIES = 4096
+
+GENERATION_CACHE_LOOKUPS = counter("mash_generation_cache_total", "Generation cache lookups by result (hit, miss, fresh)", ["result"])
+GENERATION_UPLOADS_REUSED = counter("mash_generation_uploads_reused_total", "Uploads skipped because the same image was already uploaded to the space")
+
+
+def parse_policy(spec: str) -> Dict[str, str]:
+    """Parse "command=reuse|fresh,..." into a dict (commands not listed are fresh)"""
+    policy = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        command, _, mode = item.partition("=")
+        mode = mode.strip() or "reuse"
+        if mode not in ("reuse", "fresh"):
+            raise ValueError(f"Unknown generation cache policy for {command}: {mode}")
+        policy[command.strip()] = mode
+    return policy
+
+
+def _outputs_size(outputs: List[Dict]) -> int:
+    return sum(len(output.get("imageBase64") or "") + len(output.get("description") or "") for output in outputs)
+
+
+class GenerationCache:
+    """
+    Results of image-model requests keyed by their inputs, evicted least
+    recently used first once they exceed a byte budget.
+
+    Also remembers which generated images were already uploaded to which
+    space, so a reused result is never uploaded twice.
+    """
+
+    def __init__(self, max_bytes: int, policy: Dict[str, str], enabled: bool = True):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.enabled = enabled
+        self.byte_size = 0
+        self._entries: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._uploads: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, image_record: ImageRecord, source_images: Optional[Dict[str, ImageRecord]],
+            prompt: str, generation_config: Dict) -> Optional[str]:
+        """
+        Cache key of a request: image content hashes, prompt, model and config
+
+        Returns:
+            The key, or None if an input image is missing
+        """
+        if image_record.image is None:
+            return None
+        sources = []
+        for feature, source in sorted((source_images or {}).items()):
+            if source.image is None:
+                return None
+            sources.append([feature, source.image.digest])
+        material = json.dumps([model, image_record.image.digest, sources, prompt, generation_config], sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def reuses(self, command: str) -> bool:
+        return self.enabled and self.policy.get(command) == "reuse"
+
+    def get(self, key: str, command: str) -> Optional[List[Dict]]:
+        """
+        Cached outputs of a request, if the command's policy allows reusing them
+
+        Args:
+            key: Key from GenerationCache.key()
+            command: Command type (mash, edit, prompt, ...)
+        """
+        if not self.reuses(command):
+            GENERATION_CACHE_LOOKUPS.inc(result="fresh")
+            return None
+        with self._lock:
+            outputs = self._entries.get(key)
+            if outputs is not None:
+                self._entries.move_to_end(key)
+        GENERATION_CACHE_LOOKUPS.inc(result="hit" if outputs is not None else "miss")
+        return outputs
+
+    def put(self, key: str, outputs: List[Dict]):
+        """Store the generated outputs of a request (responses without an image are not cached)"""
+        if not self.enabled or not any("imageBase64" in output for output in outputs):
+            return
+        size = _outputs_size(outputs)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.byte_size -= _outputs_size(previous)
+            self._entries[key] = outputs
+            self.byte_size += size
+            while self.byte_size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.byte_size -= _outputs_size(evicted)
+
+    def upload_once(self, image_base64: str, space_id: str, upload: Callable[[], Dict]) -> Dict:
+        """
+        Upload a generated image unless the same image already went to the space
+
+        Args:
+            image_base64: The generated image
+            space_id: Destination SOOT space
+            upload: Performs the upload and returns its result
+
+        Returns:
+            The upload result (the earlier one if the upload was skipped)
+        """
+        if not self.enabled:
+            return upload()
+        memo_key = (image_digest(image_base64), space_id)
+        with self._lock:
+            previous = self._uploads.get(memo_key)
+        if previous is not None:
+            GENERATION_UPLOADS_REUSED.inc()
+            logger.info("Image already uploaded to space %s, reusing the upload", space_id)
+            return previous
+
+        result = upload()
+        if result.get("success"):
+            with self._lock:
+                self._uploads[memo_key] = result
+                while len(self._uploads) > UPLOAD_MEMO_MAX_ENTRIES:
+                    self._uploads.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._uploads.clear()
+            self.byte_size = 0
+
+
+generation_cache = GenerationCache(GENERATION_CACHE_MAX_BYTES, parse_policy(GENERATION_CACHE_POLICY), GENERATION_CACHE_ENABLED)
+
+gauge("mash_generation_cache_bytes", "Bytes of generated images held by the generation cache",
+      callback=lambda: generation_cache.byte_size)
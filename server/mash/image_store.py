@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import weakref
+from typing import Dict, Optional
+
+
+class ImageRef:
+    """
+    A base64 image held once in memory and shared by every record that
+    refers to it, identified by the SHA-256 of its base64 text
+    """
+
+    __slots__ = ("digest", "base64", "__weakref__")
+
+    def __init__(self, digest: str, base64: str):
+        self.digest = digest
+        self.base64 = base64
+
+    @property
+    def size(self) -> int:
+        return len(self.base64)
+
+    def __repr__(self) -> str:
+        return f"ImageRef({self.digest[:12]}, {self.size} chars)"
+
+
+def image_digest(image_base64: str) -> str:
+    return hashlib.sha256(image_base64.encode("ascii")).hexdigest()
+
+
+class ImageStore:
+    """
+    Content-addressed in-memory image store.
+
+    Entries are weakly referenced: an image stays in memory while any record
+    refers to it and is dropped once the last record is gone, so identical
+    images pasted into several sessions are kept only once.
+    """
+
+    def __init__(self):
+        self._images: "weakref.WeakValueDictionary[str, ImageRef]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def put(self, image_base64: str, digest: Optional[str] = None) -> ImageRef:
+        """Return the shared reference for an image, adding it if it is new"""
+        digest = digest or image_digest(image_base64)
+        with self._lock:
+            ref = self._images.get(digest)
+            if ref is None:
+                ref = ImageRef(digest, image_base64)
+                self._images[digest] = ref
+            return ref
+
+    def get(self, digest: str) -> Optional[ImageRef]:
+        with self._lock:
+            return self._images.get(digest)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            refs = list(self._images.values())
+        return {"images": len(refs), "bytes": sum(ref.size for ref in refs)}
+
+
+image_store = ImageStore()
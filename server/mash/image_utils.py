@@ -2,11 +2,14 @@ import requests
 import os
 from dotenv import load_dotenv
 import base64
+from utils.log import get_logger
 
 load_dotenv()
 
 SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
 
+logger = get_logger(__name__)
+
 def fetch_image_as_base64(url: str) -> str | None:
     try:
         res = requests.get(url, headers={
@@ -17,5 +20,5 @@ def fetch_image_as_base64(url: str) -> str | None:
         encoded = base64.b64encode(res.content).decode("utf-8")
         return encoded
     except Exception as e:
-        print(f"[SOOT] ❌ Fetch failed for {url}: {e}")
+        logger.error("Fetch failed for %s: %s", url, e)
         return None
@@ -0,0 +1,499 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .budget import charge_to
+from .bulk import run_bulk
+from .records import ImageRecord
+from soot.upload_tracker import FINAL_STATES, UploadListener, upload_tracker
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+# Job state lives here so batch commands survive a restart
+JOB_DIR = os.getenv("MASH_JOB_DIR", os.path.join("cache", "jobs"))
+JOB_RETENTION_SECONDS = int(os.getenv("MASH_JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Seconds between sweeps for finished jobs past retention and image files no job refers to
+JOB_PRUNE_INTERVAL_SECONDS = float(os.getenv("MASH_JOB_PRUNE_INTERVAL_SECONDS", "600"))
+# Unreferenced image files younger than this are kept, as a job being created may not refer to them yet
+JOB_BLOB_GRACE_SECONDS = 3600
+# Resume jobs interrupted by a restart when the server starts
+JOB_RESUME_ON_START = os.getenv("MASH_JOB_RESUME", "1") not in ("0", "false", "False")
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+RUNNING, COMPLETED, COMPLETED_WITH_ERRORS = "running", "completed", "completed_with_errors"
+
+# Runs one item: (job, item input, previous partial result) -> (result, error or None)
+ItemRunner = Callable[["Job", Dict, Any], Tuple[Any, Optional[str]]]
+
+
+class Job:
+    """
+    A batch command split into items, each pending, done (with its result)
+    or failed (with the reason and any partial result).
+
+    The input images are stored with the job, so it can run to completion
+    even after the session that started it is gone.
+    """
+
+    def __init__(self, job_id: str, kind: str, session_id: Optional[str], params: Dict,
+                 images: Dict[str, Dict], items: "OrderedDict[str, Dict]", status: str = RUNNING,
+                 created_at: Optional[float] = None, updated_at: Optional[float] = None,
+                 uploads: Optional[Dict[str, Dict]] = None):
+        self.job_id = job_id
+        self.kind = kind
+        self.session_id = session_id
+        self.params = params
+        self.images = images  # instanceId -> encoded record (image data in separate files)
+        self.items = items  # itemId -> {"input", "status", "result", "error", "attempts"}
+        self.uploads = uploads or {}  # SOOT upload intentId -> latest upload status
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        self.lock = threading.Lock()
+        # Notified (with lock held) whenever the job is saved, for progress streams
+        self.changed = threading.Condition(self.lock)
+        self.version = 0
+
+    def image(self, instance_id: str) -> Optional[ImageRecord]:
+        data = self.images.get(instance_id)
+        return ImageRecord.from_dict(_materialize(data)) if data else None
+
+    def counts(self) -> Dict[str, int]:
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        for item in self.items.values():
+            counts[item["status"]] += 1
+        return counts
+
+    def upload_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for upload in self.uploads.values():
+            counts[upload["state"]] = counts.get(upload["state"], 0) + 1
+        return counts
+
+    def uploads_pending(self) -> bool:
+        return any(upload["state"] not in FINAL_STATES for upload in self.uploads.values())
+
+    def wait_for_change(self, version: int, timeout: float) -> int:
+        """Block until the job changes from `version` (or timeout), returning the current version"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def summary(self) -> Dict:
+        return {
+            "jobId": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "params": self.params,
+            "items": self.counts(),
+            "uploads": self.upload_counts(),
+            "createdAt": self.created_at,
+            "updatedAt": self.updated_at,
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            "jobId": self.job_id,
+            "kind": self.kind,
+            "sessionId": self.session_id,
+            "params": self.params,
+            "images": self.images,
+            "items": list(self.items.items()),
+            "uploads": self.uploads,
+            "status": self.status,
+            "createdAt": self.created_at,
+            "updatedAt": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Job":
+        return cls(data["jobId"], data["kind"], data.get("sessionId"), data.get("params") or {},
+                   data.get("images") or {}, OrderedDict((k, v) for k, v in data["items"]),
+                   data.get("status", RUNNING), data.get("createdAt"), data.get("updatedAt"), data.get("uploads"))
+
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(JOB_DIR, "blobs", f"{digest}.b64")
+
+
+def _externalize(value: Any) -> Any:
+    """Copy of a result with every imageBase64 moved to a content-addressed file"""
+    if isinstance(value, list):
+        return [_externalize(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    data = {}
+    for key, v in value.items():
+        if key == "imageBase64" and isinstance(v, str):
+            digest = hashlib.sha256(v.encode("ascii")).hexdigest()
+            path = _blob_path(digest)
+            try:
+                os.utime(path)  # Reused: keep it out of the next sweep
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "w") as f:
+                    f.write(v)
+                os.replace(path + ".tmp", path)
+            data["imageBase64_ref"] = digest
+        else:
+            data[key] = _externalize(v)
+    return data
+
+
+def _references(value: Any) -> Iterator[str]:
+    """Digests of the image files an externalized value refers to"""
+    if isinstance(value, list):
+        for v in value:
+            yield from _references(v)
+    elif isinstance(value, dict):
+        for key, v in value.items():
+            if key == "imageBase64_ref":
+                yield v
+            else:
+                yield from _references(v)
+
+
+def _materialize(value: Any) -> Any:
+    """Inverse of _externalize (references to missing files are dropped)"""
+    if isinstance(value, list):
+        return [_materialize(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    data = {}
+    for key, v in value.items():
+        if key == "imageBase64_ref":
+            try:
+                with open(_blob_path(v)) as f:
+                    data["imageBase64"] = f.read()
+            except OSError as e:
+                logger.warning("Missing job blob %s: %s", v[:12], e)
+        else:
+            data[key] = _materialize(v)
+    return data
+
+
+class JobStore:
+    """
+    Jobs by ID, each persisted to its own JSON file. Item outcomes and upload
+    statuses are appended to the job's journal (one JSON line each) rather
+    than rewriting the whole file, which is only rewritten, and the journal
+    dropped, when the job is created, retried or finished.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._last_pruned = time.monotonic()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _journal_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.jsonl")
+
+    def _touch(self, job: Job):
+        job.updated_at = time.time()
+        job.version += 1
+        job.changed.notify_all()
+
+    def _save(self, job: Job):
+        """Write the whole job (job.lock held), folding in its journal"""
+        self._touch(job)
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(job.job_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(path + ".tmp", path)  # Never leave a half-written job behind
+        try:
+            os.remove(self._journal_path(job.job_id))
+        except FileNotFoundError:
+            pass
+
+    def _append(self, job: Job, entry: Dict):
+        """Append one change to the job's journal (job.lock held)"""
+        self._touch(job)
+        entry["at"] = job.updated_at
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._journal_path(job.job_id), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _replay(self, job: Job):
+        """Apply the journal written since the job file was last saved"""
+        try:
+            with open(self._journal_path(job.job_id)) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash
+            if "item" in entry and entry["item"] in job.items:
+                job.items[entry["item"]].update({key: entry[key] for key in ("status", "result", "error", "attempts")})
+            elif "upload" in entry:
+                job.uploads[entry["upload"]] = entry["status"]
+            job.updated_at = max(job.updated_at, entry.get("at") or 0)
+
+    def create(self, kind: str, session_id: Optional[str], params: Dict, images: List[ImageRecord],
+               inputs: List[Tuple[str, Dict]]) -> Job:
+        """
+        Start a job and persist it before any item runs
+
+        Args:
+            kind: Runner name (e.g. "mash_all", "variation")
+            session_id: Session that started the job
+            params: Command parameters, returned with the results
+            images: Input images the items refer to by instanceId
+            inputs: (itemId, item input) pairs in result order
+        """
+        job = Job(
+            job_id=str(uuid.uuid4()),
+            kind=kind,
+            session_id=session_id,
+            params=params,
+            images={image.instance_id: _externalize(image.to_dict()) for image in images},
+            items=OrderedDict((item_id, {"input": data, "status": PENDING, "result": None, "error": None, "attempts": 0})
+                              for item_id, data in inputs),
+        )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            prune = time.monotonic() - self._last_pruned >= JOB_PRUNE_INTERVAL_SECONDS
+        with job.lock:
+            self._save(job)
+        if prune:
+            self.prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self, session_id: str) -> List[Job]:
+        """A session's jobs, newest first"""
+        return [job for job in self.all() if job.session_id == session_id]
+
+    def all(self) -> List[Job]:
+        """Every session's jobs, newest first"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def record(self, job: Job, item_id: str, result: Any, error: Optional[str]):
+        """Store an item's outcome (the result is kept for failed items too, e.g. partial variations)"""
+        result = _externalize(result)
+        with job.lock:
+            item = job.items[item_id]
+            item["status"] = FAILED if error else DONE
+            item["result"] = result
+            item["error"] = error
+            item["attempts"] += 1
+            self._append(job, {"item": item_id, **{key: item[key] for key in ("status", "result", "error", "attempts")}})
+
+    def reset_failed(self, job: Job) -> int:
+        """Mark failed items pending again, returning how many"""
+        with job.lock:
+            failed = [item for item in job.items.values() if item["status"] == FAILED]
+            for item in failed:
+                item["status"] = PENDING
+            if failed:
+                job.status = RUNNING
+                self._save(job)
+        return len(failed)
+
+    def record_upload(self, job: Job, status: Dict):
+        """Store the latest status of an upload one of the job's items made"""
+        with job.lock:
+            job.uploads[status["intentId"]] = {key: status.get(key) for key in
+                                               ("spaceId", "state", "percentUploaded", "filesUploaded", "updatedAt")}
+            self._append(job, {"upload": status["intentId"], "status": job.uploads[status["intentId"]]})
+
+    def finish(self, job: Job):
+        with job.lock:
+            counts = job.counts()
+            if counts[PENDING]:
+                return
+            job.status = COMPLETED_WITH_ERRORS if counts[FAILED] else COMPLETED
+            self._save(job)
+
+    def results(self, job: Job) -> List[Tuple[str, Dict]]:
+        """(itemId, item with its result loaded) for every item, in order"""
+        with job.lock:
+            items = [(item_id, dict(item)) for item_id, item in job.items.items()]
+        for _, item in items:
+            item["result"] = _materialize(item["result"])
+        return items
+
+    def load(self) -> int:
+        """Load persisted jobs, dropping those older than JOB_RETENTION_SECONDS and their image files"""
+        if not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        loaded = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Skipping unreadable job file %s: %s", name, e)
+                continue
+            self._replay(job)
+            if job.updated_at < cutoff:
+                self._remove_files(job.job_id)
+                continue
+            with self._lock:
+                self._jobs[job.job_id] = job
+            loaded += 1
+        self.prune()
+        return loaded
+
+    def _remove_files(self, job_id: str):
+        for path in (self._path(job_id), self._journal_path(job_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def prune(self) -> int:
+        """
+        Drop finished jobs not updated for JOB_RETENTION_SECONDS, then the
+        image files no remaining job refers to
+
+        Returns:
+            Number of jobs dropped
+        """
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._lock:
+            self._last_pruned = time.monotonic()
+            expired = [job for job in self._jobs.values()
+                       if job.status != RUNNING and job.updated_at < cutoff and not job.uploads_pending()]
+            for job in expired:
+                del self._jobs[job.job_id]
+            jobs = list(self._jobs.values())
+        for job in expired:
+            self._remove_files(job.job_id)
+        if expired:
+            logger.info("Dropped %s job(s) past retention", len(expired))
+
+        referenced = set()
+        for job in jobs:
+            with job.lock:
+                referenced.update(_references(job.images))
+                for item in job.items.values():
+                    referenced.update(_references(item["result"]))
+        blob_dir = os.path.join(JOB_DIR, "blobs")
+        if not os.path.isdir(blob_dir):
+            return len(expired)
+        grace_cutoff = time.time() - JOB_BLOB_GRACE_SECONDS
+        for name in os.listdir(blob_dir):
+            if not name.endswith(".b64") or name[:-len(".b64")] in referenced:
+                continue
+            path = os.path.join(blob_dir, name)
+            try:
+                if os.path.getmtime(path) < grace_cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(expired)
+
+
+job_store = JobStore(JOB_DIR)
+_runners: Dict[str, ItemRunner] = {}
+# The job whose items are running, so uploads they make are reported on it
+_current_job: contextvars.ContextVar[Optional[Job]] = contextvars.ContextVar("mash_current_job", default=None)
+
+
+def register_runner(kind: str, runner: ItemRunner):
+    _runners[kind] = runner
+
+
+def run_job(job: Job, run_items: Optional[Callable[[List[Any], Callable[[int, Any], Any]], Any]] = None):
+    """
+    Run every pending item of a job, persisting each outcome as it lands
+
+    Args:
+        job: The job
+        run_items: Optional executor called as run_items(items, fn) (e.g. run_bulk);
+            items run one after another by default
+    """
+    runner = _runners[job.kind]
+    with job.lock:
+        pending = [(item_id, item["input"], item["result"]) for item_id, item in job.items.items() if item["status"] == PENDING]
+
+    def run_one(_, entry):
+        item_id, data, previous = entry
+        try:
+            result, error = runner(job, data, _materialize(previous))
+        except Exception as e:
+            logger.exception("Job %s item %s failed: %s", job.job_id[:8], item_id, e)
+            result, error = previous, str(e)
+        job_store.record(job, item_id, result, error)
+
+    # Jobs resumed after a restart run outside any admitted command; their usage still counts for the session
+    token = _current_job.set(job)
+    try:
+        with charge_to(job.session_id):
+            if run_items is None:
+                for index, entry in enumerate(pending):
+                    run_one(index, entry)
+            else:
+                run_items(pending, run_one)
+    finally:
+        _current_job.reset(token)
+    job_store.finish(job)
+    logger.info("Job %s %s: %s", job.job_id[:8], job.status, job.counts())
+
+
+def upload_listener() -> Optional[UploadListener]:
+    """Reports upload progress on the job whose item is running (None outside a job)"""
+    job = _current_job.get()
+    if job is None:
+        return None
+    return lambda status: job_store.record_upload(job, status)
+
+
+async def stream_job_events(job: Job, wait_seconds: float = 15) -> AsyncIterator[str]:
+    """
+    The job's summary as newline-delimited JSON, now and after every change
+    (items finishing, uploads progressing), until the job and its uploads are done
+    """
+    version = None
+    while True:
+        with job.lock:
+            changed, version = job.version != version, job.version
+            summary = job.summary()
+            done = job.status != RUNNING and not job.uploads_pending()
+        if changed:
+            yield json.dumps(summary) + "\n"
+        if done:
+            return
+        await asyncio.to_thread(job.wait_for_change, version, wait_seconds)
+
+
+def resume_interrupted_jobs():
+    """Load persisted jobs, finish those a restart interrupted and follow their unfinished uploads again"""
+    loaded = job_store.load()
+    for job in job_store.all():
+        for intent_id, upload in list(job.uploads.items()):
+            if upload["state"] not in FINAL_STATES:
+                upload_tracker.track(intent_id, upload["spaceId"], lambda status, job=job: job_store.record_upload(job, status))
+    interrupted = [job for job in job_store.all() if job.status == RUNNING]
+    logger.info("Loaded %s job(s), %s to resume", loaded, len(interrupted))
+    for job in interrupted:
+        if job.kind not in _runners:
+            logger.warning("No runner for job %s of kind %s", job.job_id[:8], job.kind)
+            continue
+        # Same concurrency as when the job was started
+        run_job(job, run_items=run_bulk if job.kind == "variation" else None)
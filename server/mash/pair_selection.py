@@ -0,0 +1,107 @@
+import math
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+from .records import ImageRecord
+from .tag_index import tokenize
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Terms that mark an image as a strong style source
+STYLE_TERMS = frozenset("""
+abstract analog bokeh cartoon cinematic collage comic contrast cyberpunk dramatic duotone film grain grainy
+illustration impressionist ink monochrome muted neon noir oil painterly painting pastel pencil pixel pop
+retro saturated sepia sketch surreal textured vaporwave vibrant vintage watercolor
+""".split())
+STYLE_WEIGHT = 0.5  # Weight of the style image's style strength against content distance
+
+
+def _term_counts(record: ImageRecord) -> Counter:
+    terms = Counter(tokenize(record.description))
+    for tag in record.tags:
+        terms.update(tokenize(tag))
+    return terms
+
+
+def _tfidf_vectors(records: Sequence[ImageRecord]) -> Tuple[List[Dict[str, float]], List[float]]:
+    """Unit-length TF-IDF vectors of the records' terms, and each record's style strength"""
+    counts = [_term_counts(record) for record in records]
+    document_frequency = Counter(term for terms in counts for term in terms)
+    vectors, style_strength = [], []
+    for terms in counts:
+        vector = {term: count * math.log(1 + len(records) / document_frequency[term]) for term, count in terms.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        vectors.append({term: value / norm for term, value in vector.items()})
+        total = sum(terms.values())
+        style_strength.append(sum(count for term, count in terms.items() if term in STYLE_TERMS) / total if total else 0.0)
+    return vectors, style_strength
+
+
+def similarity_matrix(records: Sequence[ImageRecord]) -> Tuple[List[List[float]], List[float]]:
+    """
+    Cosine similarity of every pair of records over their tags and descriptions
+
+    Returns:
+        (similarities as an n x n nested list, style strength of each record)
+    """
+    vectors, style_strength = _tfidf_vectors(records)
+    if np is not None:
+        vocabulary = {term: k for k, term in enumerate(sorted({term for vector in vectors for term in vector}))}
+        matrix = np.zeros((len(vectors), max(len(vocabulary), 1)), dtype=np.float32)
+        for row, vector in enumerate(vectors):
+            for term, value in vector.items():
+                matrix[row, vocabulary[term]] = value
+        return (matrix @ matrix.T).tolist(), style_strength
+    return [[sum(value * b.get(term, 0.0) for term, value in a.items()) for b in vectors] for a in vectors], style_strength
+
+
+def select_pairs(records: Sequence[ImageRecord], budget: int) -> List[Tuple[int, int]]:
+    """
+    Choose the most complementary (style, content) pairs within a budget
+
+    Pairs are scored by how different the two images are plus how strongly
+    the style image carries a style, then picked greedily so that every
+    image is used about equally often as style and as content.
+
+    Args:
+        records: Candidate images
+        budget: Maximum number of pairs
+
+    Returns:
+        (style position, content position) pairs into records, best first
+    """
+    n = len(records)
+    if n < 2 or budget <= 0:
+        return []
+    similarities, style_strength = similarity_matrix(records)
+    scored = sorted(
+        ((1.0 - similarities[i][j] + STYLE_WEIGHT * style_strength[i], i, j) for i in range(n) for j in range(n) if i != j),
+        reverse=True,
+    )
+    budget = min(budget, n * n - n)
+    max_uses = max(1, math.ceil(budget / n))
+
+    selected: List[Tuple[int, int]] = []
+    chosen = set()
+    as_style, as_content = Counter(), Counter()
+    # First pass spreads the budget across images and skips mirrored pairs; the second fills what is left
+    for balanced in (True, False):
+        for _, i, j in scored:
+            if len(selected) >= budget:
+                break
+            if (i, j) in chosen:
+                continue
+            if balanced and ((j, i) in chosen or as_style[i] >= max_uses or as_content[j] >= max_uses):
+                continue
+            selected.append((i, j))
+            chosen.add((i, j))
+            as_style[i] += 1
+            as_content[j] += 1
+    logger.debug("Selected %s of %s pairs", len(selected), n * n - n)
+    return selected
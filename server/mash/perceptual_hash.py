@@ -0,0 +1,145 @@
+import base64
+import io
+import os
+import threading
+from typing import List, Optional, Tuple
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+# NumPy and Pillow are in requirements.txt; without them no hashes are
+# computed and every image is enriched on its own
+try:
+    import numpy as np
+    from PIL import Image
+    HASHING_AVAILABLE = True
+except ImportError:
+    np = None
+    Image = None
+    HASHING_AVAILABLE = False
+    logger.warning("numpy/Pillow not installed: near-duplicate detection is OFF and every image is enriched")
+
+HASH_SIZE = 8  # 8x8 difference hash = 64 bits
+# Hashes at most this many bits apart are treated as the same picture
+DUPLICATE_MAX_DISTANCE = int(os.getenv("MASH_DUPLICATE_MAX_DISTANCE", "6"))
+# Thumbnails with less grey-level range than this (flat or solid-colour images) are not hashed:
+# their bits are noise or all zero, so unrelated images would match
+MIN_CONTRAST = int(os.getenv("MASH_DUPLICATE_MIN_CONTRAST", "16"))
+# Hashes with fewer set (or unset) bits than this carry too little of the picture to match on
+MIN_HASH_BITS = 8
+# Near-duplicates reused across sessions must have the same aspect ratio within this tolerance
+ASPECT_TOLERANCE = 0.02
+# Enough base64 to decode an image header (JPEG EXIF blocks can be up to 64 KB)
+_HEADER_BASE64_CHARS = 4 * 32 * 1024
+
+
+def dhash(image_bytes: bytes) -> Optional[int]:
+    """
+    Difference hash of an image: one bit per horizontally adjacent pixel pair
+    of a (HASH_SIZE+1) x HASH_SIZE greyscale thumbnail
+
+    Stable across resizing, re-compression and format changes.
+
+    Returns:
+        The 64-bit hash, or None if hashing is unavailable, the image cannot be
+        decoded or it has too little detail to tell it apart from others
+    """
+    if not HASHING_AVAILABLE:
+        return None
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))  # JPEGs decode at reduced size
+        pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    except Exception as e:
+        logger.warning("Could not hash image: %s", e)
+        return None
+    if int(pixels.max()) - int(pixels.min()) < MIN_CONTRAST:
+        return None
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    set_bits = int(bits.sum())
+    if min(set_bits, bits.size - set_bits) < MIN_HASH_BITS:
+        return None
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def image_dimensions(image_base64: str) -> Optional[Tuple[int, int]]:
+    """(width, height) of a base64 image, read from its header only (None if unknown)"""
+    if not HASHING_AVAILABLE:
+        return None
+    try:
+        head = image_base64[:_HEADER_BASE64_CHARS]
+        return Image.open(io.BytesIO(base64.b64decode(head[:len(head) - len(head) % 4]))).size
+    except Exception:
+        return None
+
+
+def same_shape(first_base64: str, second_base64: str) -> bool:
+    """Whether two images have the same aspect ratio (resized copies do; crops and unrelated images rarely)"""
+    first, second = image_dimensions(first_base64), image_dimensions(second_base64)
+    if not first or not second or not first[1] or not second[1]:
+        return False
+    first_ratio, second_ratio = first[0] / first[1], second[0] / second[1]
+    return abs(first_ratio - second_ratio) <= ASPECT_TOLERANCE * max(first_ratio, second_ratio)
+
+
+def format_hash(value: int) -> str:
+    return f"{value:016x}"
+
+
+def parse_hash(text: Optional[str]) -> Optional[int]:
+    return int(text, 16) if text else None
+
+
+class HashIndex:
+    """
+    Perceptual hashes of images, searched by Hamming distance.
+
+    The hashes are kept in a NumPy array so a lookup compares against every
+    indexed image in one vectorised pass.
+    """
+
+    def __init__(self):
+        self._ids: List[str] = []
+        self._hashes: List[int] = []
+        self._positions = {}  # instanceId -> position in _ids
+        self._array = None  # uint64 view of _hashes, rebuilt after changes
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, instance_id: str, value: int):
+        with self._lock:
+            position = self._positions.get(instance_id)
+            if position is None:
+                self._positions[instance_id] = len(self._ids)
+                self._ids.append(instance_id)
+                self._hashes.append(value)
+            else:
+                self._hashes[position] = value
+            self._array = None
+
+    def nearest(self, value: int, max_distance: int = DUPLICATE_MAX_DISTANCE) -> Optional[Tuple[str, int]]:
+        """
+        Find the indexed image closest to a hash
+
+        Returns:
+            (instanceId, distance) of the closest image within max_distance, or None
+        """
+        if not HASHING_AVAILABLE:
+            return None
+        with self._lock:
+            if not self._ids:
+                return None
+            if self._array is None:
+                self._array = np.array(self._hashes, dtype=np.uint64)
+            array, ids = self._array, self._ids
+            distances = np.unpackbits((array ^ np.uint64(value)).view(np.uint8)).reshape(len(array), 64).sum(axis=1)
+            position = int(distances.argmin())
+            distance = int(distances[position])
+            return (ids[position], distance) if distance <= max_distance else None
+
+
+# Hashes of every enriched image in the persistent cache
+hash_index = HashIndex()
@@ -0,0 +1,206 @@
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+from dotenv import load_dotenv
+
+from .budget import budget_ledger, estimate
+from .image_store import ImageRef, image_store
+from .perceptual_hash import dhash
+from .records import ImageRecord
+from utils.log import get_logger
+from utils.metrics import counter, gauge, histogram
+from utils.tracing import bind_context
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+BEARER_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
+MASH_PREFETCH_ENABLED = os.getenv("MASH_PREFETCH", "1") not in ("0", "false", "False")
+# Snapshot downloads running at once
+MASH_PREFETCH_CONCURRENCY = int(os.getenv("MASH_PREFETCH_CONCURRENCY", "4"))
+# Base64 bytes of prefetched images held for pastes that have not arrived yet (least recently used go first)
+MASH_PREFETCH_MAX_BYTES = int(os.getenv("MASH_PREFETCH_MAX_BYTES", str(256 * 1024 * 1024)))
+# Snapshots prefetched per listing, and how long an unused prefetched image is kept
+MASH_PREFETCH_MAX_ITEMS = int(os.getenv("MASH_PREFETCH_MAX_ITEMS", "200"))
+MASH_PREFETCH_TTL_SECONDS = float(os.getenv("MASH_PREFETCH_TTL_SECONDS", "1800"))
+# Also describe and tag prefetched images, within the budget for batch commands (spends model calls on guesses)
+MASH_PREFETCH_ENRICH = os.getenv("MASH_PREFETCH_ENRICH", "0") in ("1", "true", "True")
+# Prefetched images enriched at once; others are left for the paste to enrich
+MASH_PREFETCH_ENRICH_CONCURRENCY = int(os.getenv("MASH_PREFETCH_ENRICH_CONCURRENCY", "1"))
+
+PREFETCHES = counter("mash_prefetch_total", "Snapshot prefetches by outcome (fetched, failed, evicted, expired)", ["outcome"])
+PREFETCH_LOOKUPS = counter("mash_prefetch_lookups_total", "Pasted images looked up among prefetched snapshots", ["result"])
+PREFETCH_FETCH_SECONDS = histogram("mash_prefetch_fetch_seconds", "Time to download a snapshot ahead of a paste")
+
+# Describes a prefetched image: (publication ID, space ID, snapshot URL, image base64) -> record or None
+Enricher = Callable[[str, str, str, str], Optional[ImageRecord]]
+
+
+class Prefetched:
+    """A downloaded snapshot waiting to be pasted, with its enrichment if one was started"""
+
+    __slots__ = ("publication_id", "space_id", "url", "image", "perceptual_hash", "used_at", "enrichment")
+
+    def __init__(self, publication_id: str, space_id: str, url: str, image: ImageRef, perceptual_hash: Optional[int]):
+        self.publication_id = publication_id
+        self.space_id = space_id
+        self.url = url
+        self.image = image  # Held here, so the image store keeps it until the entry is evicted
+        self.perceptual_hash = perceptual_hash
+        self.used_at = time.monotonic()
+        self.enrichment: Optional["Future[Optional[ImageRecord]]"] = None
+
+
+class SnapshotPrefetcher:
+    """
+    Downloads the snapshots of a listed space into the content-addressed
+    image store in the background, so pasting them into mash does not wait
+    for the downloads again.
+
+    At most `concurrency` downloads run at once, and prefetched images are
+    kept within a byte budget, evicting the least recently used. Entries are
+    found by snapshot URL and kept until they expire, since the same items
+    are often pasted more than once.
+    """
+
+    def __init__(self, concurrency: int, max_bytes: int, max_items: int, ttl_seconds: float,
+                 enabled: bool = True, enrich: bool = False, enrich_concurrency: int = 1):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.enrich = enrich
+        self._enricher: Optional[Enricher] = None
+        self._enriching = threading.BoundedSemaphore(max(1, enrich_concurrency))
+        self._entries: "OrderedDict[str, Prefetched]" = OrderedDict()  # URL -> entry
+        self._queued = set()  # URLs queued or downloading
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="mash-prefetch")
+
+    def register_enricher(self, enricher: Enricher):
+        self._enricher = enricher
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"images": len(self._entries), "bytes": self._bytes, "queued": len(self._queued)}
+
+    def schedule(self, space_id: str, snapshots: List[Dict]) -> int:
+        """
+        Start downloading listed snapshots that are not held or queued yet
+
+        Args:
+            space_id: Space the snapshots were listed from
+            snapshots: {"publication_id", "snapshot_url"} entries, in listing order
+
+        Returns:
+            Number of downloads queued
+        """
+        if not self.enabled:
+            return 0
+        queued = 0
+        with self._lock:
+            self._expire_locked()
+            for snapshot in snapshots[:self.max_items]:
+                url = snapshot.get("snapshot_url")
+                if not url or url in self._entries or url in self._queued:
+                    continue
+                self._queued.add(url)
+                self._executor.submit(bind_context(self._prefetch), snapshot["publication_id"], space_id, url)
+                queued += 1
+        if queued:
+            logger.info("Prefetching %s snapshot(s) of space %s", queued, space_id[:8])
+        return queued
+
+    def take(self, url: str) -> Optional[Prefetched]:
+        """The prefetched snapshot for a pasted image's URL, if it was downloaded and not evicted"""
+        with self._lock:
+            self._expire_locked()
+            entry = self._entries.get(url)
+            if entry is not None:
+                entry.used_at = time.monotonic()
+                self._entries.move_to_end(url)
+        PREFETCH_LOOKUPS.inc(result="hit" if entry is not None else "miss")
+        return entry
+
+    def _prefetch(self, publication_id: str, space_id: str, url: str):
+        try:
+            start = time.perf_counter()
+            response = requests.get(url, headers={"Authorization": f"Bearer {BEARER_TOKEN}"}, timeout=60)
+            response.raise_for_status()
+            PREFETCH_FETCH_SECONDS.observe(time.perf_counter() - start)
+            image_base64 = base64.b64encode(response.content).decode("utf-8")
+            if len(image_base64) > self.max_bytes:
+                raise ValueError(f"{len(image_base64)} bytes exceed the prefetch budget")
+            entry = Prefetched(publication_id, space_id, url, image_store.put(image_base64), dhash(response.content))
+        except Exception as e:
+            PREFETCHES.inc(outcome="failed")
+            logger.warning("Prefetching snapshot %s failed: %s", publication_id[:8], e)
+            with self._lock:
+                self._queued.discard(url)
+            return
+
+        enrich = self.enrich and self._enricher is not None
+        if enrich:
+            # Set before the entry is visible, so a paste arriving now waits for it instead of enriching again
+            entry.enrichment = Future()
+        self._add(entry)
+        PREFETCHES.inc(outcome="fetched")
+        if enrich:
+            entry.enrichment.set_result(self._enrich(entry))
+
+    def _enrich(self, entry: Prefetched) -> Optional[ImageRecord]:
+        # Speculative model calls never use the interactive reserve, and never take or wait for a batch slot
+        if not self._enriching.acquire(blocking=False):
+            return None
+        try:
+            ticket, rejection = budget_ledger.admit(None, "prefetch", estimate(text_calls=2), speculative=True)
+            if rejection:
+                logger.info("Not enriching prefetched %s: %s", entry.publication_id[:8], rejection["error"])
+                return None
+            with ticket:
+                return self._enricher(entry.publication_id, entry.space_id, entry.url, entry.image.base64)
+        except Exception as e:
+            logger.warning("Enriching prefetched %s failed: %s", entry.publication_id[:8], e)
+            return None
+        finally:
+            self._enriching.release()
+
+    def _add(self, entry: Prefetched):
+        with self._lock:
+            self._queued.discard(entry.url)
+            previous = self._entries.pop(entry.url, None)
+            if previous is not None:
+                self._bytes -= previous.image.size
+            self._entries[entry.url] = entry
+            self._bytes += entry.image.size
+            while self._bytes > self.max_bytes:
+                self._evict_locked(next(iter(self._entries)), "evicted")
+
+    def _expire_locked(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            url, entry = next(iter(self._entries.items()))
+            if entry.used_at >= cutoff:
+                break
+            self._evict_locked(url, "expired")
+
+    def _evict_locked(self, url: str, outcome: str):
+        entry = self._entries.pop(url)
+        self._bytes -= entry.image.size
+        PREFETCHES.inc(outcome=outcome)
+
+
+snapshot_prefetcher = SnapshotPrefetcher(MASH_PREFETCH_CONCURRENCY, MASH_PREFETCH_MAX_BYTES, MASH_PREFETCH_MAX_ITEMS,
+                                         MASH_PREFETCH_TTL_SECONDS, MASH_PREFETCH_ENABLED, MASH_PREFETCH_ENRICH,
+                                         MASH_PREFETCH_ENRICH_CONCURRENCY)
+
+gauge("mash_prefetch_bytes", "Base64 bytes of prefetched snapshots held for pastes",
+      callback=lambda: snapshot_prefetcher.stats()["bytes"])
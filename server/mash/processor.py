@@ -5,37 +5,87 @@ import mimetypes
 import threading
 import json
 import re
-from typing import List, Dict, Tuple, Optional, Union
+from typing import AsyncIterator, List, Dict, Mapping, Tuple, Optional, Union
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import google.generativeai as genai
+from concurrent.futures import CancelledError, Future
 import time
-import uuid
 import os
+from dataclasses import replace
 from .upload_utils import upload_image_to_soot
+from .generation_cache import generation_cache
+from .image_store import image_store
+from .jobs import JOB_RESUME_ON_START, PENDING, Job, job_store, register_runner, resume_interrupted_jobs, run_job, stream_job_events
+from .pair_selection import select_pairs
+from .prefetch import snapshot_prefetcher
+from .perceptual_hash import HashIndex, dhash, format_hash, hash_index, parse_hash, same_shape
+from .records import ImageRecord
+from .session_store import SESSION_HEADER, Session, create_session, get_session, expire_idle_sessions
+from .gemini_client import GeminiRequestError, generate_content, response_text, scheduler as gemini_scheduler
+from .gemini_scheduler import PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from .budget import budget_ledger, charge_to, estimate
+from .bulk import run_bulk
+from .generation import (
+    IMAGE_GENERATION_CONFIG,
+    build_operation_parts,
+    extract_generated_outputs,
+    save_debug_response,
+    save_generated_image,
+    upload_generated_image,
+)
+from .variations import VARIATION_MAX_COUNT, generate_variations
+from utils.log import get_logger, get_item_logger
+from utils.metrics import counter, histogram
+from utils.tracing import bind_context, current_span, span, traced
+from utils.profiling import InstrumentedLock
+
+logger = get_logger(__name__)
+item_logger = get_item_logger(__name__)  # Per-image messages, sampled
 
 # Add global cache persistence config
 CACHE_EXPIRY_SECONDS = 3600  # Cache lifetime (1 hour)
 cache_last_access = {}  # Record last access time for each instanceId
 
-# Session management variables
-current_session_id = str(uuid.uuid4())  # Generate initial session ID
-current_session_cache = {}  # The current session's cache
-
 load_dotenv()
 
 BEARER_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 # Fixed model names
 GEMINI_MODEL_NAME = "gemini-1.5-flash"  # For text generation and tagging
 GEMINI_IMAGE_MODEL_NAME = "gemini-2.0-flash-exp"  # For image generation
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+# Per-model rate limits shared by every Gemini call (requests and tokens per minute)
+gemini_scheduler.configure_model(
+    GEMINI_MODEL_NAME,
+    rpm=int(os.getenv("GEMINI_TEXT_RPM", "60")),
+    tpm=int(os.getenv("GEMINI_TEXT_TPM", "1000000")),
+)
+gemini_scheduler.configure_model(
+    GEMINI_IMAGE_MODEL_NAME,
+    rpm=int(os.getenv("GEMINI_IMAGE_RPM", "10")),
+    tpm=int(os.getenv("GEMINI_IMAGE_TPM", "1000000")),
+)
+
+# Persistent cache shared by all sessions; per-session images live in session_store
+description_cache: dict[str, ImageRecord] = {}
+cache_lock = InstrumentedLock("cache_lock")
+
+IMAGE_FETCH_SECONDS = histogram("mash_image_fetch_seconds", "Time to fetch a pasted image from SOOT", ["outcome"])
+ENRICHMENT_SECONDS = histogram("mash_enrichment_seconds", "Time to describe and tag a pasted image", ["outcome"])
+OPERATION_SECONDS = histogram("mash_operation_seconds", "Time to generate (and upload) one edited or mashed image", ["outcome"])
+CACHE_LOOKUPS = counter("mash_cache_lookups_total", "Image cache lookups by cache and result", ["cache", "result"])
+MATCH_PATHS = counter("mash_match_path_total", "Image matches by how they were decided (lexical, llm_tiebreak, llm)", ["path"])
+
+# Lexical (BM25) matching over tags and descriptions; the LLM only breaks ties
+LEXICAL_MATCH_ENABLED = os.getenv("MASH_LEXICAL_MATCH", "1") not in ("0", "false", "False")
+LEXICAL_TIE_MARGIN = float(os.getenv("MASH_LEXICAL_TIE_MARGIN", "0.15"))  # Scores within 15% of the best are ties
+LEXICAL_MAX_TIED = int(os.getenv("MASH_LEXICAL_MAX_TIED", "5"))  # Tied candidates sent to the LLM
 
-description_cache: dict[str, dict] = {}
-cache_lock = threading.Lock()
+# Leave near-duplicate images (same perceptual hash) out of the mash: all-pairs combinations
+MASH_ALL_COLLAPSE_DUPLICATES = os.getenv("MASH_ALL_COLLAPSE_DUPLICATES", "0") in ("1", "true", "True")
+# Default pair budget for mash: (0 generates every ordered pair); mash:[k] overrides it
+MASH_ALL_PAIR_BUDGET = int(os.getenv("MASH_ALL_PAIR_BUDGET", "0"))
+DUPLICATES_REUSED = counter("mash_duplicates_reused_total", "Pasted images that reused the enrichment of a near-duplicate", ["source"])
 
 class Metadata(BaseModel):
     imageURL: str
@@ -44,111 +94,297 @@ class Metadata(BaseModel):
     spaceId: str
     operation: int
 
-def process_metadata_entries(metadata_list: List[Metadata]) -> List[Dict]:
-    global current_session_id, current_session_cache, description_cache
+def process_metadata_entries(metadata_list: List[Metadata], session_id: Optional[str] = None) -> List[Dict]:
+    """
+    Fetch the pasted images and start background enrichment for each one
+
+    Args:
+        metadata_list: Metadata entries from the SOOT clipboard
+        session_id: The client's session ID; a new batch resets only this session
+
+    Returns:
+        Payloads (metadata and base64 image) for the frontend
+    """
     frontend_payloads = []
 
-    # If new images are received, create a new session
-    if metadata_list:
-        with cache_lock:
-            # Create new session ID
-            new_session_id = str(uuid.uuid4())
-            print(f"[🔄] Creating new session: {new_session_id}")
-            
-            # Update current session
-            current_session_id = new_session_id
-            current_session_cache = {}  # Clear current session cache
-            # We don't clear description_cache to keep persistence capability
+    # If new images are received, start a fresh session for this client only
+    # (description_cache is shared and kept for persistence)
+    if not metadata_list:
+        return frontend_payloads
+
+    # Drop enrichment still queued for this client's previous batch
+    previous_session = get_session(session_id) if session_id else None
+    if previous_session is not None:
+        gemini_scheduler.cancel_group(previous_session)
+    session = create_session(session_id)
+    
+    # Near-duplicates within this batch wait for the first copy's enrichment
+    batch_hashes = HashIndex()
+    groups: Dict[str, _DuplicateGroup] = {}
     
     for meta in metadata_list:
         try:
-            print(f"[📥] Fetching image for: {meta.filename or meta.instanceId[:6]}")
-            headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
-            res = requests.get(meta.imageURL, headers=headers)
-            res.raise_for_status()
-            image_bytes = res.content
-            image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+            # Snapshots listed from the space shortly before were downloaded in the background
+            prefetched = snapshot_prefetcher.take(meta.imageURL)
+            if prefetched is not None:
+                image_base64 = prefetched.image.base64
+                perceptual_hash = prefetched.perceptual_hash
+            else:
+                item_logger.info("Fetching image for: %s", meta.filename or meta.instanceId[:6])
+                headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+                with IMAGE_FETCH_SECONDS.time(), span("fetch", instanceId=meta.instanceId) as fetch_span:
+                    res = requests.get(meta.imageURL, headers=headers)
+                    res.raise_for_status()
+                    fetch_span.set_attribute("bytesReceived", len(res.content))
+                image_bytes = res.content
+                image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+                perceptual_hash = dhash(image_bytes)
             
             frontend_payloads.append({
                 "metadata": meta.dict(),
                 "imageBase64": image_base64
             })
 
-            print(f"[📤] Payload ready for frontend: {meta.filename or meta.instanceId[:6]}")
+            item_logger.debug("Payload ready for frontend: %s", meta.filename or meta.instanceId[:6])
 
-            # Start async processing
+            # Re-exports and resized copies of an image already described are not enriched again
+            group = None
+            if perceptual_hash is not None:
+                cached = _find_enriched_duplicate(perceptual_hash, image_base64)
+                if cached is not None:
+                    _reuse_enrichment(meta, image_base64, perceptual_hash, cached, session)
+                    DUPLICATES_REUSED.inc(source="cache")
+                    continue
+                leader = batch_hashes.nearest(perceptual_hash)
+                if leader is not None:
+                    groups[leader[0]].join(meta, image_base64, perceptual_hash, session)
+                    continue
+                batch_hashes.add(meta.instanceId, perceptual_hash)
+                group = groups[meta.instanceId] = _DuplicateGroup()
+
+            # Start async processing (or take over the enrichment the prefetch started)
+            if prefetched is not None and prefetched.enrichment is not None:
+                threading.Thread(
+                    target=bind_context(_adopt_prefetched_enrichment),
+                    args=(meta, image_base64, session, perceptual_hash, group, prefetched.enrichment)
+                ).start()
+                continue
             threading.Thread(
-                target=_generate_and_cache_description,
-                args=(meta, image_base64)
+                target=bind_context(_generate_and_cache_description),
+                args=(meta, image_base64, session, perceptual_hash, group)
             ).start()
 
         except Exception as e:
-            print(f"[❌] Failed to process {meta.filename or meta.instanceId[:6]}: {e}")
+            logger.error("Failed to process %s: %s", meta.filename or meta.instanceId[:6], e)
             continue
 
-    print(f"[✅] Total payloads returned: {len(frontend_payloads)}")
+    logger.info("Total payloads returned: %s", len(frontend_payloads))
     return frontend_payloads
 
-def _generate_and_cache_description(meta: Metadata, image_base64: str):
-    global current_session_cache
-    
+def _find_enriched_duplicate(perceptual_hash: int, image_base64: str) -> Optional[ImageRecord]:
+    """
+    The cached, successfully enriched image closest to a hash, if any is near
+    enough and has the same shape (the cache spans sessions, so a false match
+    would hand one client's description to another client's image)
+    """
+    nearest = hash_index.nearest(perceptual_hash)
+    if nearest is None:
+        return None
+    with cache_lock:
+        cached = description_cache.get(nearest[0])
+    if cached is None or not same_shape(cached.image_base64, image_base64):
+        return None
+    return cached
+
+def _reuse_enrichment(meta: Metadata, image_base64: str, perceptual_hash: int, source: ImageRecord, session: Session):
+    """Store a pasted image with the description and tags of its near-duplicate"""
+    item_logger.info("Reusing enrichment of %s for near-duplicate %s", source.instance_id[:6], meta.instanceId[:6])
+    record = ImageRecord(
+        instance_id=meta.instanceId,
+        metadata=meta.dict(),
+        image=image_store.put(image_base64),
+        description=source.description,
+        tags=source.tags,
+        perceptual_hash=format_hash(perceptual_hash),
+        duplicate_of=source.instance_id,
+    )
+    session.put(record)
+    with cache_lock:
+        description_cache[meta.instanceId] = record
+
+def _adopt_prefetched_enrichment(meta: Metadata, image_base64: str, session: Session, perceptual_hash: Optional[int],
+                                 group: Optional["_DuplicateGroup"], enrichment: "Future[Optional[ImageRecord]]"):
+    """Store a pasted image with the description and tags its prefetch produced, enriching it here if that failed"""
+    source = enrichment.result()
+    if source is None:
+        _generate_and_cache_description(meta, image_base64, session, perceptual_hash, group)
+        return
+    item_logger.info("Using prefetched enrichment for %s", meta.instanceId[:6])
+    record = ImageRecord(
+        instance_id=meta.instanceId,
+        metadata=meta.dict(),
+        image=image_store.put(image_base64),
+        description=source.description,
+        tags=source.tags,
+        perceptual_hash=format_hash(perceptual_hash) if perceptual_hash is not None else None,
+    )
+    session.put(record)
+    with cache_lock:
+        description_cache[meta.instanceId] = record
+    if perceptual_hash is not None:
+        hash_index.add(meta.instanceId, perceptual_hash)
+    if group is not None:
+        group.finish(record, session)
+
+def _enrich_prefetched(publication_id: str, space_id: str, url: str, image_base64: str) -> Optional[ImageRecord]:
+    """Describe and tag a prefetched snapshot before it is pasted (the record is kept with the prefetch only)"""
+    meta = Metadata(imageURL=url, instanceId=publication_id, spaceId=space_id, operation=0)
     try:
-        print(f"[⏳] Starting description generation for {meta.instanceId[:6]}")
-        description, raw_response = generate_description(image_base64, meta)
+        description, _ = generate_description(image_base64, meta)
         tags = generate_tags(image_base64, meta)
+    except GeminiRequestError as e:
+        logger.warning("Enrichment failed for prefetched %s: %s", publication_id[:6], e)
+        return None
+    return ImageRecord(instance_id=publication_id, metadata=meta.dict(), image=image_store.put(image_base64),
+                       description=description, tags=tags)
 
-        record = {
-            "instanceId": meta.instanceId,
-            "metadata": meta.dict(),
-            "imageBase64": image_base64,
-            "description": description,
-            "tags": tags,
-            "rawResponse": raw_response
-        }
+snapshot_prefetcher.register_enricher(_enrich_prefetched)
 
+class _DuplicateGroup:
+    """
+    Near-duplicates of one image in a pasted batch. Only the first copy is
+    enriched; the others take its description and tags once it is done, or
+    are enriched on their own if it failed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = False
+        self.record: Optional[ImageRecord] = None
+        self.followers: List[Tuple[Metadata, str, int]] = []
+
+    def join(self, meta: Metadata, image_base64: str, perceptual_hash: int, session: Session):
+        with self.lock:
+            if not self.done:
+                self.followers.append((meta, image_base64, perceptual_hash))
+                return
+        self._settle(meta, image_base64, perceptual_hash, session)
+
+    def finish(self, record: Optional[ImageRecord], session: Session, cancelled: bool = False):
+        with self.lock:
+            self.done = True
+            self.record = record
+            followers, self.followers = self.followers, []
+        if cancelled:
+            return
+        for follower in followers:
+            self._settle(*follower, session)
+
+    def _settle(self, meta: Metadata, image_base64: str, perceptual_hash: int, session: Session):
+        if self.record is not None:
+            _reuse_enrichment(meta, image_base64, perceptual_hash, self.record, session)
+            DUPLICATES_REUSED.inc(source="batch")
+        else:
+            threading.Thread(
+                target=bind_context(_generate_and_cache_description),
+                args=(meta, image_base64, session, perceptual_hash)
+            ).start()
+
+@traced("enrich")
+def _generate_and_cache_description(meta: Metadata, image_base64: str, session: Session,
+                                    perceptual_hash: Optional[int] = None, group: Optional[_DuplicateGroup] = None):
+    current_span().set_attribute("instanceId", meta.instanceId)
+    start = time.perf_counter()
+    outcome = "error"
+    cached_record = None
+    try:
+        item_logger.debug("Starting description generation for %s", meta.instanceId[:6])
+        enrichment_error = None
+        try:
+            description, _ = generate_description(image_base64, meta, group=session)
+            tags = generate_tags(image_base64, meta, group=session)
+        except GeminiRequestError as e:
+            # Keep the image usable in the session, but never persist the failure
+            logger.warning("Enrichment failed for %s: %s", meta.instanceId[:6], e)
+            description, tags = "Failed to generate description", []
+            enrichment_error = str(e)
+            outcome = "failed"
+
+        # The raw Gemini text is not kept: it duplicates the description
+        record = ImageRecord(
+            instance_id=meta.instanceId,
+            metadata=meta.dict(),
+            image=image_store.put(image_base64),
+            description=description,
+            tags=tags,
+            enrichment_error=enrichment_error,
+            perceptual_hash=format_hash(perceptual_hash) if perceptual_hash is not None else None,
+        )
+
+        # Add to the client's session cache
+        session.put(record)
+
+        if enrichment_error:
+            return
+        outcome = "ok"
+
+        # Also add to global cache for persistence
         with cache_lock:
-            # Add to current session cache
-            current_session_cache[meta.instanceId] = record
-            
-            # Also add to global cache for persistence
             description_cache[meta.instanceId] = record
+        if perceptual_hash is not None:
+            hash_index.add(meta.instanceId, perceptual_hash)
+        cached_record = record
             
-        print(f"[✅] Cached description for {meta.instanceId[:6]}")
+        item_logger.info("Cached description for %s", meta.instanceId[:6])
 
+    except CancelledError:
+        outcome = "cancelled"
+        logger.info("Enrichment cancelled for %s", meta.instanceId[:6])
     except Exception as e:
-        print(f"[⚠️] Gemini error for {meta.instanceId[:6]}: {e}")
+        logger.warning("Gemini error for %s: %s", meta.instanceId[:6], e)
+    finally:
+        ENRICHMENT_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+        if group is not None:
+            group.finish(cached_record, session, cancelled=outcome == "cancelled")
 
-def generate_description(image_base64: str, meta: Metadata) -> tuple[str, str]:
-    print(f"[🧠] Generating: {meta.filename or meta.instanceId[:6]}")
-    try:
-        image_bytes = base64.b64decode(image_base64)
-        mime_type = mimetypes.guess_type(meta.filename or "")[0] or "image/png"
+def generate_description(image_base64: str, meta: Metadata, group=None) -> tuple[str, str]:
+    """
+    Generate a description for a freshly pasted image (background priority)
 
-        response = model.generate_content([
-            {"mime_type": mime_type, "data": image_bytes},
-            {"text": "Describe this image in detail (2-3 sentences), focusing on both content and style. Mention: 1) The main subjects/people, 2) The photographic or artistic style (e.g., portrait, landscape, abstract, vintage, minimalist), 3) Any notable visual characteristics (e.g., black and white, vibrant colors, blurry, sharp focus). Be specific about what's visible in the image."}
-        ])
+    Raises:
+        GeminiRequestError: If the request failed after retries, so callers
+            never cache a placeholder description
+    """
+    item_logger.debug("Generating: %s", meta.filename or meta.instanceId[:6])
+    mime_type = mimetypes.guess_type(meta.filename or "")[0] or "image/png"
 
-        description = response.text.strip()
-        print(f"[🎯] Gemini result for {meta.instanceId[:6]}: {description}")
-        return description, response.text
+    response = generate_content(GEMINI_MODEL_NAME, [
+        {"inlineData": {"mimeType": mime_type, "data": image_base64}},
+        {"text": "Describe this image in detail (2-3 sentences), focusing on both content and style. Mention: 1) The main subjects/people, 2) The photographic or artistic style (e.g., portrait, landscape, abstract, vintage, minimalist), 3) Any notable visual characteristics (e.g., black and white, vibrant colors, blurry, sharp focus). Be specific about what's visible in the image."}
+    ], priority=PRIORITY_BACKGROUND, group=group)
 
-    except Exception as e:
-        print(f"[💥] Description generation failed for {meta.instanceId[:6]}: {e}")
-        return "Failed to generate description", ""
+    raw_text = response_text(response)
+    description = raw_text.strip()
+    item_logger.debug("Gemini result for %s: %s", meta.instanceId[:6], description)
+    return description, raw_text
 
-def generate_tags(image_base64: str, meta: Metadata) -> List[str]:
-    print(f"[🏷️] Tagging: {meta.filename or meta.instanceId[:6]}")
-    try:
-        image_bytes = base64.b64decode(image_base64)
-        mime_type = mimetypes.guess_type(meta.filename or "")[0] or "image/png"
+def generate_tags(image_base64: str, meta: Metadata, group=None) -> List[str]:
+    """
+    Generate system tags for a freshly pasted image (background priority)
+
+    Raises:
+        GeminiRequestError: If the request failed after retries
+    """
+    item_logger.debug("Tagging: %s", meta.filename or meta.instanceId[:6])
+    mime_type = mimetypes.guess_type(meta.filename or "")[0] or "image/png"
 
-        response = model.generate_content([
-            {"mime_type": mime_type, "data": image_bytes},
-            {"text": "Generate 8-12 detailed, lowercase tags that thoroughly describe this image. Include tags for: 1) Visual style (e.g., portrait, landscape, abstract), 2) Technical aspects (saturation level, contrast level, black and white if applicable), 3) Subject matter and content, 4) Mood or emotion, 5) Composition, 6) Lighting conditions, 7) Color palette. Return only a JSON array of string tags."}
-        ])
+    response = generate_content(GEMINI_MODEL_NAME, [
+        {"inlineData": {"mimeType": mime_type, "data": image_base64}},
+        {"text": "Generate 8-12 detailed, lowercase tags that thoroughly describe this image. Include tags for: 1) Visual style (e.g., portrait, landscape, abstract), 2) Technical aspects (saturation level, contrast level, black and white if applicable), 3) Subject matter and content, 4) Mood or emotion, 5) Composition, 6) Lighting conditions, 7) Color palette. Return only a JSON array of string tags."}
+    ], priority=PRIORITY_BACKGROUND, group=group)
 
-        tags_text = response.text.strip()
+    try:
+        tags_text = response_text(response).strip()
         
         # Handle if the response comes in a code block format
         if "```json" in tags_text:
@@ -160,91 +396,128 @@ def generate_tags(image_base64: str, meta: Metadata) -> List[str]:
         if tags_text.startswith("["):
             try:
                 tags = json.loads(tags_text)
-                print(f"[🏷️] Tags parsed: {tags}")
+                item_logger.debug("Tags parsed: %s", tags)
                 return tags
             except json.JSONDecodeError as e:
-                print(f"[⚠️] JSON decode error: {e}")
+                logger.warning("JSON decode error: %s", e)
                 # Extract tags manually as fallback
                 potential_tags = re.findall(r'"([^"]*)"', tags_text)
                 if potential_tags:
-                    print(f"[🏷️] Tags extracted manually: {potential_tags}")
+                    item_logger.debug("Tags extracted manually: %s", potential_tags)
                     return potential_tags
                 return []
         else:
-            print(f"[⚠️] Tag format unexpected: {tags_text}")
+            logger.warning("Tag format unexpected: %s", tags_text)
             return []
 
     except Exception as e:
-        print(f"[💥] Tag generation failed for {meta.instanceId[:6]}: {e}")
+        logger.error("Tag generation failed for %s: %s", meta.instanceId[:6], e)
         return []
 
-def get_all_cached_descriptions() -> List[Dict]:
-    with cache_lock:
-        cleaned = []
-        for record in current_session_cache.values():
-            filtered = {k: v for k, v in record.items() if k != "imageBase64"}
-            cleaned.append(filtered)
-        return cleaned
+def get_all_cached_descriptions(session_id: Optional[str] = None) -> List[Dict]:
+    session = get_session(session_id)
+    if session is None:
+        return []
+
+    # Stripped once per session version, not on every poll
+    return session.snapshot().descriptions()
 
-def get_image_by_index(index: int) -> Optional[Dict]:
+def get_image_by_index(session: Session, index: int) -> Optional[ImageRecord]:
     """
-    Get an image from the current session cache by its index (1-based)
+    Get an image from the session cache by its index (1-based)
     
     Args:
+        session: The client's session
         index: 1-based index of the image in the cache
         
     Returns:
         The image record or None if not found
     """
-    with cache_lock:
-        all_images = list(current_session_cache.values())  # Use current_session_cache
-        # Convert 1-based index to 0-based index
-        idx = index - 1
-        if 0 <= idx < len(all_images):
-            image = all_images[idx]
-            # Update last access time
-            instance_id = image.get("instanceId")
-            if instance_id:
-                cache_last_access[instance_id] = time.time()
-            return image
-    return None
+    image = session.get_by_index(index)
+    CACHE_LOOKUPS.inc(cache="session", result="hit" if image else "miss")
+    if image:
+        # Update last access time
+        cache_last_access[image.instance_id] = time.time()
+    return image
 
-def find_best_matching_image(prompt: str) -> Optional[Dict]:
+def _lexical_match(session: Session, prompt: str, exclude_id: Optional[str] = None) -> Tuple[Optional[ImageRecord], Mapping[str, ImageRecord]]:
+    """
+    Rank the session's images against a prompt with the BM25 tag index
+
+    Args:
+        session: The client's session
+        prompt: User's prompt
+        exclude_id: Instance ID to leave out
+
+    Returns:
+        (match, candidates): the match if the lexical ranking is decisive,
+        otherwise None and the images the LLM should score (the tied leaders,
+        or every image when the prompt matches nothing lexically)
+    """
+    images = session.items()
+    candidates = {k: v for k, v in images.items() if k != exclude_id} if exclude_id else images
+    if not LEXICAL_MATCH_ENABLED or not candidates:
+        MATCH_PATHS.inc(path="llm")
+        return None, candidates
+
+    # The index may be a write ahead of the snapshot; only rank images in it
+    ranked = [(i, score) for i, score in session.index.search(prompt) if i in candidates]
+    if not ranked:
+        MATCH_PATHS.inc(path="llm")
+        return None, candidates
+
+    best_id, best_score = ranked[0]
+    tied = [i for i, score in ranked[:LEXICAL_MAX_TIED] if score >= best_score * (1 - LEXICAL_TIE_MARGIN)]
+    current_span().set_attribute("lexicalScore", round(best_score, 3))
+    if len(tied) == 1:
+        MATCH_PATHS.inc(path="lexical")
+        current_span().set_attribute("matchPath", "lexical")
+        item_logger.debug("Lexical match %s with score %.3f", best_id[:6], best_score)
+        return candidates[best_id], {}
+
+    MATCH_PATHS.inc(path="llm_tiebreak")
+    current_span().set_attribute("matchPath", "llm_tiebreak")
+    return None, {i: candidates[i] for i in tied}
+
+@traced("match")
+def find_best_matching_image(session: Session, prompt: str) -> Optional[ImageRecord]:
     """
     Find the best matching image for a user prompt based on descriptions and tags.
     
     Args:
+        session: The client's session
         prompt: User's prompt
         
     Returns:
         The best matching image record, or None if no matches
     """
-    print(f"[🔍] Finding best match for prompt: {prompt}")
+    logger.info("Finding best match for prompt: %s", prompt)
     
-    with cache_lock:
-        if not current_session_cache:
-            print("[⚠️] No cached images available")
-            return None
-        
-        cached_descriptions_copy = current_session_cache.copy()
+    if not session.items():
+        logger.warning("No cached images available")
+        return None
     
-    # Use text processing model
-    matching_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    # Decisive lexical matches skip the LLM; ties are scored by it
+    lexical_match, cached_descriptions_copy = _lexical_match(session, prompt)
+    if lexical_match is not None:
+        logger.info("Best match found lexically: %s", lexical_match.instance_id[:6])
+        return lexical_match
     
     best_match = None
     highest_score = -1
     
     for instance_id, record in cached_descriptions_copy.items():
         # Extract description and tags
-        description = record.get("description", "")
-        tags = record.get("tags", [])
+        description = record.description
+        tags = record.tags
         
         # Create a context for matching
         context = f"Description: {description}\nTags: {', '.join(tags)}"
         
         try:
             # Improved prompt for more consistent scoring
-            response = matching_model.generate_content(
+            response = generate_content(
+                GEMINI_MODEL_NAME,
                 [{"text": f"""
                 Task: Score how relevant an image is to a specific prompt.
                 
@@ -258,73 +531,77 @@ def find_best_matching_image(prompt: str) -> Optional[Dict]:
                 from 0 to 10, where 0 means completely irrelevant and 10 means perfect match.
                 
                 Return only a number between 0 and 10.
-                """}]
+                """}],
+                priority=PRIORITY_INTERACTIVE
             )
             
             # Extract the score
-            score_text = response.text.strip()
+            score_text = response_text(response).strip()
             # Handle possible text format - extract just the number
             score_text = ''.join(char for char in score_text if char.isdigit() or char == '.')
             
             try:
                 score = float(score_text)
-                print(f"[📊] Image {instance_id[:6]} score: {score}")
+                item_logger.debug("Image %s score: %s", instance_id[:6], score)
                 
                 if score > highest_score:
                     highest_score = score
                     best_match = record
             except ValueError:
-                print(f"[⚠️] Could not parse score: {score_text}")
+                logger.warning("Could not parse score: %s", score_text)
                 continue
                 
         except Exception as e:
-            print(f"[❌] Error scoring match for {instance_id[:6]}: {e}")
+            logger.error("Error scoring match for %s: %s", instance_id[:6], e)
             continue
     
     if best_match:
-        print(f"[✅] Best match found: {best_match['instanceId'][:6]} with score {highest_score}")
+        logger.info("Best match found: %s with score %s", best_match.instance_id[:6], highest_score)
     else:
-        print("[❌] No suitable match found")
+        logger.warning("No suitable match found")
         
     return best_match
 
-def find_second_best_matching_image(prompt: str, exclude_id: str) -> Optional[Dict]:
+@traced("match.second")
+def find_second_best_matching_image(session: Session, prompt: str, exclude_id: str) -> Optional[ImageRecord]:
     """
     Find the second best matching image for a prompt, excluding the specified ID
     
     Args:
+        session: The client's session
         prompt: User's prompt
         exclude_id: Instance ID to exclude
         
     Returns:
         The second best matching image, or None if no matches
     """
-    print(f"[🔍] Finding second best match for prompt: {prompt}, excluding {exclude_id[:6]}")
+    logger.debug("Finding second best match for prompt: %s, excluding %s", prompt, exclude_id[:6])
     
-    with cache_lock:
-        if not current_session_cache:
-            print("[⚠️] No cached images available in current session")
-            return None
-        
-        cached_descriptions_copy = {k: v for k, v in current_session_cache.items() if k != exclude_id}
+    session_images = session.items()
+    if not session_images:
+        logger.warning("No cached images available in current session")
+        return None
     
-    # Use text processing model
-    matching_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    lexical_match, cached_descriptions_copy = _lexical_match(session, prompt, exclude_id=exclude_id)
+    if lexical_match is not None:
+        logger.info("Second best match found lexically: %s", lexical_match.instance_id[:6])
+        return lexical_match
     
     best_match = None
     highest_score = -1
     
     for instance_id, record in cached_descriptions_copy.items():
         # Extract description and tags
-        description = record.get("description", "")
-        tags = record.get("tags", [])
+        description = record.description
+        tags = record.tags
         
         # Create a context for matching
         context = f"Description: {description}\nTags: {', '.join(tags)}"
         
         try:
             # Improved prompt for more consistent scoring
-            response = matching_model.generate_content(
+            response = generate_content(
+                GEMINI_MODEL_NAME,
                 [{"text": f"""
                 Task: Score how relevant an image is to a specific prompt.
                 
@@ -338,36 +615,38 @@ def find_second_best_matching_image(prompt: str, exclude_id: str) -> Optional[Di
                 from 0 to 10, where 0 means completely irrelevant and 10 means perfect match.
                 
                 Return only a number between 0 and 10.
-                """}]
+                """}],
+                priority=PRIORITY_INTERACTIVE
             )
             
             # Extract the score
-            score_text = response.text.strip()
+            score_text = response_text(response).strip()
             # Handle possible text format
             score_text = ''.join(char for char in score_text if char.isdigit() or char == '.')
             
             try:
                 score = float(score_text)
-                print(f"[📊] Image {instance_id[:6]} score: {score}")
+                item_logger.debug("Image %s score: %s", instance_id[:6], score)
                 
                 if score > highest_score:
                     highest_score = score
                     best_match = record
             except ValueError:
-                print(f"[⚠️] Could not parse score: {score_text}")
+                logger.warning("Could not parse score: %s", score_text)
                 continue
                 
         except Exception as e:
-            print(f"[❌] Error scoring match for {instance_id[:6]}: {e}")
+            logger.error("Error scoring match for %s: %s", instance_id[:6], e)
             continue
     
     if best_match:
-        print(f"[✅] Second best match found: {best_match['instanceId'][:6]} with score {highest_score}")
+        logger.info("Second best match found: %s with score %s", best_match.instance_id[:6], highest_score)
     else:
-        print("[❌] No suitable second match found")
+        logger.warning("No suitable second match found")
         
     return best_match
 
+@traced()
 def parse_user_command(command: str) -> dict:
     """
     Parse user command to identify command type and parameters
@@ -425,7 +704,7 @@ def parse_user_command(command: str) -> dict:
         result["command_type"] = "prompt"
         result["parameters"] = command
     
-    print(f"[🔍] Parsed command: {result['command_type']} with parameters: {result['parameters']}")
+    logger.debug("Parsed command: %s with parameters: %s", result['command_type'], result['parameters'])
     return result
 
 def parse_mash_details(prompt: str) -> Dict:
@@ -444,7 +723,13 @@ def parse_mash_details(prompt: str) -> Dict:
         "is_empty": prompt.strip() == ""
     }
     
-    print(f"[🔍] Checking if mash command is empty: '{prompt}' -> {result['is_empty']}")
+    # "mash:[k]" is mash all, limited to the k best pairs
+    budget_match = re.match(r'^\[(\d+)\]$', prompt.strip())
+    if budget_match:
+        result["is_empty"] = True
+        result["budget"] = int(budget_match.group(1))
+    
+    logger.debug("Checking if mash command is empty: '%s' -> %s", prompt, result['is_empty'])
     
     # If empty prompt, this is a "mash all" command
     if result["is_empty"]:
@@ -470,30 +755,32 @@ def parse_mash_details(prompt: str) -> Dict:
     
     return result
 
-def handle_mash_command(parsed_command: Dict) -> Dict:
+@traced()
+def handle_mash_command(session: Session, parsed_command: Dict) -> Dict:
     """
     Handle mash command by combining images according to specifications
     
     Args:
+        session: The client's session
         parsed_command: Parsed command information
         
     Returns:
         Result of the operation
     """
-    print(f"[🔀] Processing mash command: {parsed_command}")
+    logger.info("Processing mash command: %s", parsed_command)
     
     # Check if this is an empty mash command (mash:)
     mash_info = parsed_command.get("mash_info", {})
     parameters = parsed_command.get("parameters", "")
     
     # Debug output to check the values
-    print(f"[🔍] Mash parameters: '{parameters}'")
-    print(f"[🔍] Is empty mash command: {mash_info.get('is_empty', False)}")
+    logger.debug("Mash parameters: '%s'", parameters)
+    logger.debug("Is empty mash command: %s", mash_info.get('is_empty', False))
     
     # If this is an empty mash command (mash:), combine all images in pairs
     if mash_info and mash_info.get("is_empty", False):
-        print(f"[✅] Detected empty mash command, routing to handle_mash_all_images()")
-        return handle_mash_all_images()
+        logger.info("Detected empty mash command, routing to handle_mash_all_images()")
+        return handle_mash_all_images(session, budget=mash_info.get("budget"))
     
     # Collect all source images for specified features
     source_images = {}
@@ -501,16 +788,16 @@ def handle_mash_command(parsed_command: Dict) -> Dict:
     # Check if we have valid sources
     if not mash_info or not mash_info.get("sources"):
         # If no explicit sources, find best matching images for each feature
-        return find_and_mash_best_matches(parameters)
+        return find_and_mash_best_matches(session, parameters)
     
     # Get source images for each feature
     for feature, source_index in mash_info.get("sources", {}).items():
-        source_image = get_image_by_index(source_index)
+        source_image = get_image_by_index(session, source_index)
         if source_image:
             source_images[feature] = source_image
-            print(f"[🔍] Found source for {feature}: image #{source_index} ({source_image['instanceId'][:6]})")
+            logger.debug("Found source for %s: image #%s (%s)", feature, source_index, source_image.instance_id[:6])
         else:
-            print(f"[⚠️] Source not found for {feature}: image #{source_index}")
+            logger.warning("Source not found for %s: image #%s", feature, source_index)
     
     # Check if we have enough sources
     if not source_images:
@@ -528,152 +815,224 @@ def handle_mash_command(parsed_command: Dict) -> Dict:
     base_image = source_images[base_feature]
     
     # Apply the mash operation
-    result = apply_operation_to_image(base_image, parsed_command["original_command"], source_images, skip_upload=False)
+    result = apply_operation_to_image(base_image, parsed_command["original_command"], source_images, skip_upload=False,
+                                      command="mash")
     
     return result
   
-def handle_mash_all_images() -> Dict:
+def _collapse_near_duplicates(indexed_images: List[Tuple[int, ImageRecord]]) -> List[Tuple[int, ImageRecord]]:
+    """Keep only the first of each group of images with near-identical perceptual hashes"""
+    seen = HashIndex()
+    kept = []
+    for index, image in indexed_images:
+        value = parse_hash(image.perceptual_hash)
+        if value is not None:
+            if seen.nearest(value) is not None:
+                item_logger.debug("Leaving near-duplicate image %s out of the mash", index + 1)
+                continue
+            seen.add(image.instance_id, value)
+        kept.append((index, image))
+    return kept
+
+@traced()
+def handle_mash_all_images(session: Session, budget: Optional[int] = None) -> Dict:
     """
     Handle 'mash:' command (without parameters) by combining all images in pairs.
-    Generates n*n-n combinations (excluding self-combinations).
-    Uses only images from the current session.
+    Generates n*n-n combinations (excluding self-combinations), or with a
+    budget ('mash:[k]') only the k most complementary pairs.
+    Uses only images from the client's session.
     
+    Args:
+        session: The client's session
+        budget: Maximum number of combinations (defaults to MASH_ALL_PAIR_BUDGET, 0 for all)
+        
     Returns:
         Result with all generated combinations
     """
-    print("[🔄] Processing mash all images command")
+    logger.info("Processing mash all images command")
     
-    with cache_lock:
-        # Changed from description_cache to current_session_cache
-        all_images = list(current_session_cache.values())
+    all_images = session.records()
         
     if len(all_images) < 2:
         return {"error": "Need at least 2 images to perform mash all operation"}
     
     total_images = len(all_images)
-    # n*n-n combinations (excluding self with self)
-    max_combinations = total_images * total_images - total_images
+    # Images keep their session index even when near-duplicates are left out
+    indexed_images = list(enumerate(all_images))
+    if MASH_ALL_COLLAPSE_DUPLICATES:
+        indexed_images = _collapse_near_duplicates(indexed_images)
+    collapsed = total_images - len(indexed_images)
+    
+    # n*n-n ordered pairs (excluding self with self), or only the best ones within the budget
+    all_pairs = len(indexed_images) * len(indexed_images) - len(indexed_images)
+    budget = budget if budget is not None else MASH_ALL_PAIR_BUDGET
+    if budget and budget < all_pairs:
+        pairs = [(indexed_images[i], indexed_images[j])
+                 for i, j in select_pairs([image for _, image in indexed_images], budget)]
+    else:
+        pairs = [(style, content) for style in indexed_images for content in indexed_images if style[0] != content[0]]
+    max_combinations = len(pairs)
+    
+    logger.info("Starting mash of all %s images (%s of %s combinations, %s near-duplicates left out)",
+                total_images, max_combinations, all_pairs, collapsed)
+    
+    # Every combination is a job item, so a restart or a retry never repeats finished generations
+    job = job_store.create(
+        "mash_all",
+        session.session_id,
+        {"totalImages": total_images, "collapsedDuplicates": collapsed, "pairBudget": budget or None},
+        [image for _, image in indexed_images],
+        [(f"style{i+1}_content{j+1}", {"style": style_image.instance_id, "content": content_image.instance_id, "i": i, "j": j})
+         for (i, style_image), (j, content_image) in pairs],
+    )
+    run_job(job)
+    return _mash_all_response(job)
+
+def _mash_combination(style_image: ImageRecord, content_image: ImageRecord, i: int, j: int) -> Dict:
+    """
+    Apply the style of one image to the content of another and upload the result
+
+    Args:
+        style_image: Style source
+        content_image: Content source and base image
+        i: 0-based session index of the style image
+        j: 0-based session index of the content image
+
+    Returns:
+        The combination result, or an error entry
+    """
+    # Create ID for this combination
+    combo_id = f"style{i+1}_content{j+1}"
+    item_logger.debug("Processing combination %s", combo_id)
     
-    print(f"[🔀] Starting mash of all {total_images} images ({max_combinations} combinations)")
+    # Set up the source images for this combination
+    source_images = {
+        "style": style_image,
+        "content": content_image
+    }
     
-    # Prepare array to store all combinations
-    all_combinations = []
+    # Create a descriptive prompt
+    style_desc = style_image.description or f"image {i+1}"
+    content_desc = content_image.description or f"image {j+1}"
+    mash_prompt = f"Apply style from image {i+1} to content of image {j+1}"
     
-    # Generate combinations by applying each image's style to every other image
-    for i, style_image in enumerate(all_images):
-        for j, content_image in enumerate(all_images):
-            # Skip self-combinations
-            if i == j:
-                continue
-                
-            # Create ID for this combination
-            combo_id = f"style{i+1}_content{j+1}"
-            print(f"[🔀] Processing combination {combo_id}")
-            
-            # Set up the source images for this combination
-            source_images = {
-                "style": style_image,
-                "content": content_image
-            }
-            
-            # Create a descriptive prompt
-            style_desc = style_image.get("description", f"image {i+1}")
-            content_desc = content_image.get("description", f"image {j+1}")
-            mash_prompt = f"Apply style from image {i+1} to content of image {j+1}"
-            
+    try:
+        # Apply the mash operation with skip_upload=True to prevent double upload
+        result = apply_operation_to_image(
+            content_image,  # Use content as base
+            mash_prompt,
+            source_images,
+            skip_upload=True,  # Skip the upload in apply_operation_to_image
+            command="mash"
+        )
+        
+        # Add metadata for tracking
+        result["styleImageIndex"] = i + 1
+        result["contentImageIndex"] = j + 1
+        result["styleImageId"] = style_image.instance_id
+        result["contentImageId"] = content_image.instance_id
+        result["combinationId"] = combo_id
+        
+        item_logger.info("Completed combination %s", combo_id)
+        
+        # Upload to original SOOT space if we have a generated image
+        if "result" in result and "imageBase64" in result["result"]:
             try:
-                # Apply the mash operation with skip_upload=True to prevent double upload
-                result = apply_operation_to_image(
-                    content_image,  # Use content as base
-                    mash_prompt,
-                    source_images,
-                    skip_upload=True  # Skip the upload in apply_operation_to_image
-                )
-                
-                # Add metadata for tracking
-                result["styleImageIndex"] = i + 1
-                result["contentImageIndex"] = j + 1
-                result["styleImageId"] = style_image["instanceId"]
-                result["contentImageId"] = content_image["instanceId"]
-                result["combinationId"] = combo_id
-                
-                # Add to results
-                all_combinations.append(result)
-                
-                print(f"[✅] Completed combination {len(all_combinations)}/{max_combinations}")
-                
-                # Upload to original SOOT space if we have a generated image
-                if "result" in result and "imageBase64" in result["result"]:
-                    try:
-                        # Get spaceId from metadata - use content image's space
-                        space_id = content_image.get("metadata", {}).get("spaceId")
-                        if space_id:
-                            print(f"[🔄] Uploading mash combination {combo_id} to SOOT space: {space_id}")
-                            
-                            # Upload to SOOT
-                            upload_result = upload_image_to_soot(
-                                image_data=result["result"]["imageBase64"],
-                                space_id=space_id,
-                                is_base64=True,
-                                verbose=True
-                            )
-                            
-                            # Store upload result
-                            result["sootUploadResult"] = upload_result
-                            
-                            if upload_result["success"]:
-                                print(f"[✅] Mash combination {combo_id} successfully uploaded to SOOT")
-                            else:
-                                print(f"[❌] Failed to upload mash combination {combo_id}: {upload_result['message']}")
-                    except Exception as e:
-                        print(f"[❌] Error uploading mash combination {combo_id}: {e}")
-                        import traceback
-                        traceback.print_exc()
-                
+                # Get spaceId from metadata - use content image's space
+                space_id = content_image.space_id
+                if space_id:
+                    item_logger.info("Uploading mash combination %s to SOOT space: %s", combo_id, space_id)
+                    
+                    # Upload to SOOT (skipped if this image was already uploaded there)
+                    generated_image_base64 = result["result"]["imageBase64"]
+                    upload_result = generation_cache.upload_once(generated_image_base64, space_id, lambda: upload_image_to_soot(
+                        image_data=generated_image_base64,
+                        space_id=space_id,
+                        is_base64=True,
+                        verbose=True
+                    ))
+                    
+                    # Store upload result
+                    result["sootUploadResult"] = upload_result
+                    
+                    if upload_result["success"]:
+                        item_logger.info("Mash combination %s successfully uploaded to SOOT", combo_id)
+                    else:
+                        logger.error("Failed to upload mash combination %s: %s", combo_id, upload_result['message'])
             except Exception as e:
-                print(f"[❌] Error processing combination {i+1}×{j+1}: {e}")
-                error_result = {
-                    "styleImageIndex": i + 1,
-                    "contentImageIndex": j + 1,
-                    "error": f"Failed to process: {str(e)}"
-                }
-                all_combinations.append(error_result)
+                logger.exception("Error uploading mash combination %s: %s", combo_id, e)
+        
+    except Exception as e:
+        logger.error("Error processing combination %s×%s: %s", i+1, j+1, e)
+        return {
+            "styleImageIndex": i + 1,
+            "contentImageIndex": j + 1,
+            "error": f"Failed to process: {str(e)}"
+        }
+    
+    return result
+
+def _run_mash_item(job: Job, item: Dict, previous: Optional[Dict]) -> Tuple[Optional[Dict], Optional[str]]:
+    style_image, content_image = job.image(item["style"]), job.image(item["content"])
+    if style_image is None or content_image is None:
+        return None, "Source image is missing from the job"
+    result = _mash_combination(style_image, content_image, item["i"], item["j"])
+    return result, result.get("error")
+
+def _mash_all_response(job: Job) -> Dict:
+    """The mash: response for a job, with finished combinations and errors in pair order"""
+    all_combinations = []
+    for _, item in job_store.results(job):
+        if item["status"] == PENDING:
+            continue
+        all_combinations.append(item["result"] or {
+            "styleImageIndex": item["input"]["i"] + 1,
+            "contentImageIndex": item["input"]["j"] + 1,
+            "error": f"Failed to process: {item['error']}"
+        })
     
     # Final logging
-    print(f"[🎉] Successfully generated {len(all_combinations)} image combinations")
+    logger.info("Successfully generated %s image combinations", len(all_combinations))
     
     # Return the results
     return {
         "command": "mash:",
-        "total_images": total_images,
-        "expected_combinations": max_combinations,
+        "jobId": job.job_id,
+        "jobStatus": job.status,
+        "total_images": job.params["totalImages"],
+        "collapsed_duplicates": job.params["collapsedDuplicates"],
+        "pair_budget": job.params["pairBudget"],
+        "expected_combinations": len(job.items),
         "actual_combinations": len(all_combinations),
         "combinations": all_combinations
     }
-def find_and_mash_best_matches(prompt: str) -> Dict:
+
+@traced("match.mash")
+def find_and_mash_best_matches(session: Session, prompt: str) -> Dict:
     """
     Find two best matching images for the given prompt and mash them together
     
     Args:
+        session: The client's session
         prompt: User's prompt
         
     Returns:
         Result of the mash operation
     """
-    print(f"[🔍] Finding best matches for mash prompt: {prompt}")
+    logger.info("Finding best matches for mash prompt: %s", prompt)
     
     # Find the best matching image for style
-    style_match = find_best_matching_image("style " + prompt)
+    style_match = find_best_matching_image(session, "style " + prompt)
     
     # Find the best matching image for content
-    content_match = find_best_matching_image("content " + prompt)
+    content_match = find_best_matching_image(session, "content " + prompt)
     
     if not style_match or not content_match:
         return {"error": "Could not find suitable images to match the prompt"}
     
-    if style_match["instanceId"] == content_match["instanceId"]:
+    if style_match.instance_id == content_match.instance_id:
         # Try to find a different content match
-        second_match = find_second_best_matching_image("content " + prompt, exclude_id=style_match["instanceId"])
+        second_match = find_second_best_matching_image(session, "content " + prompt, exclude_id=style_match.instance_id)
         if second_match:
             content_match = second_match
     
@@ -684,8 +1043,8 @@ def find_and_mash_best_matches(prompt: str) -> Dict:
     }
     
     # Create enhanced mash prompt
-    style_desc = style_match.get("description", "unknown style")
-    content_desc = content_match.get("description", "unknown content")
+    style_desc = style_match.description or "unknown style"
+    content_desc = content_match.description or "unknown content"
     mash_prompt = f"Apply the style of '{style_desc}' to the content of '{content_desc}'"
     
     # Apply the mash operation with skip_upload=False to ensure upload to SOOT
@@ -693,12 +1052,13 @@ def find_and_mash_best_matches(prompt: str) -> Dict:
         content_match,  # Use content as base
         mash_prompt,
         source_images,
-        skip_upload=False
+        skip_upload=False,
+        command="mash"
     )
     
     # Add metadata about the matches
-    result["styleImageId"] = style_match["instanceId"]
-    result["contentImageId"] = content_match["instanceId"]
+    result["styleImageId"] = style_match.instance_id
+    result["contentImageId"] = content_match.instance_id
     result["styleImageDescription"] = style_desc
     result["contentImageDescription"] = content_desc
     
@@ -706,45 +1066,98 @@ def find_and_mash_best_matches(prompt: str) -> Dict:
 
 
 
-def handle_user_prompt(prompt: str):
+def estimate_command_cost(session: Session, parsed_command: Dict) -> Tuple[Dict[str, int], bool]:
+    """
+    Estimate the model usage of a command before running it (an upper bound:
+    cache hits and lexical matches make fewer calls)
+    
+    Args:
+        session: The client's session
+        parsed_command: Parsed command information
+        
+    Returns:
+        (cost from budget.estimate(), whether it is a batch command that scales with the session)
+    """
+    command_type = parsed_command["command_type"]
+    n = len(session.records())
+    if command_type == "mash":
+        mash_info = parsed_command.get("mash_info") or {}
+        if mash_info.get("is_empty"):
+            # mash-all: n*n-n generations, or the pair budget
+            all_pairs = n * n - n
+            budget = mash_info.get("budget")
+            budget = budget if budget is not None else MASH_ALL_PAIR_BUDGET
+            return estimate(generations=min(budget, all_pairs) if budget else all_pairs), True
+        # Explicit sources are looked up by index. Otherwise style, content and (if they coincide) a
+        # second content match may each score every image with the LLM when the lexical match is not decisive
+        return estimate(generations=1, text_calls=0 if mash_info.get("sources") else 3 * n), False
+    if command_type in ("tag", "describe"):
+        return estimate(text_calls=n), True
+    if command_type == "edit":
+        return estimate(generations=n), True
+    if command_type == "variation":
+        return estimate(generations=n * parse_variation_count(parsed_command.get("parameters", ""))), True
+    # Prompt: match the image (the LLM may score every image), then generate
+    return estimate(generations=1, text_calls=n), False
+
+def handle_user_prompt(prompt: str, session_id: Optional[str] = None):
     """
     Handle user prompt by parsing the command type and routing to appropriate handler
     
     Args:
         prompt: User's prompt
+        session_id: The client's session ID
         
     Returns:
         Result of the operation
     """
-    print(f"[🟡] Handling user prompt: {prompt}")
+    logger.info("Handling user prompt: %s", prompt)
+    
+    if not session_id:
+        return {"error": f"Missing {SESSION_HEADER} header; paste images first to get a session"}
+    session = get_session(session_id)
+    if session is None:
+        return {"error": "Unknown or expired session"}
     
     # Parse the user command
     parsed_command = parse_user_command(prompt)
-    
+    current_span().set_attribute("commandType", parsed_command["command_type"])
+    
+    # Admit the command only if its estimated model usage fits the budgets
+    cost, batch = estimate_command_cost(session, parsed_command)
+    ticket, rejection = budget_ledger.admit(session.session_id, parsed_command["command_type"], cost, batch)
+    if rejection:
+        return rejection
+    with ticket:
+        return _route_command(session, parsed_command)
+
+
+def _route_command(session: Session, parsed_command: Dict) -> Dict:
+    """Run a parsed command with the handler for its type"""
     # Route to the appropriate handler based on command type
     if parsed_command["command_type"] == "mash":
-        return handle_mash_command(parsed_command)
+        return handle_mash_command(session, parsed_command)
     
     # Handle tag commands
     elif parsed_command["command_type"] == "tag":
-        return handle_tag_command(parsed_command)
+        return handle_tag_command(session, parsed_command)
     
     # Handle describe commands
     elif parsed_command["command_type"] == "describe":
-        return handle_describe_command(parsed_command)
+        return handle_describe_command(session, parsed_command)
     
     # Handle edit commands
     elif parsed_command["command_type"] == "edit":
-        return handle_edit_command(parsed_command)
+        return handle_edit_command(session, parsed_command)
     
     # Handle variation commands
     elif parsed_command["command_type"] == "variation":
-        return handle_variation_command(parsed_command)
+        return handle_variation_command(session, parsed_command)
     
     # For standard prompts or unknown commands
     else:
         # Find the best matching image
-        best_match = find_best_matching_image(parsed_command["parameters"])
+        best_match = find_best_matching_image(session, parsed_command["parameters"])
         
         if not best_match:
             return {"error": "No suitable image found for the prompt"}
@@ -761,34 +1174,34 @@ def save_cache_to_disk():
         if not os.path.exists("cache"):
             os.makedirs("cache")
         
-        # Save current cache state (excluding imageBase64 to reduce file size)
+        # Save current cache state (images go to separate files to reduce file size)
         cache_to_save = {}
         with cache_lock:
-            for instance_id, record in description_cache.items():
-                # Create copy without imageBase64
-                record_copy = record.copy()
-                if "imageBase64" in record_copy:
-                    # Save image to separate file
-                    img_file = f"cache/{instance_id}.b64"
+            records = list(description_cache.values())
+        for record in records:
+            record_data = record.to_dict(include_image=False)
+            if record.image is not None:
+                # Images are named by content, so an image shared by several records is written once
+                img_file = f"cache/{record.image.digest}.b64"
+                if not os.path.exists(img_file):
                     with open(img_file, "w") as f:
-                        f.write(record_copy["imageBase64"])
-                    record_copy["imageBase64_file"] = img_file
-                    del record_copy["imageBase64"]
-                cache_to_save[instance_id] = record_copy
+                        f.write(record.image.base64)
+                record_data["imageBase64_file"] = img_file
+            cache_to_save[record.instance_id] = record_data
         
         # Save metadata
         with open("cache/metadata.json", "w") as f:
             json.dump(cache_to_save, f)
             
-        print(f"[💾] Cache saved to disk: {len(cache_to_save)} entries")
+        logger.info("Cache saved to disk: %s entries", len(cache_to_save))
     except Exception as e:
-        print(f"[❌] Failed to save cache: {e}")
+        logger.error("Failed to save cache: %s", e)
 
 def load_cache_from_disk():
     """Load cache from disk for persistence"""
     try:
         if not os.path.exists("cache/metadata.json"):
-            print("[ℹ️] No cache file found, starting with empty cache")
+            logger.info("No cache file found, starting with empty cache")
             return
             
         # Load metadata
@@ -797,33 +1210,30 @@ def load_cache_from_disk():
             
         # Load image data
         with cache_lock:
-            for instance_id, record in loaded_cache.items():
-                if "imageBase64_file" in record:
+            for instance_id, record_data in loaded_cache.items():
+                image = None
+                img_file = record_data.pop("imageBase64_file", None)
+                if img_file:
                     try:
-                        img_file = record["imageBase64_file"]
                         if os.path.exists(img_file):
                             with open(img_file, "r") as f:
-                                record["imageBase64"] = f.read()
-                        del record["imageBase64_file"]
+                                image = image_store.put(f.read())
                     except Exception as e:
-                        print(f"[⚠️] Failed to load image for {instance_id}: {e}")
+                        logger.warning("Failed to load image for %s: %s", instance_id, e)
                 
+                record = ImageRecord.from_dict(record_data, image=image)
                 description_cache[instance_id] = record
                 cache_last_access[instance_id] = time.time()
+                if record.perceptual_hash and record.duplicate_of is None:
+                    hash_index.add(instance_id, parse_hash(record.perceptual_hash))
                 
-        print(f"[📂] Loaded {len(description_cache)} entries from cache")
+        logger.info("Loaded %s entries from cache", len(description_cache))
     except Exception as e:
-        print(f"[❌] Failed to load cache: {e}")
-
-# Add function to generate unique filenames
-def generate_unique_filename(prefix: str, extension: str = "png") -> str:
-    """Generate unique filename to avoid conflicts"""
-    timestamp = int(time.time())
-    unique_id = str(uuid.uuid4())[:8]
-    return f"{prefix}_{timestamp}_{unique_id}.{extension}"
+        logger.error("Failed to load cache: %s", e)
 
- 
-def apply_operation_to_image(image_record: Dict, prompt: str, source_images: Dict = None, skip_upload: bool = False) -> Dict:
+@traced("apply_operation")
+def apply_operation_to_image(image_record: ImageRecord, prompt: str, source_images: Dict = None, skip_upload: bool = False,
+                             command: str = "prompt") -> Dict:
     """
     Apply the user's prompt operation to the selected image
     
@@ -832,109 +1242,67 @@ def apply_operation_to_image(image_record: Dict, prompt: str, source_images: Dic
         prompt: User's prompt for operation
         source_images: Optional dict of source images for mash operations
         skip_upload: If True, skip the SOOT upload step
+        command: Command type, selects the generation cache policy
         
     Returns:
         Updated image record with results
     """
-    print(f"[🔧] Applying operation to image: {image_record['instanceId'][:6]}")
+    operation_span = current_span()
+    operation_span.set_attribute("instanceId", image_record.instance_id)
+    operation_span.set_attribute("sources", len(source_images or {}))
+    operation_span.set_attribute("skipUpload", skip_upload)
+    start = time.perf_counter()
+    result = _apply_operation_to_image(image_record, prompt, source_images, skip_upload, command)
+    operation_span.set_attribute("fromCache", bool(result.get("fromCache")))
+    if "error" in result:
+        operation_span.set_attribute("error", result["error"])
+    OPERATION_SECONDS.observe(time.perf_counter() - start, outcome="error" if "error" in result else "ok")
+    return result
+
+def _apply_operation_to_image(image_record: ImageRecord, prompt: str, source_images: Dict = None, skip_upload: bool = False,
+                              command: str = "prompt") -> Dict:
+    """Generate the operation result for apply_operation_to_image"""
+    item_logger.info("Applying operation to image: %s", image_record.instance_id[:6])
     
     # Get image data
-    image_base64 = image_record.get("imageBase64", "")
-    if not image_base64:
-        print("[⚠️] No image data available")
-        return image_record
+    if not image_record.image_base64:
+        logger.warning("No image data available")
+        return image_record.to_dict()
     
     try:
-        # Decode image
-        image_bytes = base64.b64decode(image_base64)
-        metadata = image_record.get("metadata", {})
-        
-        # Force MIME type to JPEG regardless of what it's detected as
-        # This avoids the "Unsupported MIME type" error
-        mime_type = "image/jpeg"
-        print(f"[🔍] Using fixed MIME type: {mime_type} instead of auto-detection")
-        
-        # Use the provided prompt directly
-        enhanced_prompt = prompt
+        item_logger.debug("Using prompt: %s", prompt)
         
-        print(f"[✏️] Using prompt: {enhanced_prompt}")
-        
-        # Use image generation model
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_IMAGE_MODEL_NAME}:generateContent?key={GEMINI_API_KEY}"
-        
-        # Prepare parts for the request
-        parts = []
-        
-        # First add the main image
-        parts.append({
-            "inlineData": {
-                "mimeType": mime_type,
-                "data": image_base64
-            }
-        })
-        
-        # Add source images for mash operations
-        if source_images:
-            for feature, source_image in source_images.items():
-                if feature != "base" and "imageBase64" in source_image:
-                    # Also force MIME type for source images
-                    print(f"[🔍] Using fixed MIME type for source image {feature}: image/jpeg")
-                    
-                    parts.append({
-                        "inlineData": {
-                            "mimeType": "image/jpeg",
-                            "data": source_image["imageBase64"]
-                        }
-                    })
+        # Identical earlier requests (same images, prompt and config) may be served from the cache
+        cache_key = None
+        if generation_cache.enabled:
+            cache_key = generation_cache.key(GEMINI_IMAGE_MODEL_NAME, image_record, source_images, prompt, IMAGE_GENERATION_CONFIG)
+        outputs = generation_cache.get(cache_key, command) if cache_key else None
+        from_cache = outputs is not None
         
-        # Add the text prompt at the end
-        parts.append({
-            "text": enhanced_prompt
-        })
-        
-        # Format payload
-        payload = {
-            "contents": [
-                {
-                    "parts": parts
+        if not from_cache:
+            # Prepare parts for the request (base image, mash sources, prompt)
+            parts = build_operation_parts(image_record, prompt, source_images)
+            
+            # Send request through the rate-limited scheduler (retries 429s with backoff)
+            try:
+                result_json = generate_content(GEMINI_IMAGE_MODEL_NAME, parts, IMAGE_GENERATION_CONFIG,
+                                               priority=PRIORITY_INTERACTIVE)
+            except GeminiRequestError as e:
+                logger.error("Image generation failed: %s", e)
+                return {
+                    "originalInstanceId": image_record.instance_id,
+                    "prompt": prompt,
+                    "error": str(e)
                 }
-            ],
-            "generationConfig": {
-                "temperature": 0.4,
-                "topK": 32,
-                "topP": 1,
-                "response_modalities": ["TEXT", "IMAGE"],
-                "maxOutputTokens": 2048
-            }
-        }
-        
-        # Send request
-        headers = {
-            "Content-Type": "application/json"
-        }
-        response = requests.post(url, headers=headers, json=payload)
-        
-        # Check for errors
-        if response.status_code != 200:
-            print(f"[❌] API error: {response.status_code}")
-            print(f"[❌] Error details: {response.text}")
-            return {
-                "originalInstanceId": image_record["instanceId"],
-                "prompt": prompt,
-                "error": f"API error: {response.status_code}"
-            }
-        
-        # Parse response
-        result_json = response.json()
-        
-        # Save full response for debugging with unique name
-        debug_filename = generate_unique_filename(f"gemini_response_{image_record['instanceId'][:6]}", "json")
-        with open(debug_filename, "w") as f:
-            json.dump(result_json, f, indent=2)
+            
+            save_debug_response(result_json, image_record)
+            outputs = extract_generated_outputs(result_json)
+            if cache_key:
+                generation_cache.put(cache_key, outputs)
         
         # Result to return
         result = {
-            "originalInstanceId": image_record["instanceId"],
+            "originalInstanceId": image_record.instance_id,
             "prompt": prompt,
             "originalPrompt": prompt,
             "result": {}
@@ -945,87 +1313,53 @@ def apply_operation_to_image(image_record: Dict, prompt: str, source_images: Dic
             result["mashSources"] = {}
             for feature, source_image in source_images.items():
                 result["mashSources"][feature] = {
-                    "instanceId": source_image["instanceId"],
-                    "description": source_image.get("description", "")
+                    "instanceId": source_image.instance_id,
+                    "description": source_image.description
                 }
         
+        if from_cache:
+            result["fromCache"] = True
+            item_logger.info("Reusing cached generation for %s", image_record.instance_id[:6])
+        
         # Extract image data from response
-        if 'candidates' in result_json and result_json['candidates']:
-            for candidate in result_json['candidates']:
-                if 'content' in candidate and 'parts' in candidate['content']:
-                    for part in candidate['content']['parts']:
-                        # Check for image data
-                        if 'inlineData' in part and 'data' in part['inlineData']:
-                            # Image data is Base64 encoded
-                            generated_image_base64 = part['inlineData']['data']
-                            result["result"]["imageBase64"] = generated_image_base64
-                            print("[✅] Generated new image successfully")
-                            
-                            # Save the generated image to local file with unique name
-                            try:
-                                image_data = base64.b64decode(generated_image_base64)
-                                
-                                # Generate unique filename
-                                original_id = image_record["instanceId"][:6]
-                                safe_prompt = "".join(c for c in prompt[:20] if c.isalnum() or c.isspace()).replace(" ", "_")
-                                filename = generate_unique_filename(f"generated_{original_id}_{safe_prompt}")
-                                
-                                # Save image
-                                with open(filename, "wb") as f:
-                                    f.write(image_data)
-                                print(f"[💾] Saved generated image to {filename}")
-                                
-                                # Add the local filename to the result
-                                result["localFilename"] = filename
-                                
-                                # Only upload if not skipped
-                                if not skip_upload:
-                                    # Upload to SOOT
-                                    space_id = image_record.get("metadata", {}).get("spaceId")
-                                    if space_id:
-                                        print(f"[🔄] Uploading generated image to SOOT space: {space_id}")
-                                        
-                                        # Upload the generated image
-                                        upload_result = upload_image_to_soot(
-                                            image_data=generated_image_base64,
-                                            space_id=space_id,
-                                            is_base64=True,
-                                            verbose=True
-                                        )
-                                        
-                                        # Store upload result
-                                        result["sootUploadResult"] = upload_result
-                                        
-                                        if upload_result["success"]:
-                                            print(f"[✅] Generated image successfully uploaded to SOOT")
-                                        else:
-                                            print(f"[❌] Failed to upload generated image: {upload_result['message']}")
-                                else:
-                                    print("[ℹ️] Skipping SOOT upload as requested")
-                                
-                            except Exception as e:
-                                print(f"[❌] Error saving/uploading image: {e}")
-                                import traceback
-                                traceback.print_exc()
-                        
-                        # If there is text response
-                        if 'text' in part:
-                            result["result"]["description"] = part['text']
-                            print(f"[📝] Generation description: {part['text'][:100]}...")
+        for output in outputs:
+            generated_image_base64 = output.get("imageBase64")
+            if generated_image_base64:
+                result["result"]["imageBase64"] = generated_image_base64
+                item_logger.info("Generated new image successfully")
+                
+                try:
+                    # Save the generated image to local file with unique name (already saved if cached)
+                    if not from_cache:
+                        result["localFilename"] = save_generated_image(generated_image_base64, image_record, prompt)
+                    
+                    # Only upload if not skipped (an image already uploaded to the space is not uploaded again)
+                    if not skip_upload:
+                        upload_result = upload_generated_image(generated_image_base64, image_record)
+                        if upload_result is not None:
+                            result["sootUploadResult"] = upload_result
+                    else:
+                        item_logger.debug("Skipping SOOT upload as requested")
+                    
+                except Exception as e:
+                    logger.exception("Error saving/uploading image: %s", e)
+            
+            # If there is text response
+            if "description" in output:
+                result["result"]["description"] = output["description"]
+                item_logger.debug("Generation description: %s...", output['description'][:100])
         
         # Add all the original image metadata to preserve context
-        result["originalMetadata"] = image_record.get("metadata", {})
-        result["originalDescription"] = image_record.get("description", "")
-        result["originalTags"] = image_record.get("tags", [])
+        result["originalMetadata"] = image_record.metadata
+        result["originalDescription"] = image_record.description
+        result["originalTags"] = list(image_record.tags)
         
         return result
     
     except Exception as e:
-        print(f"[❌] Error applying operation: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error applying operation: %s", e)
         return {
-            "originalInstanceId": image_record["instanceId"],
+            "originalInstanceId": image_record.instance_id,
             "prompt": prompt,
             "error": str(e)
         }
@@ -1033,7 +1367,7 @@ def apply_operation_to_image(image_record: Dict, prompt: str, source_images: Dic
 # Add initialization code to load cache at startup
 def initialize_system():
     """Initialize the system, load cache, and set up background tasks"""
-    print("[🚀] Initializing system...")
+    logger.info("Initializing system...")
     
     # Load existing cache from disk
     load_cache_from_disk()
@@ -1043,62 +1377,68 @@ def initialize_system():
         while True:
             time.sleep(300)  # Save every 5 minutes
             save_cache_to_disk()
-            print("[⏲️] Performed periodic cache save")
+            logger.info("Performed periodic cache save")
+            expire_idle_sessions()
     
     # Start background thread for periodic tasks
     background_thread = threading.Thread(target=periodic_cache_save, daemon=True)
     background_thread.start()
     
-    print("[✅] System initialized successfully")
+    # Finish batch jobs a restart interrupted
+    if JOB_RESUME_ON_START:
+        threading.Thread(target=resume_interrupted_jobs, daemon=True).start()
+    
+    logger.info("System initialized successfully")
 
-# Call initialization at module import time
-# Make sure this is at the end of the file
-if __name__ != "__main__":  # Only when imported, not when run directly
-    initialize_system()
 
-def handle_tag_command(parsed_command: Dict) -> Dict:
+def _store_updated_records(records: List[ImageRecord], session: Session):
+    """Write updated records to the session and the persistent cache in one batch"""
+    if not records:
+        return
+    session.update_many(records)
+    with cache_lock:
+        for record in records:
+            description_cache[record.instance_id] = record
+
+
+@traced()
+def handle_tag_command(session: Session, parsed_command: Dict) -> Dict:
     """
     Handle tag command by generating specialized tags for all images based on the user's prompt.
     This creates a separate set of user tags while preserving the original system tags.
     
     Args:
+        session: The client's session
         parsed_command: Parsed command information
         
     Returns:
         Result of the operation with updated images
     """
-    print(f"[🏷️] Processing tag command: {parsed_command}")
+    logger.info("Processing tag command: %s", parsed_command)
     
     parameters = parsed_command.get("parameters", "").strip()
     
-    # Get all images from current session
-    with cache_lock:
-        all_images = list(current_session_cache.values())
+    # Get all images from the client's session
+    all_images = session.records()
         
     if not all_images:
         return {"error": "No images available in current session"}
     
     total_images = len(all_images)
-    print(f"[🏷️] Generating user tags for {total_images} images with prompt: '{parameters}'")
+    logger.info("Generating user tags for %s images with prompt: '%s'", total_images, parameters)
     
-    # Prepare array to store all updated images
-    updated_images = []
-    
-    for i, image in enumerate(all_images):
+    def tag_image(i: int, image: ImageRecord) -> Optional[Tuple[ImageRecord, Dict]]:
         try:
             # Get image data
-            image_base64 = image.get("imageBase64", "")
+            image_base64 = image.image_base64
             if not image_base64:
-                print(f"[⚠️] No image data available for image {i+1}")
-                continue
+                logger.warning("No image data available for image %s", i+1)
+                return None
             
             # Keep system tags
-            system_tags = image.get("tags", [])
+            system_tags = image.tags
             
-            # Decode image for processing
-            image_bytes = base64.b64decode(image_base64)
-            metadata = image.get("metadata", {})
-            mime_type = mimetypes.guess_type(metadata.get("filename", "") or "")[0] or "image/png"
+            mime_type = mimetypes.guess_type(image.filename)[0] or "image/png"
             
             # Determine which prompt to use based on parameters
             if parameters:
@@ -1109,12 +1449,12 @@ def handle_tag_command(parsed_command: Dict) -> Dict:
                 prompt_text = "Generate 8-12 detailed, lowercase tags that thoroughly describe this image. Include tags for: 1) Visual style (e.g., portrait, landscape, abstract), 2) Technical aspects (saturation level, contrast level, black and white if applicable), 3) Subject matter and content, 4) Mood or emotion, 5) Composition, 6) Lighting conditions, 7) Color palette. Return only a JSON array of string tags."
             
             # Generate tags using the appropriate prompt
-            response = model.generate_content([
-                {"mime_type": mime_type, "data": image_bytes},
+            response = generate_content(GEMINI_MODEL_NAME, [
+                {"inlineData": {"mimeType": mime_type, "data": image_base64}},
                 {"text": prompt_text}
-            ])
+            ], priority=PRIORITY_INTERACTIVE)
             
-            tags_text = response.text.strip()
+            tags_text = response_text(response).strip()
             
             # Handle if the response comes in a code block format
             if "```json" in tags_text:
@@ -1127,45 +1467,41 @@ def handle_tag_command(parsed_command: Dict) -> Dict:
             if tags_text.startswith("["):
                 try:
                     user_tags = json.loads(tags_text)
-                    print(f"[🏷️] User tags generated for image {i+1}: {user_tags}")
+                    item_logger.debug("User tags generated for image %s: %s", i+1, user_tags)
                 except json.JSONDecodeError as e:
-                    print(f"[⚠️] JSON decode error for image {i+1}: {e}")
+                    logger.warning("JSON decode error for image %s: %s", i+1, e)
                     # Extract tags manually as fallback
                     potential_tags = re.findall(r'"([^"]*)"', tags_text)
                     if potential_tags:
-                        print(f"[🏷️] Tags extracted manually for image {i+1}: {potential_tags}")
+                        item_logger.debug("Tags extracted manually for image %s: %s", i+1, potential_tags)
                         user_tags = potential_tags
             else:
-                print(f"[⚠️] Tag format unexpected for image {i+1}: {tags_text}")
+                logger.warning("Tag format unexpected for image %s: %s", i+1, tags_text)
             
-            # Update the image record with both sets of tags
-            updated_image = image.copy()
-            updated_image["system_tags"] = system_tags  # Original system-generated tags
-            updated_image["user_tags"] = user_tags     # New user-command generated tags
+            # Update the image record with both sets of tags; the original tags
+            # field stays unchanged so code that uses tags still works
+            updated_image = replace(image, system_tags=system_tags, user_tags=user_tags)
             
-            # For backward compatibility, keep the original tags field unchanged
-            # This ensures existing code that uses tags[] still works
-            updated_image["tags"] = system_tags
+            item_logger.info("Added user tags for image %s/%s", i+1, total_images)
             
-            # Update the cache
-            with cache_lock:
-                instance_id = image.get("instanceId")
-                if instance_id:
-                    current_session_cache[instance_id] = updated_image
-                    description_cache[instance_id] = updated_image
-            
-            # Add to results - include both sets of tags
-            updated_images.append({
-                "instanceId": instance_id,
-                "system_tags": system_tags,
+            # Result entry - include both sets of tags
+            return updated_image, {
+                "instanceId": image.instance_id,
+                "system_tags": list(system_tags),
                 "user_tags": user_tags,
-                "description": image.get("description", "")
-            })
-            
-            print(f"[✅] Added user tags for image {i+1}/{total_images}")
+                "description": image.description
+            }
             
         except Exception as e:
-            print(f"[❌] Error updating tags for image {i+1}: {e}")
+            logger.error("Error updating tags for image %s: %s", i+1, e)
+            return None
+    
+    # Tag images concurrently; results stay in image index order
+    outcomes = [outcome for outcome in run_bulk(all_images, tag_image) if outcome]
+    updated_images = [entry for _, entry in outcomes]
+    
+    # Write all cache updates in one batch
+    _store_updated_records([record for record, _ in outcomes], session)
     
     # Return the results
     return {
@@ -1176,49 +1512,44 @@ def handle_tag_command(parsed_command: Dict) -> Dict:
     }
 
 
-def handle_describe_command(parsed_command: Dict) -> Dict:
+@traced()
+def handle_describe_command(session: Session, parsed_command: Dict) -> Dict:
     """
     Handle describe command by generating specialized descriptions for all images based on the user's prompt.
     This creates a separate set of user descriptions while preserving the original system descriptions.
     
     Args:
+        session: The client's session
         parsed_command: Parsed command information
         
     Returns:
         Result of the operation with updated images
     """
-    print(f"[📝] Processing description command: {parsed_command}")
+    logger.info("Processing description command: %s", parsed_command)
     
     parameters = parsed_command.get("parameters", "").strip()
     
-    # Get all images from current session
-    with cache_lock:
-        all_images = list(current_session_cache.values())
+    # Get all images from the client's session
+    all_images = session.records()
         
     if not all_images:
         return {"error": "No images available in current session"}
     
     total_images = len(all_images)
-    print(f"[📝] Generating user descriptions for {total_images} images with prompt: '{parameters}'")
-    
-    # Prepare array to store all updated images
-    updated_images = []
+    logger.info("Generating user descriptions for %s images with prompt: '%s'", total_images, parameters)
     
-    for i, image in enumerate(all_images):
+    def describe_image(i: int, image: ImageRecord) -> Optional[Tuple[ImageRecord, Dict]]:
         try:
             # Get image data
-            image_base64 = image.get("imageBase64", "")
+            image_base64 = image.image_base64
             if not image_base64:
-                print(f"[⚠️] No image data available for image {i+1}")
-                continue
+                logger.warning("No image data available for image %s", i+1)
+                return None
             
             # Keep system description
-            system_description = image.get("description", "")
+            system_description = image.description
             
-            # Decode image for processing
-            image_bytes = base64.b64decode(image_base64)
-            metadata = image.get("metadata", {})
-            mime_type = mimetypes.guess_type(metadata.get("filename", "") or "")[0] or "image/png"
+            mime_type = mimetypes.guess_type(image.filename)[0] or "image/png"
             
             # Determine which prompt to use based on parameters
             if parameters:
@@ -1229,42 +1560,38 @@ def handle_describe_command(parsed_command: Dict) -> Dict:
                 prompt_text = "Describe this image in detail (2-3 sentences), focusing on both content and style. Mention: 1) The main subjects/people, 2) The photographic or artistic style (e.g., portrait, landscape, abstract, vintage, minimalist), 3) Any notable visual characteristics (e.g., black and white, vibrant colors, blurry, sharp focus). Be specific about what's visible in the image. Describe this image in exceptional detail, focusing on the main subject, visual style, composition, colors, textures, lighting, mood, and artistic characteristics. Be comprehensive but maintain the essence of the image. Provide a description that could be used as a prompt to recreate this image."
             
             # Generate description using the appropriate prompt
-            response = model.generate_content([
-                {"mime_type": mime_type, "data": image_bytes},
+            response = generate_content(GEMINI_MODEL_NAME, [
+                {"inlineData": {"mimeType": mime_type, "data": image_base64}},
                 {"text": prompt_text}
-            ])
-            
-            user_description = response.text.strip()
-            print(f"[📝] User description generated for image {i+1}: {user_description}")
+            ], priority=PRIORITY_INTERACTIVE)
             
-            # Update the image record with both descriptions
-            updated_image = image.copy()
-            updated_image["system_description"] = system_description  # Original system-generated description
-            updated_image["user_description"] = user_description      # New user-command generated description
+            user_description = response_text(response).strip()
+            item_logger.debug("User description generated for image %s: %s", i+1, user_description)
             
-            # For backward compatibility, keep the original description field unchanged
-            # This ensures existing code that uses description still works
-            updated_image["description"] = system_description
+            # Update the image record with both descriptions; the original description
+            # field stays unchanged so code that uses description still works
+            updated_image = replace(image, system_description=system_description, user_description=user_description)
             
-            # Update the cache
-            with cache_lock:
-                instance_id = image.get("instanceId")
-                if instance_id:
-                    current_session_cache[instance_id] = updated_image
-                    description_cache[instance_id] = updated_image
+            item_logger.info("Added user description for image %s/%s", i+1, total_images)
             
-            # Add to results - include both descriptions
-            updated_images.append({
-                "instanceId": instance_id,
+            # Result entry - include both descriptions
+            return updated_image, {
+                "instanceId": image.instance_id,
                 "system_description": system_description,
                 "user_description": user_description,
-                "tags": image.get("tags", [])
-            })
-            
-            print(f"[✅] Added user description for image {i+1}/{total_images}")
+                "tags": list(image.tags)
+            }
             
         except Exception as e:
-            print(f"[❌] Error updating description for image {i+1}: {e}")
+            logger.error("Error updating description for image %s: %s", i+1, e)
+            return None
+    
+    # Describe images concurrently; results stay in image index order
+    outcomes = [outcome for outcome in run_bulk(all_images, describe_image) if outcome]
+    updated_images = [entry for _, entry in outcomes]
+    
+    # Write all cache updates in one batch
+    _store_updated_records([record for record, _ in outcomes], session)
     
     # Return the results
     return {
@@ -1275,62 +1602,60 @@ def handle_describe_command(parsed_command: Dict) -> Dict:
     }
 
 
-def handle_edit_command(parsed_command: Dict) -> Dict:
+@traced()
+def handle_edit_command(session: Session, parsed_command: Dict) -> Dict:
     """
     Handle edit command by modifying images according to the user's instructions.
     
     Args:
+        session: The client's session
         parsed_command: Parsed command information
         
     Returns:
         Result of the operation with edited images
     """
-    print(f"[✏️] Processing edit command: {parsed_command}")
+    logger.info("Processing edit command: %s", parsed_command)
     
     parameters = parsed_command.get("parameters", "").strip()
     
     if not parameters:
         return {"error": "Edit command requires specific instructions. Please use 'edit: your instructions'."}
     
-    # Get all images from current session
-    with cache_lock:
-        all_images = list(current_session_cache.values())
+    # Get all images from the client's session
+    all_images = session.records()
         
     if not all_images:
         return {"error": "No images available in current session"}
     
     total_images = len(all_images)
-    print(f"[✏️] Editing {total_images} images with instructions: '{parameters}'")
-    
-    # Prepare array to store all edited images
-    edited_images = []
+    logger.info("Editing %s images with instructions: '%s'", total_images, parameters)
     
-    for i, image in enumerate(all_images):
+    def edit_image(i: int, image: ImageRecord) -> Optional[Dict]:
         try:
             # Get image data
-            image_base64 = image.get("imageBase64", "")
-            if not image_base64:
-                print(f"[⚠️] No image data available for image {i+1}")
-                continue
+            if not image.image_base64:
+                logger.warning("No image data available for image %s", i+1)
+                return None
             
-            print(f"[✏️] Applying edit to image {i+1}/{total_images}: '{parameters}'")
+            item_logger.info("Applying edit to image %s/%s: '%s'", i+1, total_images, parameters)
             
             # Apply the edit operation using the existing apply_operation_to_image function
             # Ensure upload to SOOT by setting skip_upload=False
-            result = apply_operation_to_image(image, f"Edit this image: {parameters}", skip_upload=False)
-            
-            # Add to results
-            edited_images.append(result)
+            result = apply_operation_to_image(image, f"Edit this image: {parameters}", skip_upload=False, command="edit")
             
-            print(f"[✅] Completed edit for image {i+1}/{total_images}")
+            item_logger.info("Completed edit for image %s/%s", i+1, total_images)
+            return result
             
         except Exception as e:
-            print(f"[❌] Error editing image {i+1}: {e}")
-            edited_images.append({
-                "originalInstanceId": image.get("instanceId"),
+            logger.error("Error editing image %s: %s", i+1, e)
+            return {
+                "originalInstanceId": image.instance_id,
                 "prompt": f"Edit this image: {parameters}",
                 "error": str(e)
-            })
+            }
+    
+    # Edit images concurrently; results stay in image index order
+    edited_images = [result for result in run_bulk(all_images, edit_image) if result]
     
     # Return the results
     return {
@@ -1341,37 +1666,41 @@ def handle_edit_command(parsed_command: Dict) -> Dict:
     }
 
 
-def handle_variation_command(parsed_command: Dict) -> Dict:
+def parse_variation_count(parameters: str) -> int:
+    """Number of variations per image requested by 'variation:[n]' (1 if not specified)"""
+    variation_count = 1  # Default to 1 variation if not specified
+    number_match = re.search(r'\[(\d+)\]', parameters)
+    if number_match:
+        try:
+            variation_count = int(number_match.group(1))
+            # Limit to a reasonable number to prevent abuse
+            variation_count = min(max(1, variation_count), VARIATION_MAX_COUNT)
+        except ValueError:
+            pass
+    return variation_count
+
+@traced()
+def handle_variation_command(session: Session, parsed_command: Dict) -> Dict:
     """
     Handle variation command by generating a specified number of variations for each image.
     The command format is 'variation:[n]' where n is the number of variations to generate.
     
     Args:
+        session: The client's session
         parsed_command: Parsed command information
         
     Returns:
         Result of the operation with generated variations
     """
-    print(f"[🔄] Processing variation command: {parsed_command}")
+    logger.info("Processing variation command: %s", parsed_command)
     
     parameters = parsed_command.get("parameters", "").strip()
     
-    # Extract the number of variations from the command (format: variation:[n])
-    variation_count = 1  # Default to 1 variation if not specified
-    number_match = re.search(r'\[(\d+)\]', parameters)
-    if number_match:
-        try:
-            variation_count = int(number_match.group(1))
-            # Limit to a reasonable number to prevent abuse
-            variation_count = min(max(1, variation_count), 5)
-        except ValueError:
-            pass
-    
-    print(f"[🔄] Generating {variation_count} variations for each image")
+    variation_count = parse_variation_count(parameters)
+    logger.info("Generating %s variations for each image", variation_count)
     
-    # Get all images from current session
-    with cache_lock:
-        all_images = list(current_session_cache.values())
+    # Get all images from the client's session
+    all_images = session.records()
         
     if not all_images:
         return {"error": "No images available in current session"}
@@ -1379,62 +1708,135 @@ def handle_variation_command(parsed_command: Dict) -> Dict:
     total_images = len(all_images)
     total_variations = total_images * variation_count
     
-    print(f"[🔄] Processing {total_images} source images to create {total_variations} variations")
+    logger.info("Processing %s source images to create %s variations", total_images, total_variations)
     
-    # Prepare array to store all variations
+    # Every source image is a job item, so a restart or a retry never repeats finished variations
+    job = job_store.create(
+        "variation",
+        session.session_id,
+        {"count": variation_count, "totalImages": total_images},
+        list(all_images),
+        [(image.instance_id, {"instanceId": image.instance_id, "index": i}) for i, image in enumerate(all_images)],
+    )
+    # Images are processed concurrently; variations stay in image, then variation, order
+    run_job(job, run_items=run_bulk)
+    return _variation_response(job)
+
+def _run_variation_item(job: Job, item: Dict, previous: Optional[List[Dict]]) -> Tuple[List[Dict], Optional[str]]:
+    """Generate the variations of one image that are still missing (all of them on the first run)"""
+    i, count = item["index"], job.params["count"]
+    image = job.image(item["instanceId"])
+    if image is None or not image.image_base64:
+        logger.warning("No image data available for image %s", i+1)
+        return [], "No image data available"
+    
+    # Keep the variations that succeeded earlier; only the missing ones are generated
+    variations = [variation for variation in previous or [] if "error" not in variation]
+    missing = count - len(variations)
+    if missing > 0:
+        item_logger.info("Generating %s variations for image %s/%s", missing, i+1, job.params["totalImages"])
+        # Ensure upload to SOOT by setting skip_upload=False
+        variations += generate_variations(image, missing, GEMINI_IMAGE_MODEL_NAME, skip_upload=False)
+    
+    for number, variation in enumerate(variations, 1):
+        variation["variationNumber"] = number
+        variation["totalVariations"] = count
+    errors = [variation["error"] for variation in variations if "error" in variation]
+    return variations, errors[0] if errors else None
+
+def _variation_response(job: Job) -> Dict:
+    """The variation:[n] response for a job, in image, then variation, order"""
     all_variations = []
-    
-    for i, image in enumerate(all_images):
-        image_variations = []
-        
-        try:
-            # Get image data
-            image_base64 = image.get("imageBase64", "")
-            if not image_base64:
-                print(f"[⚠️] No image data available for image {i+1}")
-                continue
-            
-            print(f"[🔄] Generating {variation_count} variations for image {i+1}/{total_images}")
-            
-            # Generate variations for this image
-            for v in range(variation_count):
-                try:
-                    # Create variation prompt 
-                    variation_prompt = f"Create a visually distinctive variation of this image with different composition, lighting, or style. Variation {v+1} of {variation_count}."
-                    
-                    # Apply the operation to create variation - ensure upload to SOOT by setting skip_upload=False
-                    result = apply_operation_to_image(image, variation_prompt, skip_upload=False)
-                    
-                    # Add metadata for tracking
-                    result["sourceImageId"] = image.get("instanceId")
-                    result["variationNumber"] = v + 1
-                    result["totalVariations"] = variation_count
-                    
-                    # Add to results
-                    image_variations.append(result)
-                    all_variations.append(result)
-                    
-                    print(f"[✅] Completed variation {v+1}/{variation_count} for image {i+1}/{total_images}")
-                    
-                except Exception as e:
-                    print(f"[❌] Error creating variation {v+1} for image {i+1}: {e}")
-                    error_result = {
-                        "sourceImageId": image.get("instanceId"),
-                        "variationNumber": v + 1,
-                        "totalVariations": variation_count,
-                        "error": f"Failed to create variation: {str(e)}"
-                    }
-                    image_variations.append(error_result)
-                    all_variations.append(error_result)
-            
-        except Exception as e:
-            print(f"[❌] Error processing variations for image {i+1}: {e}")
-    
-    # Return the results
+    for _, item in job_store.results(job):
+        if item["result"]:
+            all_variations.extend(item["result"])
+        elif item["status"] != PENDING:
+            all_variations.append({
+                "sourceImageId": item["input"]["instanceId"],
+                "totalVariations": job.params["count"],
+                "error": f"Failed to create variation: {item['error']}"
+            })
     return {
-        "command": f"variation:[{variation_count}]",
-        "total_source_images": total_images,
-        "variation_count": variation_count,
+        "command": f"variation:[{job.params['count']}]",
+        "jobId": job.job_id,
+        "jobStatus": job.status,
+        "total_source_images": job.params["totalImages"],
+        "variation_count": job.params["count"],
         "total_variations": len(all_variations),
         "variations": all_variations
-    }
\ No newline at end of file
+    }
+
+register_runner("mash_all", _run_mash_item)
+register_runner("variation", _run_variation_item)
+
+_JOB_RESPONSES = {"mash_all": _mash_all_response, "variation": _variation_response}
+
+def _session_job(job_id: str, session_id: str) -> Optional[Job]:
+    """A job, if it belongs to the session (other sessions' jobs are reported as unknown)"""
+    job = job_store.get(job_id)
+    return job if job is not None and job.session_id == session_id else None
+
+def get_job_results(job_id: str, session_id: str) -> Dict:
+    """Current results of one of the session's batch jobs (complete once its status is no longer running)"""
+    job = _session_job(job_id, session_id)
+    if job is None:
+        return {"error": "Unknown job"}
+    response = _JOB_RESPONSES[job.kind](job)
+    # Where each uploaded image stands in SOOT, by upload intent
+    with job.lock:
+        response["uploads"] = dict(job.uploads)
+    return response
+
+def get_job_events(job_id: str, session_id: str) -> Optional[AsyncIterator[str]]:
+    """Progress stream of one of the session's jobs (None for an unknown job)"""
+    job = _session_job(job_id, session_id)
+    return stream_job_events(job) if job is not None else None
+
+def list_jobs(session_id: str) -> List[Dict]:
+    return [job.summary() for job in job_store.list(session_id)]
+
+@traced()
+def retry_failed_job_items(job_id: str, session_id: str) -> Dict:
+    """
+    Re-run only the failed items of a finished job; items that succeeded are never repeated
+    
+    Args:
+        job_id: The job's ID
+        session_id: Session asking for the retry (only its own jobs can be retried)
+        
+    Returns:
+        The job's results after the retry
+    """
+    job = _session_job(job_id, session_id)
+    if job is None:
+        return {"error": "Unknown job"}
+    if job.status == "running":
+        return {"error": "Job is still running"}
+    with job.lock:
+        failed = [item for item in job.items.values() if item["status"] == "failed"]
+    if not failed:
+        return get_job_results(job_id, session_id)
+    
+    # A retry is admitted like the command that started the job, for the generations still missing
+    if job.kind == "variation":
+        generations = sum(job.params["count"] - len([v for v in item["result"] or [] if "error" not in v]) for item in failed)
+    else:
+        generations = len(failed)
+    ticket, rejection = budget_ledger.admit(job.session_id, job.kind, estimate(generations=generations), batch=True)
+    if rejection:
+        return rejection
+    with ticket:
+        retried = job_store.reset_failed(job)
+        logger.info("Retrying %s failed item(s) of job %s", retried, job_id[:8])
+        if retried:
+            run_job(job, run_items=run_bulk if job.kind == "variation" else None)
+    return get_job_results(job_id, session_id)
+
+def get_budget_report(session_id: Optional[str] = None) -> Dict:
+    """Model usage against the global budget and the session's, over the budget window"""
+    return budget_ledger.report(session_id)
+
+# Call initialization at module import time
+# Make sure this is at the end of the file
+if __name__ != "__main__":  # Only when imported, not when run directly
+    initialize_system()
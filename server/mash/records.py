@@ -0,0 +1,118 @@
+import sys
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from .image_store import ImageRef, image_store
+
+
+def intern_tags(tags: Optional[Iterable[Any]]) -> Tuple[str, ...]:
+    """Tags as a tuple of interned strings, so repeated tags share one object"""
+    return tuple(sys.intern(str(tag)) for tag in tags or ())
+
+
+@dataclass(frozen=True, slots=True)
+class ImageRecord:
+    """
+    A cached image and its enrichment.
+
+    Records are immutable (session snapshots share them); use
+    dataclasses.replace() to derive an updated record. The image itself is
+    held by reference to the shared image store.
+    """
+
+    instance_id: str
+    metadata: Dict[str, Any]
+    image: Optional[ImageRef] = None
+    description: str = ""
+    tags: Tuple[str, ...] = ()
+    system_tags: Optional[Tuple[str, ...]] = None
+    user_tags: Optional[Tuple[str, ...]] = None
+    system_description: Optional[str] = None
+    user_description: Optional[str] = None
+    enrichment_error: Optional[str] = None
+    perceptual_hash: Optional[str] = None  # Hex dHash, see perceptual_hash.py
+    duplicate_of: Optional[str] = None  # instanceId whose enrichment this record reuses
+
+    def __post_init__(self):
+        # Frozen dataclass: normalise through object.__setattr__
+        object.__setattr__(self, "tags", intern_tags(self.tags))
+        if self.system_tags is not None:
+            object.__setattr__(self, "system_tags", intern_tags(self.system_tags))
+        if self.user_tags is not None:
+            object.__setattr__(self, "user_tags", intern_tags(self.user_tags))
+
+    @property
+    def image_base64(self) -> str:
+        return self.image.base64 if self.image else ""
+
+    @property
+    def image_size(self) -> int:
+        return self.image.size if self.image else 0
+
+    @property
+    def space_id(self) -> Optional[str]:
+        return self.metadata.get("spaceId")
+
+    @property
+    def filename(self) -> str:
+        return self.metadata.get("filename") or ""
+
+    def with_image(self, image_base64: str) -> "ImageRecord":
+        return replace(self, image=image_store.put(image_base64))
+
+    def to_dict(self, include_image: bool = True) -> Dict[str, Any]:
+        """
+        Encode in the wire/disk format (camelCase keys, as sent to the client)
+
+        Args:
+            include_image: Include imageBase64 (False for listings and the disk index)
+        """
+        data: Dict[str, Any] = {
+            "instanceId": self.instance_id,
+            "metadata": self.metadata,
+            "description": self.description,
+            "tags": list(self.tags),
+        }
+        if include_image and self.image is not None:
+            data["imageBase64"] = self.image.base64
+        if self.system_tags is not None:
+            data["system_tags"] = list(self.system_tags)
+        if self.user_tags is not None:
+            data["user_tags"] = list(self.user_tags)
+        if self.system_description is not None:
+            data["system_description"] = self.system_description
+        if self.user_description is not None:
+            data["user_description"] = self.user_description
+        if self.enrichment_error is not None:
+            data["enrichmentError"] = self.enrichment_error
+        if self.perceptual_hash is not None:
+            data["perceptualHash"] = self.perceptual_hash
+        if self.duplicate_of is not None:
+            data["duplicateOf"] = self.duplicate_of
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], image: Optional[ImageRef] = None) -> "ImageRecord":
+        """
+        Decode a record from to_dict() output (or a legacy cache entry)
+
+        Args:
+            data: Encoded record; a legacy rawResponse key is ignored
+            image: Image reference to use instead of data["imageBase64"]
+        """
+        if image is None and data.get("imageBase64"):
+            image = image_store.put(data["imageBase64"])
+        return cls(
+            instance_id=data["instanceId"],
+            metadata=data.get("metadata") or {},
+            image=image,
+            description=data.get("description", ""),
+            tags=data.get("tags") or (),
+            system_tags=data.get("system_tags"),
+            user_tags=data.get("user_tags"),
+            system_description=data.get("system_description"),
+            user_description=data.get("user_description"),
+            enrichment_error=data.get("enrichmentError"),
+            perceptual_hash=data.get("perceptualHash"),
+            duplicate_of=data.get("duplicateOf"),
+        )
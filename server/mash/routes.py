@@ -1,23 +1,111 @@
-from fastapi import APIRouter,Body
+from fastapi import APIRouter,Body,Header,Response
+from fastapi.responses import StreamingResponse
 from typing import List
-from .processor import Metadata, process_metadata_entries, get_all_cached_descriptions, handle_user_prompt
+from .processor import (
+    Metadata,
+    get_all_cached_descriptions,
+    get_budget_report,
+    get_job_events,
+    get_job_results,
+    handle_user_prompt,
+    list_jobs,
+    process_metadata_entries,
+    retry_failed_job_items,
+)
+from .session_store import SESSION_HEADER, new_session_id
+from utils.log import get_logger
+from utils.tracing import TRACE_HEADER, new_trace_id, span
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 @router.post("/process-entries")
-def process_entries(metadata_list: List[Metadata]):
-    print(f"[🌐] Received metadata batch: {len(metadata_list)} entries")
-    return process_metadata_entries(metadata_list)
+def process_entries(metadata_list: List[Metadata], response: Response, x_mash_session: str | None = Header(default=None)):
+    logger.info("Received metadata batch: %s entries", len(metadata_list))
+    # Issue a session ID to clients that do not have one yet
+    session_id = x_mash_session or new_session_id()
+    response.headers[SESSION_HEADER] = session_id
+    trace_id = new_trace_id()
+    response.headers[TRACE_HEADER] = trace_id
+    with span("process-entries", trace_id=trace_id, session=session_id[:8], entries=len(metadata_list)):
+        return process_metadata_entries(metadata_list, session_id)
 
 @router.get("/descriptions")
-def get_descriptions():
-    print(f"[📦] Fetching cached descriptions...")
-    return get_all_cached_descriptions()
+def get_descriptions(x_mash_session: str | None = Header(default=None)):
+    logger.debug("Fetching cached descriptions...")
+    return get_all_cached_descriptions(x_mash_session)
 
 
 
 @router.post("/user-prompt")  
-def user_prompt(prompt: str = Body(..., embed=True)):
-    print(f"[📥] Received user prompt: {prompt}")
-    handle_user_prompt(prompt) 
-    return {"status": "received", "prompt": prompt}
+def user_prompt(response: Response, prompt: str = Body(..., embed=True), x_mash_session: str | None = Header(default=None)):
+    logger.info("Received user prompt: %s", prompt)
+    # Commands only run against the caller's own session
+    if not x_mash_session:
+        response.status_code = 400
+        return {"status": "rejected", "prompt": prompt, "error": f"Missing {SESSION_HEADER} header"}
+    trace_id = new_trace_id()
+    response.headers[TRACE_HEADER] = trace_id
+    with span("user-prompt", trace_id=trace_id, session=(x_mash_session or "")[:8], promptLength=len(prompt)):
+        result = handle_user_prompt(prompt, x_mash_session)
+    # Commands refused by admission control are reported, so clients can back off
+    if isinstance(result, dict) and "budget" in result:
+        response.status_code = 429
+        retry_after = result["budget"].get("retryAfterSeconds")
+        if retry_after is not None:
+            response.headers["Retry-After"] = str(int(retry_after))
+        return {"status": "rejected", "prompt": prompt, "traceId": trace_id, **result}
+    return {"status": "received", "prompt": prompt, "traceId": trace_id}
+
+@router.get("/budget")
+def get_budget(x_mash_session: str | None = Header(default=None)):
+    return get_budget_report(x_mash_session)
+
+def _missing_session(response: Response, x_mash_session: str | None):
+    """Error for job requests without the session header (jobs are only visible to their own session)"""
+    if x_mash_session:
+        return None
+    response.status_code = 400
+    return {"error": f"Missing {SESSION_HEADER} header"}
+
+@router.get("/jobs")
+def get_jobs(response: Response, x_mash_session: str | None = Header(default=None)):
+    return _missing_session(response, x_mash_session) or list_jobs(x_mash_session)
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str, response: Response, x_mash_session: str | None = Header(default=None)):
+    error = _missing_session(response, x_mash_session)
+    if error:
+        return error
+    result = get_job_results(job_id, x_mash_session)
+    if result.get("error") == "Unknown job":
+        response.status_code = 404
+    return result
+
+@router.get("/jobs/{job_id}/events")
+def get_job_progress(job_id: str, response: Response, x_mash_session: str | None = Header(default=None)):
+    """Job summary as newline-delimited JSON after every item and upload status change, until all are done"""
+    error = _missing_session(response, x_mash_session)
+    if error:
+        return error
+    events = get_job_events(job_id, x_mash_session)
+    if events is None:
+        response.status_code = 404
+        return {"error": "Unknown job"}
+    return StreamingResponse(events, media_type="application/x-ndjson")
+
+@router.post("/jobs/{job_id}/retry")
+def retry_job(job_id: str, response: Response, x_mash_session: str | None = Header(default=None)):
+    """Re-run only the failed items of one of the session's mash:/variation: jobs"""
+    error = _missing_session(response, x_mash_session)
+    if error:
+        return error
+    trace_id = new_trace_id()
+    response.headers[TRACE_HEADER] = trace_id
+    with span("retry-job", trace_id=trace_id, job=job_id[:8]):
+        result = retry_failed_job_items(job_id, x_mash_session)
+    if result.get("error") == "Unknown job":
+        response.status_code = 404
+    elif "budget" in result:
+        response.status_code = 429
+    return result
@@ -0,0 +1,217 @@
+import os
+import time
+import uuid
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from .records import ImageRecord
+from .tag_index import TagIndex
+from utils.log import get_logger
+from utils.profiling import InstrumentedLock
+
+logger = get_logger(__name__)
+
+# Session limits (overridable from the environment)
+SESSION_IDLE_EXPIRY_SECONDS = int(os.getenv("MASH_SESSION_IDLE_SECONDS", "3600"))  # Drop sessions idle for 1 hour
+SESSION_MAX_IMAGES = int(os.getenv("MASH_SESSION_MAX_IMAGES", "200"))
+SESSION_MAX_BYTES = int(os.getenv("MASH_SESSION_MAX_BYTES", str(256 * 1024 * 1024)))  # Base64 bytes per session
+
+SESSION_HEADER = "X-Mash-Session"
+
+
+class SessionSnapshot:
+    """
+    One immutable version of a session's images.
+
+    Readers use a snapshot without taking any lock; writers never modify a
+    published snapshot, they build a new one and swap it in.
+    """
+
+    __slots__ = ("records", "by_id", "byte_size", "_descriptions")
+
+    def __init__(self, records: Tuple[ImageRecord, ...], by_id: Mapping[str, ImageRecord], byte_size: int):
+        self.records = records  # Index order (1-based image index = position + 1)
+        self.by_id = by_id  # Read-only instanceId -> record view
+        self.byte_size = byte_size
+        self._descriptions: Optional[List[Dict]] = None
+
+    def descriptions(self) -> List[Dict]:
+        """Encoded records without imageBase64, computed once per version"""
+        if self._descriptions is None:
+            # Concurrent first readers may both compute this; the results are identical
+            self._descriptions = [record.to_dict(include_image=False) for record in self.records]
+        return self._descriptions
+
+
+_EMPTY_SNAPSHOT = SessionSnapshot((), MappingProxyType({}), 0)
+
+
+def _image_size(record: Optional[ImageRecord]) -> int:
+    return record.image_size if record else 0
+
+
+class Session:
+    """
+    Images pasted by one client, in the order they were cached.
+
+    The images are held in copy-on-write snapshots: reads are lock-free and
+    see a consistent version, while writers (serialised by the session's
+    own lock) publish a new version atomically.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.lock = InstrumentedLock("session")  # Serialises writers only
+        self._snapshot = _EMPTY_SNAPSHOT
+        self.index = TagIndex()  # Lexical search over tags and descriptions, kept in step by writers
+
+    @property
+    def byte_size(self) -> int:
+        return self._snapshot.byte_size
+
+    def touch(self):
+        self.last_access = time.time()
+
+    def snapshot(self) -> SessionSnapshot:
+        """The current version of the session's images"""
+        self.last_access = time.time()
+        return self._snapshot
+
+    def _publish(self, records: List[ImageRecord], byte_size: int):
+        by_id = {record.instance_id: record for record in records}
+        self._snapshot = SessionSnapshot(tuple(records), MappingProxyType(by_id), byte_size)
+        self.last_access = time.time()
+
+    def put(self, record: ImageRecord) -> bool:
+        """
+        Add or replace a record, enforcing the per-session memory limits
+
+        Args:
+            record: Image record
+
+        Returns:
+            True if the record was stored, False if it would exceed the limits
+        """
+        instance_id = record.instance_id
+
+        with self.lock:
+            current = self._snapshot
+            previous = current.by_id.get(instance_id)
+
+            if previous is None and len(current.records) >= SESSION_MAX_IMAGES:
+                logger.warning("Session %s is full (%s images), dropping %s", self.session_id[:8], SESSION_MAX_IMAGES, instance_id[:6])
+                return False
+            byte_size = current.byte_size - _image_size(previous) + _image_size(record)
+            if byte_size > SESSION_MAX_BYTES:
+                logger.warning("Session %s memory limit reached, dropping %s", self.session_id[:8], instance_id[:6])
+                return False
+
+            if previous is None:
+                records = list(current.records) + [record]
+            else:
+                records = [record if r.instance_id == instance_id else r for r in current.records]
+            self.index.add(record)
+            self._publish(records, byte_size)
+            return True
+
+    def update_many(self, records: List[ImageRecord]):
+        """Replace several existing records at once (records no longer in the session are ignored)"""
+        with self.lock:
+            current = self._snapshot
+            updates = {record.instance_id: record for record in records if record.instance_id in current.by_id}
+            if not updates:
+                return
+            byte_size = current.byte_size + sum(
+                _image_size(record) - _image_size(current.by_id[instance_id]) for instance_id, record in updates.items()
+            )
+            self.index.add_many(updates.values())
+            self._publish([updates.get(r.instance_id, r) for r in current.records], byte_size)
+
+    def get(self, instance_id: str) -> Optional[ImageRecord]:
+        return self._snapshot.by_id.get(instance_id)
+
+    def get_by_index(self, index: int) -> Optional[ImageRecord]:
+        """Return the record at a 1-based index, or None if out of range"""
+        records = self.snapshot().records
+        if 1 <= index <= len(records):
+            return records[index - 1]
+        return None
+
+    def records(self) -> Tuple[ImageRecord, ...]:
+        """Return the session's records in index order"""
+        return self.snapshot().records
+
+    def items(self) -> Mapping[str, ImageRecord]:
+        """Return a read-only instanceId -> record mapping"""
+        return self._snapshot.by_id
+
+    def __len__(self) -> int:
+        return len(self._snapshot.records)
+
+
+_sessions: Dict[str, Session] = {}
+_sessions_lock = InstrumentedLock("sessions")
+
+
+def new_session_id() -> str:
+    return str(uuid.uuid4())
+
+
+def create_session(session_id: Optional[str] = None) -> Session:
+    """
+    Start a fresh session, replacing any existing session with the same ID
+
+    Args:
+        session_id: Client-supplied session ID, or None to issue a new one
+
+    Returns:
+        The new, empty session
+    """
+    session = Session(session_id or new_session_id())
+    with _sessions_lock:
+        _sessions[session.session_id] = session
+    logger.info("Creating new session: %s", session.session_id)
+    return session
+
+
+def get_session(session_id: Optional[str]) -> Optional[Session]:
+    """
+    Look up a live session
+
+    Args:
+        session_id: Session ID sent by the client (None if it sent none)
+
+    Returns:
+        The session, or None if there is no ID, or it does not exist or has expired
+    """
+    # Never fall back to another client's session
+    if not session_id:
+        return None
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+    if session is None:
+        return None
+    if time.time() - session.last_access > SESSION_IDLE_EXPIRY_SECONDS:
+        drop_session(session.session_id)
+        return None
+    session.touch()
+    return session
+
+
+def drop_session(session_id: str):
+    with _sessions_lock:
+        _sessions.pop(session_id, None)
+
+
+def expire_idle_sessions() -> int:
+    """Drop every session idle for longer than SESSION_IDLE_EXPIRY_SECONDS, returning how many were dropped"""
+    cutoff = time.time() - SESSION_IDLE_EXPIRY_SECONDS
+    with _sessions_lock:
+        expired = [sid for sid, session in _sessions.items() if session.last_access < cutoff]
+    for session_id in expired:
+        drop_session(session_id)
+    if expired:
+        logger.info("Expired %s idle session(s)", len(expired))
+    return len(expired)
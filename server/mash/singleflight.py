@@ -0,0 +1,73 @@
+import hashlib
+import threading
+from concurrent.futures import CancelledError, Future
+from typing import Any, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key: the first caller runs the
+    function, later callers wait on the same future instead of repeating it.
+
+    Results are not kept once the call finishes, so this only deduplicates
+    work that is in flight at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        self.coalesced = 0  # Number of calls served by another caller's request
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run fn once per key among concurrent callers
+
+        Args:
+            key: Request fingerprint
+            fn: Zero-argument callable performing the request
+
+        Returns:
+            The (shared) result of fn
+        """
+        while True:
+            with self._lock:
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._inflight[key] = future
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(result)
+                    return result
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+
+            try:
+                return future.result()
+            except CancelledError:
+                # The leader's call was cancelled on its own behalf (e.g. its
+                # session was reset); this caller still wants the result.
+                continue
+
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._inflight)
+
+
+def fingerprint(*chunks: str) -> str:
+    """Stable SHA-256 fingerprint of the given string chunks"""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .records import ImageRecord
+from utils.profiling import InstrumentedLock
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+TAG_TERM_WEIGHT = 2  # A term from a tag counts as this many description occurrences
+
+# Words that say nothing about an image. "style" and "content" are kept:
+# they are what tells the two queries of find_and_mash_best_matches apart
+STOPWORDS = frozenset("""
+a an and are as at be by for from has in into is it its of on or that the this to with
+image images photo picture me make look like some very
+""".split())
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens of a text, without stopwords"""
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def _record_terms(record: ImageRecord) -> Counter:
+    terms: Counter = Counter()
+    # A failed enrichment's description is a placeholder, not something to match
+    descriptions = (record.user_description or "",) if record.enrichment_error else (record.description, record.user_description or "")
+    for text in descriptions:
+        terms.update(tokenize(text))
+    for tags in (record.tags, record.system_tags or (), record.user_tags or ()):
+        for tag in tags:
+            for token in tokenize(tag):
+                terms[token] += TAG_TERM_WEIGHT
+    return terms
+
+
+class TagIndex:
+    """
+    Inverted index over the tags and descriptions of a session's images,
+    ranked with BM25.
+
+    The index is updated incrementally as records are added or replaced, so
+    a search never rebuilds it.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, int]] = {}  # term -> instanceId -> term frequency
+        self._doc_terms: Dict[str, Counter] = {}
+        self._doc_lengths: Dict[str, int] = {}
+        self._total_length = 0
+        self._lock = InstrumentedLock("tag_index")
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def _remove_locked(self, instance_id: str):
+        terms = self._doc_terms.pop(instance_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self._postings[term]
+            del postings[instance_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(instance_id)
+
+    def add(self, record: ImageRecord):
+        """Index a record, replacing any previous version of it"""
+        terms = _record_terms(record)
+        with self._lock:
+            self._remove_locked(record.instance_id)
+            for term, frequency in terms.items():
+                self._postings.setdefault(term, {})[record.instance_id] = frequency
+            self._doc_terms[record.instance_id] = terms
+            self._doc_lengths[record.instance_id] = sum(terms.values())
+            self._total_length += self._doc_lengths[record.instance_id]
+
+    def add_many(self, records: Iterable[ImageRecord]):
+        for record in records:
+            self.add(record)
+
+    def remove(self, instance_id: str):
+        with self._lock:
+            self._remove_locked(instance_id)
+
+    def search(self, query: str, limit: Optional[int] = None, exclude: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Rank indexed images against a query
+
+        Args:
+            query: Free-form prompt
+            limit: Maximum number of results
+            exclude: Instance IDs to leave out
+
+        Returns:
+            (instanceId, score) pairs with a positive score, best first
+        """
+        query_terms = set(tokenize(query))
+        scores: Dict[str, float] = {}
+        with self._lock:
+            count = len(self._doc_lengths)
+            if not query_terms or not count:
+                return []
+            average_length = self._total_length / count or 1.0
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for instance_id, frequency in postings.items():
+                    length_norm = 1 - BM25_B + BM25_B * self._doc_lengths[instance_id] / average_length
+                    scores[instance_id] = scores.get(instance_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+
+        ranked = sorted(((i, s) for i, s in scores.items() if not exclude or i not in exclude), key=lambda item: item[1], reverse=True)
+        return ranked[:limit] if limit else ranked
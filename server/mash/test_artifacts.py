@@ -0,0 +1,37 @@
+import base64
+import json
+import os
+
+from mash.artifacts import ArtifactSink, strip_inline_data
+
+
+def _image(size):
+    return base64.b64encode(b"x" * size).decode("ascii")
+
+
+def test_images_are_written_in_the_background(tmp_path):
+    sink = ArtifactSink(str(tmp_path), max_bytes=1000)
+    path = sink.write_image("a.png", _image(10))
+    sink.flush()
+    with open(path, "rb") as f:
+        assert f.read() == b"x" * 10
+
+
+def test_oldest_files_go_once_over_budget(tmp_path):
+    sink = ArtifactSink(str(tmp_path), max_bytes=25)
+    for name in ("a.png", "b.png", "c.png"):
+        sink.write_image(name, _image(10))
+    sink.flush()
+    assert sorted(os.listdir(tmp_path)) == ["b.png", "c.png"]
+
+
+def test_debug_dumps_are_sampled_and_stripped(tmp_path):
+    response = {"candidates": [{"content": {"parts": [{"inlineData": {"mimeType": "image/png", "data": "AAAA"}}]}}]}
+    ArtifactSink(str(tmp_path), debug_dump_rate=0).dump_debug("off.json", response)
+    sink = ArtifactSink(str(tmp_path), debug_dump_rate=1)
+    sink.dump_debug("on.json", response)
+    sink.flush()
+    assert os.listdir(tmp_path) == ["on.json"]
+    with open(tmp_path / "on.json") as f:
+        assert json.load(f) == strip_inline_data(response)
+    assert strip_inline_data(response)["candidates"][0]["content"]["parts"][0]["inlineData"]["data"] == "<4 base64 chars>"
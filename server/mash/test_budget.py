@@ -0,0 +1,100 @@
+import threading
+import time
+
+from mash.budget import BudgetLedger, estimate, parse_limits
+from mash.processor import estimate_command_cost
+from mash.records import ImageRecord
+from mash.session_store import Session
+
+
+def _ledger(global_limits="", session_limits="", **kwargs):
+    return BudgetLedger(3600, parse_limits(global_limits), parse_limits(session_limits), **kwargs)
+
+
+def test_admits_within_budget_and_rejects_over_it():
+    ledger = _ledger(session_limits="generations=3")
+    ticket, rejection = ledger.admit("s1", "mash", estimate(generations=2))
+    assert rejection is None
+    # The running command's estimate stays reserved
+    _, rejection = ledger.admit("s1", "mash", estimate(generations=2))
+    assert rejection["budget"]["scope"] == "session"
+    assert rejection["budget"]["available"] == 1
+    # Other sessions have their own budget
+    assert ledger.admit("s2", "mash", estimate(generations=2))[1] is None
+
+
+def test_release_returns_the_unused_reservation():
+    ledger = _ledger(global_limits="generations=4")
+    ticket, _ = ledger.admit("s1", "mash", estimate(generations=4))
+    with ticket:
+        ledger.record("s1", {"generations": 1}, ticket)
+    assert ledger.report()["global"]["used"]["generations"] == 1
+    assert ledger.report()["global"]["reserved"]["generations"] == 0
+    assert ledger.admit("s1", "mash", estimate(generations=3))[1] is None
+
+
+def test_batch_commands_leave_the_interactive_reserve():
+    ledger = _ledger(global_limits="generations=10", interactive_reserve=0.2)
+    _, rejection = ledger.admit("s1", "mash_all", estimate(generations=9), batch=True)
+    assert rejection["budget"]["available"] == 8
+    assert ledger.admit("s1", "mash", estimate(generations=9))[1] is None
+
+
+def test_no_load_shedding_without_a_global_budget():
+    ledger = _ledger(batch_max_in_flight=1)
+    tickets = [ledger.admit(f"s{i}", "mash_all", estimate(generations=1), batch=True) for i in range(3)]
+    assert all(rejection is None for _, rejection in tickets)
+
+
+def test_batch_commands_wait_for_a_slot_then_are_shed():
+    ledger = _ledger(global_limits="generations=100", batch_max_in_flight=1, batch_queue_seconds=0.2)
+    first, _ = ledger.admit("s1", "mash_all", estimate(generations=1), batch=True)
+    start = time.monotonic()
+    _, rejection = ledger.admit("s2", "mash_all", estimate(generations=1), batch=True)
+    assert rejection is not None and time.monotonic() - start >= 0.2
+
+    threading.Timer(0.05, ledger.release, [first]).start()
+    second, rejection = ledger.admit("s2", "mash_all", estimate(generations=1), batch=True)
+    assert rejection is None and ledger.batch_in_flight == 1
+    ledger.release(second)
+    assert ledger.batch_in_flight == 0
+
+
+def test_speculative_work_never_holds_or_waits_for_a_batch_slot():
+    ledger = _ledger(global_limits="text_calls=10", interactive_reserve=0.2,
+                     batch_max_in_flight=1, batch_queue_seconds=5)
+    speculative, rejection = ledger.admit(None, "prefetch", estimate(text_calls=2), speculative=True)
+    assert rejection is None and ledger.batch_in_flight == 0
+    ledger.release(speculative)
+
+    batch, _ = ledger.admit("s1", "mash_all", estimate(text_calls=1), batch=True)
+    start = time.monotonic()
+    _, rejection = ledger.admit(None, "prefetch", estimate(text_calls=2), speculative=True)
+    assert rejection is not None and time.monotonic() - start < 1
+    ledger.release(batch)
+
+    # Held to the batch share of the budget
+    _, rejection = ledger.admit(None, "prefetch", estimate(text_calls=9), speculative=True)
+    assert rejection["budget"]["available"] == 8
+
+
+def _session(n):
+    session = Session("estimate")
+    for k in range(n):
+        session.put(ImageRecord(instance_id=str(k), metadata={}))
+    return session
+
+
+def test_command_estimates_reserve_the_llm_scoring_calls():
+    session = _session(4)
+    assert estimate_command_cost(session, {"command_type": "prompt"}) == (estimate(generations=1, text_calls=4), False)
+    assert estimate_command_cost(session, {"command_type": "mash", "mash_info": {}}) == (estimate(generations=1, text_calls=12), False)
+    assert estimate_command_cost(session, {"command_type": "mash", "mash_info": {"sources": {"style": 1}}}) == (estimate(generations=1), False)
+
+
+def test_batch_command_estimates_scale_with_the_session():
+    session = _session(4)
+    assert estimate_command_cost(session, {"command_type": "mash", "mash_info": {"is_empty": True}}) == (estimate(generations=12), True)
+    assert estimate_command_cost(session, {"command_type": "mash", "mash_info": {"is_empty": True, "budget": 5}}) == (estimate(generations=5), True)
+    assert estimate_command_cost(session, {"command_type": "tag"}) == (estimate(text_calls=4), True)
+    assert estimate_command_cost(session, {"command_type": "edit"}) == (estimate(generations=4), True)
@@ -0,0 +1,33 @@
+import threading
+import time
+
+from mash.bulk import run_bulk
+
+
+def test_results_keep_item_order():
+    def slow_for_early_items(i, item):
+        time.sleep(0.01 * (5 - i))
+        return item * 2
+
+    assert run_bulk([1, 2, 3, 4, 5], slow_for_early_items, max_workers=5) == [2, 4, 6, 8, 10]
+
+
+def test_concurrency_is_bounded():
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def track(i, item):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    run_bulk(range(12), track, max_workers=3)
+    assert peak[0] == 3
+
+
+def test_one_worker_runs_in_the_calling_thread():
+    threads = run_bulk(range(3), lambda i, item: threading.current_thread(), max_workers=1)
+    assert threads == [threading.current_thread()] * 3
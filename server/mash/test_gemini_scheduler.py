@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from mash.gemini_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, GeminiScheduler, RateLimitedError
+
+
+def test_interactive_calls_run_before_queued_background_calls():
+    scheduler = GeminiScheduler(max_workers=1)
+    release = threading.Event()
+    order = []
+    blocker = scheduler.submit("model", release.wait)
+    background = scheduler.submit("model", lambda: order.append("background"), priority=PRIORITY_BACKGROUND)
+    interactive = scheduler.submit("model", lambda: order.append("interactive"), priority=PRIORITY_INTERACTIVE)
+    release.set()
+    for future in (blocker, background, interactive):
+        future.result(timeout=5)
+    assert order == ["interactive", "background"]
+
+
+def test_retry_after_backs_off_the_whole_model():
+    scheduler = GeminiScheduler(max_workers=2)
+    scheduler.configure_model("model", rpm=1000)
+    attempts = []
+
+    def limited():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RateLimitedError("429", retry_after=0.3)
+        return "ok"
+
+    start = time.monotonic()
+    assert scheduler.call("model", limited) == "ok"
+    assert attempts[1] - start >= 0.3
+    assert scheduler._limits["model"].blocked_until >= start + 0.3
+
+    # Other calls on the model wait out the same Retry-After
+    scheduler._limits["model"].blocked_until = time.monotonic() + 0.3
+    start = time.monotonic()
+    scheduler.call("model", lambda: None)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_gives_up_after_max_retries():
+    scheduler = GeminiScheduler(max_workers=1, max_retries=2)
+    attempts = []
+
+    def always_limited():
+        attempts.append(1)
+        raise RateLimitedError("429", retry_after=0.01)
+
+    with pytest.raises(RateLimitedError):
+        scheduler.call("model", always_limited)
+    assert len(attempts) == 3
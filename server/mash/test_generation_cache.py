@@ -0,0 +1,84 @@
+import pytest
+
+from mash.generation_cache import GenerationCache, parse_policy
+from mash.records import ImageRecord
+
+
+def _record(instance_id, image_base64):
+    return ImageRecord(instance_id=instance_id, metadata={}).with_image(image_base64)
+
+
+def _cache(max_bytes=1000, policy="mash=reuse,edit=fresh"):
+    return GenerationCache(max_bytes, parse_policy(policy))
+
+
+def test_policy_parsing():
+    assert parse_policy("mash=reuse, edit=fresh,prompt") == {"mash": "reuse", "edit": "fresh", "prompt": "reuse"}
+    with pytest.raises(ValueError):
+        parse_policy("mash=sometimes")
+
+
+def test_key_depends_on_image_content_not_record_identity():
+    key = GenerationCache.key("model", _record("a", "aW1hZ2U="), {"style": _record("s", "c3R5bGU=")}, "p", {})
+    assert key == GenerationCache.key("model", _record("b", "aW1hZ2U="), {"style": _record("t", "c3R5bGU=")}, "p", {})
+    assert key != GenerationCache.key("model", _record("a", "aW1hZ2U="), {"content": _record("s", "c3R5bGU=")}, "p", {})
+    assert key != GenerationCache.key("model", _record("a", "aW1hZ2U="), {"style": _record("s", "c3R5bGU=")}, "q", {})
+    assert GenerationCache.key("model", ImageRecord(instance_id="a", metadata={}), None, "p", {}) is None
+
+
+def test_hits_and_misses_follow_the_command_policy():
+    cache = _cache()
+    outputs = [{"imageBase64": "abc", "description": "d"}]
+    assert cache.get("k", "mash") is None
+    cache.put("k", outputs)
+    assert cache.get("k", "mash") == outputs
+    assert cache.get("k", "edit") is None  # Fresh: always generates
+    assert cache.get("k", "unlisted") is None
+
+
+def test_text_only_responses_are_not_cached():
+    cache = _cache()
+    cache.put("k", [{"description": "no image"}])
+    assert cache.get("k", "mash") is None
+
+
+def test_least_recently_used_results_are_evicted_over_budget():
+    cache = _cache(max_bytes=10)
+    cache.put("a", [{"imageBase64": "aaaa"}])
+    cache.put("b", [{"imageBase64": "bbbb"}])
+    cache.get("a", "mash")
+    cache.put("c", [{"imageBase64": "cccc"}])
+    assert cache.get("b", "mash") is None
+    assert cache.get("a", "mash") and cache.get("c", "mash")
+    assert cache.byte_size == 8
+
+
+def test_upload_once_skips_repeat_uploads_to_the_same_space():
+    cache = _cache()
+    uploads = []
+
+    def upload():
+        uploads.append(1)
+        return {"success": True, "url": f"u{len(uploads)}"}
+
+    assert cache.upload_once("aW1n", "space-1", upload)["url"] == "u1"
+    assert cache.upload_once("aW1n", "space-1", upload)["url"] == "u1"
+    assert cache.upload_once("aW1n", "space-2", upload)["url"] == "u2"
+    assert len(uploads) == 2
+
+
+def test_failed_uploads_are_retried():
+    cache = _cache()
+    results = iter([{"success": False}, {"success": True}])
+    assert not cache.upload_once("aW1n", "space-1", lambda: next(results))["success"]
+    assert cache.upload_once("aW1n", "space-1", lambda: next(results))["success"]
+
+
+def test_disabled_cache_does_nothing():
+    cache = GenerationCache(1000, parse_policy("mash=reuse"), enabled=False)
+    cache.put("k", [{"imageBase64": "abc"}])
+    assert cache.get("k", "mash") is None
+    calls = []
+    for _ in range(2):
+        cache.upload_once("aW1n", "space-1", lambda: calls.append(1) or {"success": True})
+    assert len(calls) == 2
@@ -0,0 +1,122 @@
+import os
+import time
+
+import pytest
+
+from mash import jobs
+from mash.bulk import run_bulk
+from mash.jobs import COMPLETED, COMPLETED_WITH_ERRORS, DONE, FAILED, PENDING, RUNNING, JobStore, run_job
+from mash.records import ImageRecord
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DIR", str(tmp_path))
+    store = JobStore(str(tmp_path))
+    monkeypatch.setattr(jobs, "job_store", store)
+    return store
+
+
+def _create(store, inputs=(("0", {"n": 0}), ("1", {"n": 1})), session_id="session-1"):
+    image = ImageRecord(instance_id="a", metadata={}).with_image("aW5wdXQ=")
+    return store.create("test", session_id, {}, [image], list(inputs))
+
+
+def _blobs():
+    return sorted(os.listdir(os.path.join(jobs.JOB_DIR, "blobs")))
+
+
+def test_progress_is_journaled_and_replayed_after_a_restart(store):
+    job = _create(store)
+    store.record(job, "0", {"imageBase64": "b3V0cHV0"}, None)
+    assert os.path.exists(store._journal_path(job.job_id))
+
+    reloaded = JobStore(store.directory)
+    assert reloaded.load() == 1
+    job = reloaded.get(job.job_id)
+    assert job.status == RUNNING
+    assert job.counts() == {PENDING: 1, DONE: 1, FAILED: 0}
+    assert reloaded.results(job)[0][1]["result"] == {"imageBase64": "b3V0cHV0"}
+    assert job.image("a").image_base64 == "aW5wdXQ="
+
+
+def test_a_truncated_journal_line_is_ignored(store):
+    job = _create(store)
+    store.record(job, "0", {"text": "ok"}, None)
+    with open(store._journal_path(job.job_id), "a") as f:
+        f.write('{"item": "1", "sta')
+    reloaded = JobStore(store.directory)
+    reloaded.load()
+    assert reloaded.get(job.job_id).counts() == {PENDING: 1, DONE: 1, FAILED: 0}
+
+
+def test_finishing_folds_the_journal_into_the_job_file(store):
+    job = _create(store)
+    store.record(job, "0", None, None)
+    store.record(job, "1", None, "boom")
+    store.finish(job)
+    assert job.status == COMPLETED_WITH_ERRORS
+    assert not os.path.exists(store._journal_path(job.job_id))
+    reloaded = JobStore(store.directory)
+    reloaded.load()
+    assert reloaded.get(job.job_id).items["1"]["error"] == "boom"
+
+
+def test_jobs_are_listed_per_session(store):
+    mine, other = _create(store), _create(store, session_id="session-2")
+    assert store.list("session-1") == [mine]
+    assert {job.job_id for job in store.all()} == {mine.job_id, other.job_id}
+
+
+def test_only_failed_items_run_again(store, monkeypatch):
+    calls = []
+
+    def runner(job, data, previous):
+        calls.append(data["n"])
+        if data["n"] == 1 and calls.count(1) == 1:
+            return "partial", "flaky"
+        return f"result {data['n']}", None
+
+    monkeypatch.setitem(jobs._runners, "test", runner)
+    job = _create(store)
+    run_job(job, run_items=run_bulk)
+    assert job.status == COMPLETED_WITH_ERRORS
+    assert job.items["1"]["result"] == "partial"
+
+    assert store.reset_failed(job) == 1
+    assert job.status == RUNNING
+    run_job(job)
+    assert job.status == COMPLETED
+    assert sorted(calls) == [0, 1, 1]
+    assert job.items["1"]["attempts"] == 2
+
+
+def test_prune_drops_expired_jobs_and_unreferenced_images(store, monkeypatch):
+    kept = _create(store)
+    expired = _create(store, inputs=[("0", {})])
+    store.record(expired, "0", {"imageBase64": "ZXhwaXJlZA=="}, None)
+    store.finish(expired)
+    expired.updated_at = time.time() - jobs.JOB_RETENTION_SECONDS - 1
+    assert len(_blobs()) == 2  # The shared input image and the expired job's output
+
+    old = time.time() - jobs.JOB_BLOB_GRACE_SECONDS - 1
+    for name in _blobs():
+        os.utime(os.path.join(jobs.JOB_DIR, "blobs", name), (old, old))
+    assert store.prune() == 1
+    assert store.get(expired.job_id) is None
+    assert not os.path.exists(store._path(expired.job_id))
+    assert store.get(kept.job_id) is kept
+    assert len(_blobs()) == 1
+    assert kept.image("a").image_base64 == "aW5wdXQ="
+
+
+def test_prune_keeps_running_and_recent_jobs_and_young_images(store):
+    running = _create(store)
+    running.updated_at = 0
+    finished = _create(store, inputs=[("0", {})])
+    store.record(finished, "0", {"imageBase64": "bmV3"}, None)
+    store.finish(finished)
+    finished.items["0"]["result"] = None  # No job refers to the output any more, but it is new
+    assert store.prune() == 0
+    assert store.get(running.job_id) and store.get(finished.job_id)
+    assert len(_blobs()) == 2
@@ -0,0 +1,54 @@
+from collections import Counter
+
+import pytest
+
+from mash import pair_selection
+from mash.pair_selection import select_pairs, similarity_matrix
+from mash.records import ImageRecord
+
+
+def _record(instance_id, description, tags=()):
+    return ImageRecord(instance_id=instance_id, metadata={}, description=description, tags=tags)
+
+
+RECORDS = [
+    _record("cat", "a cat sleeping on a sofa", ("cat", "sofa")),
+    _record("kitten", "a kitten sleeping on a sofa", ("cat", "sofa")),
+    _record("city", "neon city street at night", ("neon", "cyberpunk", "street")),
+    _record("beach", "watercolor beach with palm trees", ("watercolor", "beach")),
+]
+
+
+def test_similar_records_score_higher():
+    similarities, style_strength = similarity_matrix(RECORDS)
+    assert similarities[0][0] == pytest.approx(1.0)
+    assert similarities[0][1] > similarities[0][2]
+    assert style_strength[2] > 0 and style_strength[0] == 0
+
+
+def test_pure_python_fallback_matches_numpy(monkeypatch):
+    with_numpy, _ = similarity_matrix(RECORDS)
+    monkeypatch.setattr(pair_selection, "np", None)
+    without_numpy, _ = similarity_matrix(RECORDS)
+    for row, expected in zip(without_numpy, with_numpy):
+        assert row == pytest.approx(expected, abs=1e-6)
+
+
+def test_budget_picks_complementary_pairs_first():
+    pairs = select_pairs(RECORDS, budget=4)
+    assert len(pairs) == 4 and len(set(pairs)) == 4
+    assert all(i != j for i, j in pairs)
+    assert pairs[0][0] in (2, 3)  # A strong style image leads
+    assert (0, 1) not in pairs and (1, 0) not in pairs  # Near-identical images are not paired early
+
+
+def test_budget_is_spread_across_images():
+    pairs = select_pairs(RECORDS, budget=3)
+    assert max(Counter(i for i, _ in pairs).values()) == 1
+    assert max(Counter(j for _, j in pairs).values()) == 1
+
+
+def test_budget_beyond_every_pair_returns_all_pairs():
+    assert len(select_pairs(RECORDS, budget=100)) == 12
+    assert select_pairs(RECORDS[:1], budget=5) == []
+    assert select_pairs(RECORDS, budget=0) == []
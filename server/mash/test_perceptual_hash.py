@@ -0,0 +1,65 @@
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+from mash.perceptual_hash import HashIndex, dhash, format_hash, parse_hash, same_shape
+
+
+def _picture(width=64, height=48, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).resize((width, height), Image.BILINEAR)
+
+
+def _encode(image, format="PNG", **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def _distance(first, second):
+    return bin(first ^ second).count("1")
+
+
+def test_resized_and_recompressed_copies_hash_close():
+    original = dhash(_encode(_picture()))
+    copy = dhash(_encode(_picture().resize((160, 120)), format="JPEG", quality=70))
+    assert original is not None and copy is not None
+    assert _distance(original, copy) <= 6
+
+
+def test_different_pictures_hash_far_apart():
+    assert _distance(dhash(_encode(_picture(seed=1))), dhash(_encode(_picture(seed=2)))) > 6
+
+
+def test_flat_and_undecodable_images_are_not_hashed():
+    assert dhash(_encode(Image.new("RGB", (64, 48), (200, 10, 10)))) is None
+    assert dhash(b"not an image") is None
+
+
+def test_same_shape_compares_aspect_ratios():
+    wide = base64.b64encode(_encode(_picture(64, 48))).decode()
+    scaled = base64.b64encode(_encode(_picture(128, 96))).decode()
+    square = base64.b64encode(_encode(_picture(64, 64))).decode()
+    assert same_shape(wide, scaled)
+    assert not same_shape(wide, square)
+    assert not same_shape(wide, "bm90IGFuIGltYWdl")
+
+
+def test_hash_index_finds_the_nearest_within_distance():
+    index = HashIndex()
+    assert index.nearest(0) is None
+    index.add("a", 0b1111)
+    index.add("b", 0xFFFF_0000_0000_0000)
+    assert index.nearest(0b0111) == ("a", 1)
+    assert index.nearest(0xFFFF_0000_0000_0000, max_distance=0) == ("b", 0)
+    assert index.nearest(0x0000_FFFF_0000_0000) is None
+    index.add("a", 0x0000_FFFF_0000_0000)  # Re-adding replaces the hash
+    assert len(index) == 2 and index.nearest(0x0000_FFFF_0000_0000) == ("a", 0)
+
+
+def test_hashes_round_trip_as_hex():
+    assert format_hash(0xABC) == "0000000000000abc"
+    assert parse_hash(format_hash(0xABC)) == 0xABC
+    assert parse_hash(None) is None
@@ -0,0 +1,118 @@
+import base64
+import time
+
+import pytest
+
+from mash import prefetch
+from mash.prefetch import SnapshotPrefetcher
+from mash.records import ImageRecord
+
+
+class _Response:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise prefetch.requests.HTTPError(f"{self.status_code}")
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """URL -> snapshot bytes served by the fake SOOT, and the URLs downloaded"""
+    content, fetched = {}, []
+
+    def get(url, headers=None, timeout=None):
+        fetched.append(url)
+        return _Response(content[url]) if url in content else _Response(b"", 404)
+
+    monkeypatch.setattr(prefetch.requests, "get", get)
+    return content, fetched
+
+
+def _prefetcher(**kwargs):
+    options = {"concurrency": 1, "max_bytes": 1000, "max_items": 10, "ttl_seconds": 60}
+    options.update(kwargs)
+    return SnapshotPrefetcher(**options)
+
+
+def _run(prefetcher, snapshots):
+    queued = prefetcher.schedule("space", snapshots)
+    deadline = time.monotonic() + 5
+    while prefetcher.stats()["queued"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return queued
+
+
+def _snapshots(*urls):
+    return [{"publication_id": f"pub-{url}", "snapshot_url": url} for url in urls]
+
+
+def test_listed_snapshots_are_downloaded_once(downloads):
+    content, fetched = downloads
+    content.update({"u1": b"first", "u2": b"second"})
+    prefetcher = _prefetcher()
+    assert _run(prefetcher, _snapshots("u1", "u2", "missing")) == 3
+    entry = prefetcher.take("u1")
+    assert entry.image.base64 == base64.b64encode(b"first").decode()
+    assert entry.publication_id == "pub-u1" and entry.space_id == "space"
+    assert prefetcher.take("missing") is None
+    assert prefetcher.stats()["queued"] == 0
+    assert prefetcher.schedule("space", _snapshots("u1", "u2")) == 0
+    assert sorted(fetched) == ["missing", "u1", "u2"]
+
+
+def test_least_recently_used_images_are_evicted_over_budget(downloads):
+    content, _ = downloads
+    content.update({"u1": b"a" * 6, "u2": b"b" * 6, "u3": b"c" * 6})  # 8 base64 bytes each
+    prefetcher = _prefetcher(max_bytes=16)
+    _run(prefetcher, _snapshots("u1", "u2"))
+    prefetcher.take("u1")
+    _run(prefetcher, _snapshots("u3"))
+    assert prefetcher.take("u2") is None
+    assert prefetcher.take("u1") and prefetcher.take("u3")
+    assert prefetcher.stats()["bytes"] == 16
+
+
+def test_unused_images_expire(downloads):
+    content, _ = downloads
+    content["u1"] = b"first"
+    prefetcher = _prefetcher(ttl_seconds=0)
+    _run(prefetcher, _snapshots("u1"))
+    assert prefetcher.take("u1") is None
+    assert prefetcher.stats() == {"images": 0, "bytes": 0, "queued": 0}
+
+
+def test_disabled_prefetcher_downloads_nothing(downloads):
+    _, fetched = downloads
+    assert _run(_prefetcher(enabled=False), _snapshots("u1")) == 0
+    assert fetched == []
+
+
+def test_prefetched_images_are_enriched_when_the_budget_allows(downloads):
+    content, _ = downloads
+    content["u1"] = b"first"
+    prefetcher = _prefetcher(enrich=True)
+    prefetcher.register_enricher(lambda publication_id, space_id, url, image: ImageRecord(
+        instance_id=publication_id, metadata={}, description="described"))
+    _run(prefetcher, _snapshots("u1"))
+    assert prefetcher.take("u1").enrichment.result().description == "described"
+
+
+def test_speculative_enrichment_is_skipped_when_the_budget_rejects_it(downloads, monkeypatch):
+    content, _ = downloads
+    content["u1"] = b"first"
+
+    class _Ledger:
+        def admit(self, session_id, command, cost, speculative=False):
+            assert speculative
+            return None, {"error": "over budget"}
+
+    monkeypatch.setattr(prefetch, "budget_ledger", _Ledger())
+    calls = []
+    prefetcher = _prefetcher(enrich=True)
+    prefetcher.register_enricher(lambda *args: calls.append(args))
+    _run(prefetcher, _snapshots("u1"))
+    assert prefetcher.take("u1").enrichment.result() is None
+    assert calls == []
@@ -0,0 +1,47 @@
+import dataclasses
+
+import pytest
+
+from mash.image_store import image_digest, image_store
+from mash.records import ImageRecord
+
+
+def test_records_are_immutable():
+    record = ImageRecord(instance_id="a", metadata={})
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        record.description = "changed"
+    assert not hasattr(record, "__dict__")
+
+
+def test_tags_are_interned_tuples():
+    first = ImageRecord(instance_id="a", metadata={}, tags=["".join(["sun", "set"])], user_tags=["x"])
+    second = ImageRecord(instance_id="b", metadata={}, tags=["".join(["sun", "se", "t"])])
+    assert first.tags == ("sunset",) and first.user_tags == ("x",)
+    assert first.tags[0] is second.tags[0]
+
+
+def test_round_trip_through_the_wire_format():
+    record = ImageRecord(
+        instance_id="a",
+        metadata={"spaceId": "s1", "filename": "a.png"},
+        description="desc",
+        tags=("red",),
+        system_tags=("sys",),
+        enrichment_error="timeout",
+        perceptual_hash="00ff",
+        duplicate_of="b",
+    ).with_image("aGVsbG8=")
+    data = record.to_dict()
+    assert data["imageBase64"] == "aGVsbG8=" and data["duplicateOf"] == "b"
+    assert "user_tags" not in data
+    assert ImageRecord.from_dict(data) == record
+    assert "imageBase64" not in record.to_dict(include_image=False)
+    assert (record.space_id, record.filename) == ("s1", "a.png")
+
+
+def test_identical_images_share_one_reference():
+    first = ImageRecord(instance_id="a", metadata={}).with_image("c2FtZQ==")
+    second = ImageRecord.from_dict({"instanceId": "b", "imageBase64": "c2FtZQ=="})
+    assert first.image is second.image
+    assert image_store.get(image_digest("c2FtZQ==")) is first.image
+    assert first.image_size == len("c2FtZQ==")
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from mash import jobs
+from mash.routes import router
+from mash.session_store import SESSION_HEADER
+
+app = FastAPI()
+app.include_router(router, prefix="/api/mash")
+client = TestClient(app)
+
+
+def test_prompts_without_a_session_are_rejected():
+    response = client.post("/api/mash/user-prompt", json={"prompt": "a cat"})
+    assert response.status_code == 400
+    assert response.json()["status"] == "rejected"
+    assert SESSION_HEADER in response.json()["error"]
+
+
+def test_process_entries_issues_a_session():
+    response = client.post("/api/mash/process-entries", json=[])
+    assert response.headers[SESSION_HEADER]
+    other = client.post("/api/mash/process-entries", json=[])
+    assert other.headers[SESSION_HEADER] != response.headers[SESSION_HEADER]
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs.job_store, "directory", str(tmp_path))
+    job = jobs.job_store.create("mash_all", "owner", {"totalImages": 0, "collapsedDuplicates": 0, "pairBudget": None}, [], [])
+    jobs.job_store.finish(job)
+    yield job
+    jobs.job_store._jobs.pop(job.job_id, None)
+
+
+@pytest.mark.parametrize("method, path", [
+    ("get", "/jobs"), ("get", "/jobs/{}"), ("get", "/jobs/{}/events"), ("post", "/jobs/{}/retry"),
+])
+def test_job_routes_require_a_session(job, method, path):
+    response = client.request(method, "/api/mash" + path.format(job.job_id))
+    assert response.status_code == 400
+    assert SESSION_HEADER in response.json()["error"]
+
+
+@pytest.mark.parametrize("method, path", [("get", "/jobs/{}"), ("get", "/jobs/{}/events"), ("post", "/jobs/{}/retry")])
+def test_other_sessions_jobs_are_not_found(job, method, path):
+    response = client.request(method, "/api/mash" + path.format(job.job_id), headers={SESSION_HEADER: "intruder"})
+    assert response.status_code == 404
+
+
+def test_jobs_are_visible_to_their_session(job):
+    owner = {SESSION_HEADER: "owner"}
+    assert [summary["jobId"] for summary in client.get("/api/mash/jobs", headers=owner).json()] == [job.job_id]
+    assert client.get("/api/mash/jobs", headers={SESSION_HEADER: "intruder"}).json() == []
+    assert client.get(f"/api/mash/jobs/{job.job_id}", headers=owner).json()["jobStatus"] == jobs.COMPLETED
+    events = client.get(f"/api/mash/jobs/{job.job_id}/events", headers=owner).text.splitlines()
+    assert json.loads(events[-1])["status"] == jobs.COMPLETED
@@ -0,0 +1,96 @@
+import time
+
+from mash import session_store
+from mash.records import ImageRecord
+from mash.session_store import create_session, drop_session, expire_idle_sessions, get_session
+
+
+def _record(instance_id):
+    return ImageRecord(instance_id=instance_id, metadata={})
+
+
+def test_sessions_are_isolated():
+    first, second = create_session(), create_session()
+    try:
+        first.put(_record("a"))
+        assert get_session(first.session_id).get("a") is not None
+        assert get_session(second.session_id).get("a") is None
+        assert len(second) == 0
+    finally:
+        drop_session(first.session_id)
+        drop_session(second.session_id)
+
+
+def test_no_session_id_never_falls_back_to_another_session():
+    session = create_session()
+    try:
+        assert get_session(None) is None
+        assert get_session("") is None
+        assert get_session("unknown") is None
+    finally:
+        drop_session(session.session_id)
+
+
+def test_idle_sessions_expire():
+    session = create_session()
+    session.last_access = time.time() - session_store.SESSION_IDLE_EXPIRY_SECONDS - 1
+    assert expire_idle_sessions() >= 1
+    assert get_session(session.session_id) is None
+
+
+def test_sessions_are_bounded(monkeypatch):
+    monkeypatch.setattr(session_store, "SESSION_MAX_IMAGES", 2)
+    session = create_session()
+    try:
+        assert session.put(_record("a")) and session.put(_record("b"))
+        assert not session.put(_record("c"))
+        assert session.put(_record("a"))  # Replacing does not count against the limit
+        assert [record.instance_id for record in session.records()] == ["a", "b"]
+    finally:
+        drop_session(session.session_id)
+
+
+def test_snapshots_are_not_changed_by_later_writes():
+    session = create_session()
+    try:
+        session.put(_record("a"))
+        before = session.snapshot()
+        session.put(_record("b"))
+        session.put(ImageRecord(instance_id="a", metadata={}, description="updated"))
+        assert [record.instance_id for record in before.records] == ["a"]
+        assert before.by_id["a"].description == ""
+        assert session.get("a").description == "updated"
+        assert len(session.snapshot().records) == 2
+    finally:
+        drop_session(session.session_id)
+
+
+def test_update_many_replaces_known_records_in_one_version():
+    session = create_session()
+    try:
+        session.put(_record("a"))
+        session.put(_record("b"))
+        before = session.snapshot()
+        session.update_many([
+            ImageRecord(instance_id="b", metadata={}, description="b2"),
+            ImageRecord(instance_id="gone", metadata={}, description="ignored"),
+        ])
+        after = session.snapshot()
+        assert after is not before
+        assert [record.instance_id for record in after.records] == ["a", "b"]
+        assert after.by_id["b"].description == "b2"
+        assert "gone" not in after.by_id
+    finally:
+        drop_session(session.session_id)
+
+
+def test_descriptions_leave_out_images_and_are_cached_per_version():
+    session = create_session()
+    try:
+        session.put(_record("a").with_image("aGVsbG8="))
+        snapshot = session.snapshot()
+        assert "imageBase64" not in snapshot.descriptions()[0]
+        assert snapshot.descriptions() is snapshot.descriptions()
+        assert snapshot.byte_size == len("aGVsbG8=")
+    finally:
+        drop_session(session.session_id)
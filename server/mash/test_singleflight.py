@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+from mash.singleflight import SingleFlight
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def _follow(flight, key, fn, results):
+    thread = threading.Thread(target=lambda: results.append(flight.do(key, fn)))
+    thread.start()
+    return thread
+
+
+def _run(flight, fn):
+    try:
+        return flight.do("key", fn)
+    except CancelledError:
+        return "cancelled"
+    except ValueError as e:
+        return str(e)
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def leader_fn():
+        calls.append("leader")
+        release.wait(5)
+        return "result"
+
+    results = []
+    leader = _follow(flight, "key", leader_fn, results)
+    _wait_until(lambda: flight.inflight() == 1)
+    follower = _follow(flight, "key", lambda: calls.append("follower"), results)
+    _wait_until(lambda: flight.coalesced == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == ["result", "result"]
+    assert calls == ["leader"]
+    assert flight.inflight() == 0
+
+
+def test_follower_runs_the_call_itself_when_the_leader_is_cancelled():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def cancelled():
+        release.wait(5)
+        raise CancelledError()
+
+    leader_results, follower_results = [], []
+    leader = threading.Thread(target=lambda: leader_results.append(_run(flight, cancelled)))
+    leader.start()
+    _wait_until(lambda: flight.inflight() == 1)
+    follower = _follow(flight, "key", lambda: "own result", follower_results)
+    _wait_until(lambda: flight.coalesced == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert leader_results == ["cancelled"]
+    assert follower_results == ["own result"]
+
+
+def test_errors_reach_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError("boom")
+
+    outcomes = []
+    leader = threading.Thread(target=lambda: outcomes.append(_run(flight, failing)))
+    leader.start()
+    _wait_until(lambda: flight.inflight() == 1)
+    follower = threading.Thread(target=lambda: outcomes.append(_run(flight, failing)))
+    follower.start()
+    _wait_until(lambda: flight.coalesced == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert outcomes == ["boom", "boom"]
+
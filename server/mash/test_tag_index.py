@@ -0,0 +1,44 @@
+from mash.records import ImageRecord
+from mash.tag_index import TagIndex, tokenize
+
+
+def _record(instance_id, description="", tags=(), **fields):
+    return ImageRecord(instance_id=instance_id, metadata={}, description=description, tags=tags, **fields)
+
+
+def test_tags_outrank_descriptions():
+    index = TagIndex()
+    index.add_many([
+        _record("tagged", tags=("sunset",)),
+        _record("described", description="a beach at sunset with palm trees"),
+        _record("unrelated", description="a city street", tags=("night",)),
+    ])
+    assert [instance_id for instance_id, _ in index.search("sunset")] == ["tagged", "described"]
+
+
+def test_results_are_limited_and_excluded():
+    index = TagIndex()
+    index.add_many(_record(f"img{i}", tags=("cat",)) for i in range(5))
+    assert len(index.search("cat", limit=2)) == 2
+    assert "img0" not in {instance_id for instance_id, _ in index.search("cat", exclude={"img0"})}
+    assert index.search("image of a") == []
+
+
+def test_replacing_a_record_drops_its_old_terms():
+    index = TagIndex()
+    index.add(_record("img", tags=("dog",)))
+    index.add(_record("img", tags=("horse",)))
+    assert index.search("dog") == []
+    assert [instance_id for instance_id, _ in index.search("horse")] == ["img"]
+    index.remove("img")
+    assert len(index) == 0 and index.search("horse") == []
+
+
+def test_style_and_content_are_searchable():
+    assert tokenize("the style image and the content image") == ["style", "content"]
+
+
+def test_failed_enrichment_description_is_not_indexed():
+    index = TagIndex()
+    index.add(_record("img", description="error describing image", enrichment_error="timeout"))
+    assert index.search("error describing") == []
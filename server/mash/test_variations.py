@@ -0,0 +1,54 @@
+import pytest
+
+from mash import variations
+from mash.gemini_client import GeminiRequestError
+from mash.records import ImageRecord
+
+
+def _response(count):
+    return {"candidates": [{"content": {"parts": [{"inlineData": {"data": f"img{i}"}}]}} for i in range(count)]}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(variations, "_single_candidate_models", set())
+    monkeypatch.setattr(variations, "save_debug_response", lambda response, record: None)
+    monkeypatch.setattr(variations, "save_generated_image", lambda image, record, prompt: "local.png")
+    return calls
+
+
+def _model(calls, monkeypatch, reply):
+    def generate_content(model_name, parts, generation_config, **kwargs):
+        per_call = generation_config.get("candidateCount", 1)
+        calls.append(per_call)
+        return reply(per_call)
+    monkeypatch.setattr(variations, "generate_content", generate_content)
+
+
+def test_candidates_are_requested_several_per_call(calls, monkeypatch):
+    monkeypatch.setattr(variations, "VARIATION_CANDIDATES_PER_CALL", 4)
+    _model(calls, monkeypatch, _response)
+    results = variations.generate_variations(ImageRecord("src", {}), 6, "model", skip_upload=True)
+    assert calls == [4, 2]
+    assert [result["variationNumber"] for result in results] == [1, 2, 3, 4, 5, 6]
+    assert all("error" not in result for result in results)
+
+
+def test_models_rejecting_candidate_count_fall_back_to_one_per_call(calls, monkeypatch):
+    def reply(per_call):
+        if per_call > 1:
+            raise GeminiRequestError("candidateCount not supported", status_code=400)
+        return _response(1)
+
+    _model(calls, monkeypatch, reply)
+    results = variations.generate_variations(ImageRecord("src", {}), 3, "model", skip_upload=True)
+    assert calls == [3, 1, 1, 1]
+    assert len(results) == 3 and "model" in variations._single_candidate_models
+
+
+def test_failed_calls_report_one_error_per_missing_variation(calls, monkeypatch):
+    _model(calls, monkeypatch, lambda per_call: {"candidates": []})
+    results = variations.generate_variations(ImageRecord("src", {}), 2, "model", skip_upload=True)
+    assert [result["variationNumber"] for result in results] == [1, 2]
+    assert all("error" in result for result in results)
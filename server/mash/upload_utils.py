@@ -4,8 +4,16 @@ import requests
 import base64
 import os
 import json
+import time
 from typing import List, Dict, Optional, Union, Tuple
 from dotenv import load_dotenv
+from utils.log import get_logger, get_item_logger
+from utils.metrics import histogram
+from utils.tracing import span
+from soot.connector import invalidate_space
+from soot.operations import post_operation
+from soot.upload_tracker import upload_tracker
+from .jobs import upload_listener
 
 # Global configuration
 #SOOT_API = "https://api.soot.com/graphql"
@@ -18,9 +26,13 @@ SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
 
 SOOT_API_URL = os.getenv("SOOT_API_URL")
 SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
-def log_message(message: str) -> None:
-   """Print log message to console"""
-   print(message)
+IMGUR_API_URL = os.getenv("IMGUR_API_URL", "https://api.imgur.com/3/image")
+
+logger = get_logger(__name__)
+item_logger = get_item_logger(__name__)  # Per-upload step messages, sampled
+
+UPLOAD_SECONDS = histogram("soot_upload_seconds", "End-to-end latency of upload_image_to_soot", ["outcome"])
+UPLOAD_STEP_SECONDS = histogram("soot_upload_step_seconds", "Latency of each upload step", ["step", "outcome"])
 
 def upload_image_to_soot(
    image_data: Union[str, bytes], 
@@ -43,7 +55,8 @@ def upload_image_to_soot(
            "success": True/False,
            "message": "Description message",
            "image_url": "Uploaded Imgur URL",
-           "soot_intent_id": "SOOT intent ID"
+           "soot_intent_id": "SOOT intent ID",
+           "upload_status": "Status of the intent when this returned (SOOT processes it asynchronously)"
        }
    """
    result = {
@@ -53,57 +66,68 @@ def upload_image_to_soot(
        "soot_intent_id": None
    }
    
-   try:
-       # Ensure image_data is in base64 format
-       if not is_base64:
-           if verbose:
-               log_message("[🔄] Converting binary data to base64...")
-           if isinstance(image_data, bytes):
+   with span("upload", spaceId=space_id, bytesSent=len(image_data)):
+      start = time.perf_counter()
+      try:
+         # Ensure image_data is in base64 format
+         if not is_base64:
+            if verbose:
+               item_logger.debug("Converting binary data to base64...")
+            if isinstance(image_data, bytes):
                image_data = base64.b64encode(image_data).decode('utf-8')
-           else:
+            else:
                raise ValueError("When is_base64=False, image_data must be bytes")
        
-       # 1. Upload to Imgur to get URL
-       if verbose:
-           log_message("[📤] Step 1: Uploading image to Imgur...")
-       image_url = upload_to_imgur(image_data, verbose=verbose)
-       if not image_url:
-           result["message"] = "Failed to upload image to Imgur"
-           return result
+         # 1. Upload to Imgur to get URL
+         if verbose:
+            item_logger.info("Step 1: Uploading image to Imgur...")
+         with UPLOAD_STEP_SECONDS.time(step="imgur"), span("upload.imgur", bytesSent=len(image_data)):
+            image_url = upload_to_imgur(image_data, verbose=verbose)
+         if not image_url:
+            result["message"] = "Failed to upload image to Imgur"
+            UPLOAD_SECONDS.observe(time.perf_counter() - start, outcome="error")
+            return result
        
-       result["image_url"] = image_url
+         result["image_url"] = image_url
        
-       # 2. Upload to SOOT
-       if verbose:
-           log_message(f"[📤] Step 2: Uploading image to SOOT space: {space_id}...")
+         # 2. Upload to SOOT
+         if verbose:
+            item_logger.info("Step 2: Uploading image to SOOT space: %s...", space_id)
        
-       # 2.1 Create upload intent
-       intent_id = create_upload_intent(space_id, verbose=verbose)
-       result["soot_intent_id"] = intent_id
+         # 2.1 Create upload intent
+         with UPLOAD_STEP_SECONDS.time(step="createUploadIntent"), span("upload.createUploadIntent", spaceId=space_id):
+            intent_id = create_upload_intent(space_id, verbose=verbose)
+         result["soot_intent_id"] = intent_id
        
-       # 2.2 Upload from URL
-       upload_image_from_url(intent_id, [image_url], verbose=verbose)
+         # 2.2 Upload from URL
+         with UPLOAD_STEP_SECONDS.time(step="uploadFromUrl"), span("upload.uploadFromUrl", intentId=intent_id):
+            upload_image_from_url(intent_id, [image_url], verbose=verbose)
        
-       # 2.3 Complete upload intent
-       complete_upload_intent(intent_id, verbose=verbose)
+         # 2.3 Complete upload intent
+         with UPLOAD_STEP_SECONDS.time(step="completeUploadIntent"), span("upload.completeUploadIntent", intentId=intent_id):
+            complete_upload_intent(intent_id, verbose=verbose)
        
-       result["success"] = True
-       result["message"] = "Image successfully uploaded to SOOT"
+         result["success"] = True
+         result["message"] = "Image successfully uploaded to SOOT"
+         # The space has a new publication; cached reads of it are out of date
+         invalidate_space(space_id, reason="upload")
+         # SOOT fetches the image in the background; follow the intent until it lands (reported on the running job)
+         result["upload_status"] = upload_tracker.track(intent_id, space_id, on_update=upload_listener())
        
-       if verbose:
-           log_message("[🎉] Upload process completed successfully!")
+         if verbose:
+            item_logger.info("Upload process completed successfully!")
        
-       return result
+         UPLOAD_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+         return result
        
-   except Exception as e:
-       error_message = str(e)
-       if verbose:
-           log_message(f"[❌] Upload process error: {error_message}")
-           import traceback
-           traceback.print_exc()
+      except Exception as e:
+         error_message = str(e)
+         if verbose:
+            logger.exception("Upload process error: %s", error_message)
        
-       result["message"] = f"Error: {error_message}"
-       return result
+         result["message"] = f"Error: {error_message}"
+         UPLOAD_SECONDS.observe(time.perf_counter() - start, outcome="error")
+         return result
 
 def upload_to_imgur(image_data_base64: str, verbose: bool = True) -> Optional[str]:
    """Upload base64 encoded image to Imgur and return URL"""
@@ -112,11 +136,11 @@ def upload_to_imgur(image_data_base64: str, verbose: bool = True) -> Optional[st
    
    try:
        if verbose:
-           log_message("[🔄] Uploading image to Imgur...")
-           log_message(f"[📊] Base64 image length: {len(image_data_base64)} characters")
+           item_logger.debug("Uploading image to Imgur...")
+           item_logger.debug("Base64 image length: %s characters", len(image_data_base64))
        
        # Imgur API endpoint
-       url = "https://api.imgur.com/3/image"
+       url = IMGUR_API_URL
        
        # Prepare headers and data
        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
@@ -126,12 +150,12 @@ def upload_to_imgur(image_data_base64: str, verbose: bool = True) -> Optional[st
        response = requests.post(url, headers=headers, data=data)
        
        if verbose:
-           log_message(f"[📡] Imgur API response status: {response.status_code}")
+           item_logger.debug("Imgur API response status: %s", response.status_code)
        
        # If error, print more information
        if response.status_code != 200:
            if verbose:
-               log_message(f"[❌] Imgur API error: {response.text}")
+               logger.error("Imgur API error: %s", response.text)
            response.raise_for_status()
        
        # Parse response
@@ -139,7 +163,7 @@ def upload_to_imgur(image_data_base64: str, verbose: bool = True) -> Optional[st
        if not result["success"]:
            error_msg = result.get("data", {}).get("error", "Unknown error")
            if verbose:
-               log_message(f"[❌] Imgur upload failed: {error_msg}")
+               logger.error("Imgur upload failed: %s", error_msg)
            raise Exception(f"Imgur API error: {error_msg}")
        
        # Get image URL and delete hash
@@ -147,169 +171,128 @@ def upload_to_imgur(image_data_base64: str, verbose: bool = True) -> Optional[st
        delete_hash = result["data"]["deletehash"]
        
        if verbose:
-           log_message(f"[✅] Image uploaded to Imgur successfully!")
-           log_message(f"[🔗] Image URL: {image_url}")
-           log_message(f"[🗑️] Delete hash (for image removal): {delete_hash}")
+           item_logger.info("Image uploaded to Imgur successfully!")
+           item_logger.debug("Image URL: %s", image_url)
+           item_logger.debug("Delete hash (for image removal): %s", delete_hash)
        
        return image_url
        
    except Exception as e:
        if verbose:
-           log_message(f"[❌] Imgur upload error: {e}")
+           logger.error("Imgur upload error: %s", e)
        raise
 
 def create_upload_intent(space_id: str, verbose: bool = True) -> str:
    """Create SOOT upload intent"""
    if verbose:
-       log_message(f"[🔄] Creating upload intent for space '{space_id}'...")
+       item_logger.debug("Creating upload intent for space '%s'...", space_id)
    
    if not SOOT_ACCESS_TOKEN:
        raise ValueError("SOOT_ACCESS_TOKEN not provided")
    
-   payload = {
-       "query": """
-       mutation CreateUploadIntent($request: CreateUploadIntentRequest!) {
-         createUploadIntent(request: $request) {
-           __typename
-           ... on CreateUploadIntentResult { uploadIntent { id } }
-           ... on PermissionDeniedError { reason }
-           ... on NotFoundError { entity }
-         }
-       }
-       """,
-       "variables": {"request": {"source": {"url": {}}, "destination": {"space": space_id}}},
-       "operationName": "CreateUploadIntent"
-   }
-   headers = {"Authorization": f"Bearer {SOOT_ACCESS_TOKEN}", "Content-Type": "application/json"}
+   variables = {"request": {"source": {"url": {}}, "destination": {"space": space_id}}}
 
    try:
-       response = requests.post(SOOT_API, headers=headers, json=payload)
+       response = post_operation("CreateUploadIntent", variables)
        
        if verbose:
-           log_message(f"[📡] SOOT API response status: {response.status_code}")
+           item_logger.debug("SOOT API response status: %s", response.status_code)
        
        if response.status_code != 200:
            if verbose:
-               log_message(f"[❌] SOOT API error: {response.text}")
+               logger.error("SOOT API error: %s", response.text)
            response.raise_for_status()
            
        result = response.json()
        if 'errors' in result:
            if verbose:
-               log_message(f"[❌] GraphQL errors: {result['errors']}")
+               logger.error("GraphQL errors: %s", result['errors'])
            raise Exception(f"GraphQL errors: {result['errors']}")
 
        intent = result['data']['createUploadIntent'].get('uploadIntent', {})
        intent_id = intent.get('id')
        if not intent_id:
            if verbose:
-               log_message(f"[❌] Failed to extract uploadIntent ID: {result}")
+               logger.error("Failed to extract uploadIntent ID: %s", result)
            raise Exception(f"Failed to extract uploadIntent ID: {result}")
 
        if verbose:
-           log_message(f"[🔑] Upload intent created: ID={intent_id}")
+           item_logger.info("Upload intent created: ID=%s", intent_id)
        return intent_id
    
    except Exception as e:
        if verbose:
-           log_message(f"[❌] Error creating upload intent: {e}")
+           logger.error("Error creating upload intent: %s", e)
        raise
 
 def upload_image_from_url(intent_id: str, image_urls: List[str], verbose: bool = True):
    """Upload image from URL to SOOT"""
    if verbose:
-       log_message(f"[🔄] Uploading image from URL to SOOT...")
-       log_message(f"[📊] Upload intent ID: {intent_id}")
-       log_message(f"[📊] Image URL: {image_urls[0]}")
+       item_logger.debug("Uploading image from URL to SOOT...")
+       item_logger.debug("Upload intent ID: %s", intent_id)
+       item_logger.debug("Image URL: %s", image_urls[0])
    
-   payload = {
-       "query": """
-       mutation UploadFromUrl($request: UploadFromUrlRequest!) {
-         uploadFromUrl(request: $request) {
-           __typename
-           ... on UploadFromUrlResult { __typename }
-           ... on PermissionDeniedError { reason }
-           ... on ValidationError { field reason }
-         }
-       }
-       """,
-       "variables": {"request": {"uploadIntent": intent_id, "urls": image_urls}},
-       "operationName": "UploadFromUrl"
-   }
-   headers = {"Authorization": f"Bearer {SOOT_ACCESS_TOKEN}", "Content-Type": "application/json"}
+   variables = {"request": {"uploadIntent": intent_id, "urls": image_urls}}
 
    try:
-       response = requests.post(SOOT_API, headers=headers, json=payload)
+       response = post_operation("UploadFromUrl", variables)
        
        if verbose:
-           log_message(f"[📡] SOOT API response status: {response.status_code}")
+           item_logger.debug("SOOT API response status: %s", response.status_code)
        
        if response.status_code != 200:
            if verbose:
-               log_message(f"[❌] SOOT API error: {response.text}")
+               logger.error("SOOT API error: %s", response.text)
            response.raise_for_status()
            
        result = response.json()
        if 'errors' in result:
            if verbose:
-               log_message(f"[❌] GraphQL errors: {result['errors']}")
+               logger.error("GraphQL errors: %s", result['errors'])
            raise Exception(f"GraphQL errors: {result['errors']}")
 
        typename = result['data']['uploadFromUrl']['__typename']
        if typename != "UploadFromUrlResult":
            if verbose:
-               log_message(f"[❌] Upload failed: {typename}")
+               logger.error("Upload failed: %s", typename)
            raise Exception(f"Upload failed: {typename}")
 
        if verbose:
-           log_message(f"[✅] Upload request accepted; SOOT will fetch the image.")
+           item_logger.info("Upload request accepted; SOOT will fetch the image.")
    
    except Exception as e:
        if verbose:
-           log_message(f"[❌] Error uploading image from URL: {e}")
+           logger.error("Error uploading image from URL: %s", e)
        raise
 
 def complete_upload_intent(intent_id: str, count: int = 1, verbose: bool = True):
    """Complete SOOT upload intent"""
    if verbose:
-       log_message(f"[🔄] Completing upload intent '{intent_id}' with {count} file(s)...")
+       item_logger.debug("Completing upload intent '%s' with %s file(s)...", intent_id, count)
    
-   payload = {
-       "query": """
-       mutation CompleteUploadIntent($request: CompleteUploadIntentRequest!) {
-         completeUploadIntent(request: $request) {
-           __typename
-           ... on CompleteUploadIntentResult { uploadIntent { id } }
-           ... on ValidationError { field reason }
-         }
-       }
-       """,
-       "variables": {"request": {"uploadIntent": intent_id, "filesUploaded": count}},
-       "operationName": "CompleteUploadIntent"
-   }
-   headers = {"Authorization": f"Bearer {SOOT_ACCESS_TOKEN}", "Content-Type": "application/json"}
+   variables = {"request": {"uploadIntent": intent_id, "filesUploaded": count}}
 
    try:
-       response = requests.post(SOOT_API, headers=headers, json=payload)
+       response = post_operation("CompleteUploadIntent", variables)
        
        if verbose:
-           log_message(f"[📡] SOOT API response status: {response.status_code}")
+           item_logger.debug("SOOT API response status: %s", response.status_code)
        
        if response.status_code != 200:
            if verbose:
-               log_message(f"[❌] SOOT API error: {response.text}")
+               logger.error("SOOT API error: %s", response.text)
            response.raise_for_status()
            
        result = response.json()
        if 'errors' in result:
            if verbose:
-               log_message(f"[❌] GraphQL errors: {result['errors']}")
+               logger.error("GraphQL errors: %s", result['errors'])
            raise Exception(f"GraphQL errors: {result['errors']}")
 
        if verbose:
-           log_message(f"[✅] Upload intent '{intent_id}' completed.")
+           item_logger.info("Upload intent '%s' completed.", intent_id)
    
    except Exception as e:
        if verbose:
-           log_message(f"[❌] Error completing upload intent: {e}")
+           logger.error("Error completing upload intent: %s", e)
        raise
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from .gemini_client import GeminiRequestError, generate_content
+from .gemini_scheduler import PRIORITY_INTERACTIVE
+from .generation import (
+    IMAGE_GENERATION_CONFIG,
+    build_operation_parts,
+    extract_generated_outputs,
+    save_debug_response,
+    save_generated_image,
+    upload_generated_image,
+)
+from .records import ImageRecord
+from utils.log import get_logger
+from utils.tracing import bind_context
+
+logger = get_logger(__name__)
+
+# Upper bound for variation:[n]
+VARIATION_MAX_COUNT = int(os.getenv("MASH_VARIATION_MAX_COUNT", "12"))
+# Candidates requested per model call (models that reject candidateCount fall back to 1)
+VARIATION_CANDIDATES_PER_CALL = int(os.getenv("MASH_VARIATION_CANDIDATES_PER_CALL", "4"))
+VARIATION_UPLOAD_CONCURRENCY = int(os.getenv("MASH_VARIATION_UPLOAD_CONCURRENCY", "4"))
+VARIATION_TEMPERATURE = 1.0  # Higher than edits so candidates of one call differ
+
+# Uploads run here so the next generation call does not wait for the previous upload
+_upload_executor = ThreadPoolExecutor(max_workers=VARIATION_UPLOAD_CONCURRENCY, thread_name_prefix="variation-upload")
+
+# Models that rejected (or ignored) candidateCount > 1
+_single_candidate_models: Set[str] = set()
+
+
+def _variation_prompt(number: int, count: int, per_call: int) -> str:
+    prompt = "Create a visually distinctive variation of this image with different composition, lighting, or style."
+    if per_call == 1:
+        # Distinct prompts keep single-candidate calls from being coalesced into one
+        prompt += f" Variation {number} of {count}."
+    return prompt
+
+
+def _error_result(image_record: ImageRecord, number: int, count: int, error: str) -> Dict:
+    return {
+        "sourceImageId": image_record.instance_id,
+        "variationNumber": number,
+        "totalVariations": count,
+        "error": f"Failed to create variation: {error}"
+    }
+
+
+def generate_variations(image_record: ImageRecord, count: int, model_name: str, skip_upload: bool = False) -> List[Dict]:
+    """
+    Generate `count` variations of one image, requesting several candidates per
+    model call where the model supports it and uploading each image as soon
+    as it is saved.
+
+    Args:
+        image_record: The source image record
+        count: Number of variations to generate
+        model_name: Image generation model
+        skip_upload: If True, skip the SOOT upload step
+
+    Returns:
+        One result per variation (in variation order), in the same shape as
+        apply_operation_to_image results, or an error entry
+    """
+    results: List[Dict] = []
+    uploads: List[Tuple[Dict, Future]] = []
+
+    while len(results) < count:
+        remaining = count - len(results)
+        per_call = 1 if model_name in _single_candidate_models else min(remaining, VARIATION_CANDIDATES_PER_CALL)
+        prompt = _variation_prompt(len(results) + 1, count, per_call)
+
+        generation_config = dict(IMAGE_GENERATION_CONFIG, temperature=VARIATION_TEMPERATURE)
+        if per_call > 1:
+            generation_config["candidateCount"] = per_call
+
+        try:
+            response = generate_content(
+                model_name,
+                build_operation_parts(image_record, prompt),
+                generation_config,
+                priority=PRIORITY_INTERACTIVE,
+                coalesce=False
+            )
+        except GeminiRequestError as e:
+            if per_call > 1 and e.status_code == 400:
+                logger.info("%s rejected candidateCount=%s, falling back to one candidate per call", model_name, per_call)
+                _single_candidate_models.add(model_name)
+                continue
+            logger.error("Error creating variations for %s: %s", image_record.instance_id[:6], e)
+            for _ in range(per_call):
+                results.append(_error_result(image_record, len(results) + 1, count, str(e)))
+            continue
+
+        save_debug_response(response, image_record)
+        outputs = [output for output in extract_generated_outputs(response) if "imageBase64" in output]
+
+        if not outputs:
+            for _ in range(per_call):
+                results.append(_error_result(image_record, len(results) + 1, count, "No image in response"))
+            continue
+        if per_call > 1 and len(outputs) == 1:
+            # The model silently ignored candidateCount
+            _single_candidate_models.add(model_name)
+
+        for output in outputs[:remaining]:
+            result = {
+                "originalInstanceId": image_record.instance_id,
+                "prompt": prompt,
+                "originalPrompt": prompt,
+                "result": output,
+                "originalMetadata": image_record.metadata,
+                "originalDescription": image_record.description,
+                "originalTags": list(image_record.tags),
+                "sourceImageId": image_record.instance_id,
+                "variationNumber": len(results) + 1,
+                "totalVariations": count
+            }
+            try:
+                result["localFilename"] = save_generated_image(output["imageBase64"], image_record, prompt)
+            except Exception as e:
+                logger.error("Error saving variation image: %s", e)
+
+            if not skip_upload:
+                uploads.append((result, _upload_executor.submit(bind_context(upload_generated_image), output["imageBase64"], image_record)))
+            results.append(result)
+
+        logger.info("Completed %s/%s variations for image %s", len(results), count, image_record.instance_id[:6])
+
+    # Collect the pipelined uploads
+    for result, future in uploads:
+        try:
+            upload_result = future.result()
+            if upload_result is not None:
+                result["sootUploadResult"] = upload_result
+        except Exception as e:
+            logger.error("Error uploading variation %s: %s", result['variationNumber'], e)
+            result["sootUploadResult"] = {"success": False, "message": f"Error: {e}"}
+
+    return results
@@ -1,75 +1,202 @@
+import asyncio
+import json
 import os
-import requests
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
 from dotenv import load_dotenv
-import json
+from utils.log import get_logger, LazyJson
+from utils.metrics import histogram
+from .operations import post_operation
+from .read_cache import read_cache
+from .space_watcher import SOOT_CACHE_WATCH, SpaceWatcher
+from .subscriptions import subscriptions
 
 load_dotenv()
 
-SOOT_API_URL = os.getenv("SOOT_API_URL")
 SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
+# Publications fetched per request when paging through a space
+SOOT_PAGE_SIZE = int(os.getenv("SOOT_PAGE_SIZE", "100"))
+# Streamed spaces with at most this many publications are also cached
+SOOT_CACHE_MAX_EDGES = int(os.getenv("SOOT_CACHE_MAX_EDGES", "2000"))
+
+logger = get_logger(__name__)
+
+SOOT_QUERY_SECONDS = histogram("soot_query_seconds", "Latency of SOOT GraphQL queries", ["operation", "outcome"])
+
+
+def _succeeded(data) -> bool:
+    """Whether a GraphQL response is worth caching (no errors)"""
+    return isinstance(data, dict) and data.get("data") is not None and not data.get("errors")
 
-HEADERS = {
-    "Authorization": f"Bearer {SOOT_ACCESS_TOKEN}",
-    "Content-Type": "application/json",
-}
+
+def invalidate_space(space_id: str, reason: str = "explicit"):
+    """Drop a space's cached items and the cached space list, e.g. after uploading to it"""
+    read_cache.invalidate("getSpaceById", space_id, reason=reason)
+    read_cache.invalidate("viewerSpaces", reason=reason)
+
+
+def _on_space_event(space_id: str, event_type: str):
+    if event_type == "ArrangementGroupCreatedEvent":
+        read_cache.invalidate("getSpaceById", space_id, reason=event_type)
+    else:
+        invalidate_space(space_id, reason=event_type)
+
+
+# Changes pushed by SOOT invalidate cached reads before their TTL runs out
+space_watcher = SpaceWatcher(subscriptions, _on_space_event)
 
 
 def get_user_spaces():
-    query = """
-    query {
-      viewer {
-        spaces {
-          id
-          displayName
-        }
-      }
-    }
-    """
-    response = requests.post(SOOT_API_URL, json={"query": query}, headers=HEADERS)
-    return response.json()
+    return read_cache.get("viewerSpaces", "", _fetch_user_spaces, _succeeded)
 
 
 def get_space_items(space_id: str):
-    query = f"""
-    query {{
-      getSpaceById(request: {{ id: "{space_id}" }}) {{
-        ... on GetSpaceByIdResult {{
-          space {{
-            publications {{
-              edges {{
-                node {{
-                  id
-                }}
-              }}
-            }}
-          }}
-        }}
-      }}
-    }}
-    """
-    response = requests.post(SOOT_API_URL, json={"query": query}, headers=HEADERS)
-    data = response.json()
-    print("GraphQL response:")
-    print(json.dumps(data, indent=2))
+    data = read_cache.get("getSpaceById", space_id, lambda: _fetch_space_items(space_id), _succeeded)
+    if SOOT_CACHE_WATCH:
+        space_watcher.watch(space_id)
     return data
 
+
 def get_publication_snapshot_url(publication_id: str):
-    query = f"""
-    query {{
-      getSpacePublicationById(request: {{ id: "{publication_id}" }}) {{
-        ... on GetSpacePublicationByIdResult {{
-          spacePublication {{
-            id
-            snapshotUrl
-          }}
-        }}
-      }}
-    }}
+    return read_cache.get("getSpacePublicationById", publication_id,
+                          lambda: _fetch_publication_snapshot_url(publication_id),
+                          lambda result: "snapshot_url" in result)
+
+
+def _fetch_user_spaces():
+    with SOOT_QUERY_SECONDS.time(operation="viewerSpaces"):
+        return post_operation("ViewerSpaces").json()
+
+
+class SootQueryError(Exception):
+    """Raised when a paginated SOOT query returns errors or an unexpected shape"""
+
+    def __init__(self, message: str, errors: Optional[List[Dict]] = None):
+        super().__init__(message)
+        self.errors = errors or [{"message": message}]
+
+
+def _fetch_publications_page(space_id: str, first: int, after: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+    """
+    One page of a space's publications
+
+    Returns:
+        (edges, cursor of the next page or None if this was the last page)
+
+    Raises:
+        SootQueryError: If the query failed
     """
-    response = requests.post(SOOT_API_URL, json={"query": query}, headers=HEADERS)
-    data = response.json()
-    print("Snapshot URL response:")
-    print(json.dumps(data, indent=2))
+    variables = {"request": {"id": space_id}, "filter": {"first": first, "after": after}}
+    with SOOT_QUERY_SECONDS.time(operation="getSpaceById"):
+        data = post_operation("SpacePublications", variables).json()
+    logger.debug("Publications page (after %s): %s", after, LazyJson(data))
+    if data.get("errors"):
+        raise SootQueryError(f"getSpaceById failed for space {space_id}", data["errors"])
+    try:
+        publications = data["data"]["getSpaceById"]["space"]["publications"]
+    except (KeyError, TypeError):
+        raise SootQueryError(f"Space {space_id} not found or has no publications")
+    edges = publications.get("edges") or []
+    page_info = publications.get("pageInfo") or {}
+    cursor = page_info.get("endCursor")
+    # Servers without cursor support return everything at once; never ask for the same page twice
+    if not page_info.get("hasNextPage") or not edges or cursor is None or cursor == after:
+        cursor = None
+    return edges, cursor
+
+
+def iter_space_publications(space_id: str, page_size: int = SOOT_PAGE_SIZE) -> Iterator[List[Dict]]:
+    """
+    Yield a space's publication edges page by page
+
+    Raises:
+        SootQueryError: If a page could not be fetched
+    """
+    after = None
+    while True:
+        edges, after = _fetch_publications_page(space_id, page_size, after)
+        yield edges
+        if after is None:
+            return
+
+
+async def stream_space_publications(space_id: str, page_size: int = SOOT_PAGE_SIZE) -> AsyncIterator[List[Dict]]:
+    """
+    Yield a space's publication edges page by page, fetching the next page
+    while the caller works on the current one
+
+    Raises:
+        SootQueryError: If a page could not be fetched
+    """
+    next_page = asyncio.ensure_future(asyncio.to_thread(_fetch_publications_page, space_id, page_size, None))
+    try:
+        while next_page is not None:
+            edges, after = await next_page
+            next_page = None
+            if after is not None:
+                next_page = asyncio.ensure_future(asyncio.to_thread(_fetch_publications_page, space_id, page_size, after))
+            yield edges
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+def _space_items_response(edges: List[Dict]) -> Dict:
+    """All publications of a space in the getSpaceById response shape"""
+    return {"data": {"getSpaceById": {"space": {"publications": {"edges": edges}}}}}
+
+
+def _fetch_space_items(space_id: str):
+    edges = []
+    try:
+        for page in iter_space_publications(space_id):
+            edges.extend(page)
+    except SootQueryError as e:
+        return {"data": None, "errors": e.errors}
+    return _space_items_response(edges)
+
+
+async def stream_space_items_json(space_id: str, page_size: int = SOOT_PAGE_SIZE) -> AsyncIterator[str]:
+    """
+    A space's publications as a streamed getSpaceById JSON response
+
+    Edges are written as each page arrives, so large spaces are never held
+    in memory; a failure part way through ends the document with "errors".
+    Spaces of up to SOOT_CACHE_MAX_EDGES publications are cached as well.
+    """
+    cached = read_cache.peek("getSpaceById", space_id)
+    if cached is not None:
+        yield json.dumps(cached)
+        return
+    version = read_cache.version("getSpaceById", space_id)
+    kept: Optional[List[Dict]] = []
+    count = 0
+    yield '{"data":{"getSpaceById":{"space":{"publications":{"edges":['
+    try:
+        async for page in stream_space_publications(space_id, page_size):
+            for edge in page:
+                yield ("," if count else "") + json.dumps(edge)
+                count += 1
+            if kept is not None:
+                kept.extend(page)
+                if len(kept) > SOOT_CACHE_MAX_EDGES:
+                    kept = None
+    except Exception as e:
+        logger.warning("Streaming publications of space %s failed after %s: %s", space_id, count, e)
+        errors = e.errors if isinstance(e, SootQueryError) else [{"message": str(e)}]
+        yield ']}}}},"errors":' + json.dumps(errors) + '}'
+        return
+    yield ']}}}}}'
+    if kept is not None:
+        read_cache.put("getSpaceById", space_id, _space_items_response(kept), version)
+        if SOOT_CACHE_WATCH:
+            space_watcher.watch(space_id)
+
+
+def _fetch_publication_snapshot_url(publication_id: str):
+    with SOOT_QUERY_SECONDS.time(operation="getSpacePublicationById"):
+        data = post_operation("SpacePublicationSnapshot", {"request": {"id": publication_id}}).json()
+    logger.debug("Snapshot URL response: %s", LazyJson(data))
 
     try:
         url = data["data"]["getSpacePublicationById"]["spacePublication"]["snapshotUrl"]
@@ -0,0 +1,603 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+import requests
+from dotenv import load_dotenv
+from utils.log import get_logger
+from utils.metrics import counter
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+SOOT_API_URL = os.getenv("SOOT_API_URL")
+SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
+
+HEADERS = {
+    "Authorization": f"Bearer {SOOT_ACCESS_TOKEN}",
+    "Content-Type": "application/json",
+}
+
+# The bundled introspection result, and where its compact index is cached
+SCHEMA_PATH = os.getenv("SOOT_SCHEMA_PATH", os.path.join(os.path.dirname(__file__), "..", "..", "schema.json"))
+SCHEMA_INDEX_PATH = os.getenv("SOOT_SCHEMA_INDEX_PATH", os.path.join("cache", "soot_schema_index.json"))
+# strict: refuse to start if an operation does not match the schema; warn: log it; off: skip
+VALIDATE_OPERATIONS = os.getenv("SOOT_VALIDATE_OPERATIONS", "strict")
+# Send operations as persisted-query hashes (automatic persisted queries), falling back to the full document
+PERSISTED_QUERIES = os.getenv("SOOT_PERSISTED_QUERIES", "0") in ("1", "true", "True")
+
+PERSISTED_QUERY_REQUESTS = counter("soot_persisted_queries_total",
+                                   "Operations sent as persisted-query hashes by result (hit, registered, unsupported)",
+                                   ["result"])
+
+# Every GraphQL operation the server sends to SOOT, with minimal selections
+DOCUMENTS = [
+    """
+    query ViewerSpaces {
+      viewer { spaces { id displayName } }
+    }
+    """,
+    """
+    query SpacePublications($request: GetSpaceByIdRequest!, $filter: SpacePublicationPageFilter) {
+      getSpaceById(request: $request) {
+        ... on GetSpaceByIdResult {
+          space {
+            publications(filter: $filter) {
+              edges { cursor node { id } }
+              pageInfo { endCursor hasNextPage }
+            }
+          }
+        }
+      }
+    }
+    """,
+    """
+    query SpacePublicationSnapshot($request: GetSpacePublicationByIdRequest!) {
+      getSpacePublicationById(request: $request) {
+        ... on GetSpacePublicationByIdResult { spacePublication { id snapshotUrl } }
+      }
+    }
+    """,
+    """
+    mutation CreateUploadIntent($request: CreateUploadIntentRequest!) {
+      createUploadIntent(request: $request) {
+        __typename
+        ... on CreateUploadIntentResult { uploadIntent { id } }
+        ... on PermissionDeniedError { reason }
+        ... on NotFoundError { entity }
+      }
+    }
+    """,
+    """
+    mutation UploadFromUrl($request: UploadFromUrlRequest!) {
+      uploadFromUrl(request: $request) {
+        __typename
+        ... on PermissionDeniedError { reason }
+        ... on ValidationError { field reason }
+      }
+    }
+    """,
+    """
+    mutation CompleteUploadIntent($request: CompleteUploadIntentRequest!) {
+      completeUploadIntent(request: $request) {
+        __typename
+        ... on CompleteUploadIntentResult { uploadIntent { id } }
+        ... on ValidationError { field reason }
+      }
+    }
+    """,
+    """
+    subscription WatchSpaceDerivedState($request: WatchSpaceDerivedStateRequest!) {
+      watchSpaceDerivedState(request: $request) { __typename }
+    }
+    """,
+    """
+    query UploadIntentState($request: GetUploadIntentByIdRequest!) {
+      getUploadIntentById(request: $request) {
+        __typename
+        ... on GetUploadIntentByIdResult {
+          uploadIntent {
+            id
+            state {
+              __typename
+              ... on UploadIntentCompletedState { filesUploaded elapsedMilliseconds }
+              ... on UploadIntentInProgressState {
+                percentUploaded uploadedFiles erroredFiles unsupportedFiles
+                rejectedAsDuplicateFiles rejectedDueToSpaceSizeFiles
+              }
+            }
+          }
+        }
+      }
+    }
+    """,
+    """
+    subscription WatchUploadIntent($request: WatchUploadIntentRequest!) {
+      watchUploadIntent(request: $request) {
+        __typename
+        ... on UploadIntentUpdatedEvent {
+          uploadIntent {
+            id
+            state {
+              __typename
+              ... on UploadIntentCompletedState { filesUploaded elapsedMilliseconds }
+              ... on UploadIntentInProgressState {
+                percentUploaded uploadedFiles erroredFiles unsupportedFiles
+                rejectedAsDuplicateFiles rejectedDueToSpaceSizeFiles
+              }
+            }
+          }
+        }
+      }
+    }
+    """,
+]
+
+
+class GraphQLDocumentError(Exception):
+    """Raised for operation documents that cannot be parsed"""
+
+
+def _type_ref(ref: Dict) -> str:
+    """Introspection type reference as GraphQL type syntax (e.g. "[Space!]!")"""
+    if ref["kind"] == "NON_NULL":
+        return _type_ref(ref["ofType"]) + "!"
+    if ref["kind"] == "LIST":
+        return "[" + _type_ref(ref["ofType"]) + "]"
+    return ref["name"]
+
+
+def _input_ref(value: Dict) -> str:
+    # A non-null argument with a default may be omitted, so it validates like a nullable one
+    type_ref = _type_ref(value["type"])
+    return type_ref[:-1] if value.get("defaultValue") is not None and type_ref.endswith("!") else type_ref
+
+
+def build_schema_index(introspection: Dict) -> Dict:
+    """
+    Compact form of an introspection result: per type its kind, fields
+    (type and arguments), input fields and possible types, as type strings
+    """
+    schema = (introspection.get("data") or introspection)["__schema"]
+    types = {}
+    for graphql_type in schema["types"]:
+        if graphql_type["name"].startswith("__"):
+            continue
+        entry: Dict[str, Any] = {"kind": graphql_type["kind"]}
+        if graphql_type.get("fields"):
+            entry["fields"] = {
+                field["name"]: {"type": _type_ref(field["type"]),
+                                "args": {arg["name"]: _input_ref(arg) for arg in field.get("args") or []}}
+                for field in graphql_type["fields"]
+            }
+        if graphql_type.get("inputFields"):
+            entry["inputFields"] = {field["name"]: _input_ref(field) for field in graphql_type["inputFields"]}
+        if graphql_type.get("possibleTypes"):
+            entry["possibleTypes"] = sorted(possible["name"] for possible in graphql_type["possibleTypes"])
+        types[graphql_type["name"]] = entry
+    roots = {
+        operation: (schema.get(f"{operation}Type") or {}).get("name")
+        for operation in ("query", "mutation", "subscription")
+    }
+    return {"roots": roots, "types": types}
+
+
+_schema_index: Optional[Dict] = None
+_schema_index_lock = threading.Lock()
+
+
+def schema_index() -> Dict:
+    """
+    The compact index of SCHEMA_PATH, built once and cached on disk next
+    to the image cache (rebuilt whenever schema.json changes)
+    """
+    global _schema_index
+    with _schema_index_lock:
+        if _schema_index is not None:
+            return _schema_index
+        with open(SCHEMA_PATH, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        try:
+            with open(SCHEMA_INDEX_PATH) as f:
+                cached = json.load(f)
+            if cached.get("schemaDigest") == digest:
+                _schema_index = cached["index"]
+                return _schema_index
+        except (OSError, ValueError, KeyError):
+            pass
+        _schema_index = build_schema_index(json.loads(raw))
+        try:
+            os.makedirs(os.path.dirname(SCHEMA_INDEX_PATH) or ".", exist_ok=True)
+            with open(SCHEMA_INDEX_PATH + ".tmp", "w") as f:
+                json.dump({"schemaDigest": digest, "index": _schema_index}, f, separators=(",", ":"))
+            os.replace(SCHEMA_INDEX_PATH + ".tmp", SCHEMA_INDEX_PATH)
+        except OSError as e:
+            logger.warning("Could not cache the schema index: %s", e)
+        logger.info("Indexed %s schema types from %s", len(_schema_index["types"]), SCHEMA_PATH)
+        return _schema_index
+
+
+_TOKEN = re.compile(r'\s+|,|#[^\n]*|(\.\.\.|[!$():=@\[\]{}|]|[_A-Za-z][_0-9A-Za-z]*|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|"(?:[^"\\]|\\.)*")')
+
+
+def _tokenize(document: str) -> List[str]:
+    tokens, position = [], 0
+    while position < len(document):
+        match = _TOKEN.match(document, position)
+        if match is None:
+            raise GraphQLDocumentError(f"Unexpected character {document[position]!r} at {position}")
+        if match.group(1):
+            tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser for the executable subset used here (no named fragments or directives)"""
+
+    def __init__(self, document: str):
+        self.tokens = _tokenize(document)
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise GraphQLDocumentError(f"Expected {expected or 'a token'}, got {token!r}")
+        self.position += 1
+        return token
+
+    def operation(self) -> Dict:
+        kind = self.take()
+        if kind not in ("query", "mutation", "subscription"):
+            raise GraphQLDocumentError(f"Expected an operation, got {kind!r}")
+        name = self.take() if self.peek() not in ("(", "{") else None
+        variables = {}
+        if self.peek() == "(":
+            self.take("(")
+            while self.peek() != ")":
+                self.take("$")
+                variable = self.take()
+                self.take(":")
+                variables[variable] = self.type_ref()
+                if self.peek() == "=":
+                    self.take("=")
+                    self.value()
+                    variables[variable] = variables[variable].rstrip("!")
+            self.take(")")
+        selections = self.selection_set()
+        if self.peek() is not None:
+            raise GraphQLDocumentError(f"Unexpected {self.peek()!r} after the operation")
+        return {"kind": kind, "name": name, "variables": variables, "selections": selections}
+
+    def type_ref(self) -> str:
+        if self.peek() == "[":
+            self.take("[")
+            inner = self.type_ref()
+            self.take("]")
+            ref = f"[{inner}]"
+        else:
+            ref = self.take()
+        if self.peek() == "!":
+            self.take("!")
+            ref += "!"
+        return ref
+
+    def selection_set(self) -> List[Dict]:
+        self.take("{")
+        selections = []
+        while self.peek() != "}":
+            if self.peek() == "...":
+                self.take("...")
+                self.take("on")
+                selections.append({"on": self.take(), "selections": self.selection_set()})
+                continue
+            name = self.take()
+            if self.peek() == ":":
+                self.take(":")
+                name = self.take()  # Aliases do not change validation
+            args = {}
+            if self.peek() == "(":
+                self.take("(")
+                while self.peek() != ")":
+                    arg = self.take()
+                    self.take(":")
+                    args[arg] = self.value()
+                self.take(")")
+            selections.append({"field": name, "args": args,
+                               "selections": self.selection_set() if self.peek() == "{" else None})
+        self.take("}")
+        return selections
+
+    def value(self) -> Any:
+        token = self.take()
+        if token == "$":
+            return {"$": self.take()}
+        if token == "[":
+            items = []
+            while self.peek() != "]":
+                items.append(self.value())
+            self.take("]")
+            return items
+        if token == "{":
+            fields = {}
+            while self.peek() != "}":
+                field = self.take()
+                self.take(":")
+                fields[field] = self.value()
+            self.take("}")
+            return {"{": fields}
+        return {"literal": token}
+
+
+def parse_operation(document: str) -> Dict:
+    """Parse a single-operation document into variables and nested selections"""
+    return _Parser(document).operation()
+
+
+def _named(type_ref: str) -> str:
+    return type_ref.strip("[]!")
+
+
+def _compatible(variable_type: str, location_type: str) -> bool:
+    """Whether a variable of one type may be used where another is expected"""
+    if variable_type == location_type:
+        return True
+    # A non-null variable fits a nullable location, at any list depth
+    return variable_type.endswith("!") and not location_type.endswith("!") and \
+        _compatible(variable_type[:-1], location_type)
+
+
+class _Validator:
+    def __init__(self, index: Dict, operation: Dict):
+        self.types = index["types"]
+        self.roots = index["roots"]
+        self.operation = operation
+        self.used_variables = set()
+        self.errors: List[str] = []
+
+    def validate(self) -> List[str]:
+        operation = self.operation
+        root = self.roots.get(operation["kind"])
+        if not root:
+            return [f"Schema has no {operation['kind']} type"]
+        for variable, type_ref in operation["variables"].items():
+            kind = self.types.get(_named(type_ref), {}).get("kind")
+            if kind not in ("INPUT_OBJECT", "SCALAR", "ENUM"):
+                self.errors.append(f"${variable}: {type_ref} is not an input type")
+        self.selections(root, operation["selections"], root)
+        for variable in set(operation["variables"]) - self.used_variables:
+            self.errors.append(f"${variable} is declared but never used")
+        return self.errors
+
+    def selections(self, type_name: str, selections: List[Dict], path: str):
+        graphql_type = self.types.get(type_name, {})
+        for selection in selections:
+            if "on" in selection:
+                condition = selection["on"]
+                if condition != type_name and condition not in graphql_type.get("possibleTypes", []):
+                    self.errors.append(f"{path}: {condition} can never be a {type_name}")
+                    continue
+                self.selections(condition, selection["selections"], f"{path}(on {condition})")
+                continue
+            name = selection["field"]
+            if name == "__typename":
+                continue
+            field = graphql_type.get("fields", {}).get(name)
+            if field is None:
+                self.errors.append(f"{path}: {type_name} has no field {name}")
+                continue
+            self.arguments(f"{path}.{name}", field["args"], selection["args"])
+            field_type = _named(field["type"])
+            kind = self.types.get(field_type, {}).get("kind")
+            if kind in ("OBJECT", "INTERFACE", "UNION"):
+                if not selection["selections"]:
+                    self.errors.append(f"{path}.{name}: {field_type} needs a selection of fields")
+                else:
+                    self.selections(field_type, selection["selections"], f"{path}.{name}")
+            elif selection["selections"]:
+                self.errors.append(f"{path}.{name}: {field_type} is a leaf and takes no selection")
+
+    def arguments(self, path: str, declared: Dict[str, str], given: Dict[str, Any]):
+        for arg, type_ref in declared.items():
+            if type_ref.endswith("!") and arg not in given:
+                self.errors.append(f"{path}: required argument {arg} is missing")
+        for arg, value in given.items():
+            if arg not in declared:
+                self.errors.append(f"{path}: unknown argument {arg}")
+                continue
+            self.value(f"{path}({arg})", declared[arg], value)
+
+    def value(self, path: str, type_ref: str, value: Any):
+        if isinstance(value, dict) and "$" in value:
+            variable = value["$"]
+            self.used_variables.add(variable)
+            variable_type = self.operation["variables"].get(variable)
+            if variable_type is None:
+                self.errors.append(f"{path}: ${variable} is not declared")
+            elif not _compatible(variable_type, type_ref):
+                self.errors.append(f"{path}: ${variable} is {variable_type}, expected {type_ref}")
+        elif isinstance(value, dict) and "{" in value:
+            input_fields = self.types.get(_named(type_ref), {}).get("inputFields")
+            if input_fields is None:
+                self.errors.append(f"{path}: {type_ref} is not an input object")
+                return
+            self.arguments(path, input_fields, value["{"])
+        elif isinstance(value, list):
+            for item in value:
+                self.value(path, type_ref.rstrip("!").strip("[]") if type_ref.startswith("[") else type_ref, item)
+
+
+def validate_document(document: str, index: Optional[Dict] = None) -> List[str]:
+    """
+    Check an operation against the schema: fields, arguments, variable
+    types and selections on unions
+
+    Returns:
+        Problems found (empty if the operation is valid)
+    """
+    try:
+        operation = parse_operation(document)
+    except GraphQLDocumentError as e:
+        return [str(e)]
+    return _Validator(index or schema_index(), operation).validate()
+
+
+class Operation:
+    """A named operation ready to send: its compact document and persisted-query hash"""
+
+    __slots__ = ("name", "kind", "document", "sha256")
+
+    def __init__(self, document: str):
+        parsed = parse_operation(document)
+        if not parsed["name"]:
+            raise GraphQLDocumentError("Registered operations must be named")
+        self.name = parsed["name"]
+        self.kind = parsed["kind"]
+        self.document = " ".join(document.split())
+        self.sha256 = hashlib.sha256(self.document.encode("utf-8")).hexdigest()
+
+    def payload(self, variables: Optional[Dict] = None) -> Dict:
+        """Request body with the full document"""
+        return {"query": self.document, "operationName": self.name, "variables": variables or {}}
+
+
+OPERATIONS: Dict[str, Operation] = {operation.name: operation for operation in map(Operation, DOCUMENTS)}
+
+
+def get_operation(name: str) -> Operation:
+    return OPERATIONS[name]
+
+
+_batch_lock = threading.Lock()
+
+
+def batch_operation(name: str, size: int) -> Operation:
+    """
+    A registered single-request query repeated `size` times, so many IDs
+    are read in one round trip
+
+    Each copy is aliased r0, r1, ... and takes $request0, $request1, ...;
+    aliases do not change what is valid, so the batch is as valid as the
+    registered query. It is registered as "<name>Batch<size>" on first use,
+    so post_operation (and persisted queries) can send it.
+
+    Raises:
+        GraphQLDocumentError: If the operation is not a query taking one $request
+    """
+    batch_name = f"{name}Batch{size}"
+    operation = OPERATIONS.get(batch_name)
+    if operation is not None:
+        return operation
+    base = OPERATIONS[name]
+    match = re.fullmatch(r"query \w+\(\$request: ([^)$]+)\) \{ (.*) \}", base.document)
+    if match is None:
+        raise GraphQLDocumentError(f"{name} cannot be batched")
+    request_type, selection = match.groups()
+    variables = ", ".join(f"$request{i}: {request_type}" for i in range(size))
+    fields = " ".join(f"r{i}: " + selection.replace("$request", f"$request{i}") for i in range(size))
+    operation = Operation(f"query {batch_name}({variables}) {{ {fields} }}")
+    with _batch_lock:
+        return OPERATIONS.setdefault(batch_name, operation)
+
+
+def validate_operations() -> Dict[str, List[str]]:
+    """
+    Validate every registered operation against the bundled schema,
+    according to SOOT_VALIDATE_OPERATIONS
+
+    Returns:
+        Problems per operation name (only operations with problems)
+
+    Raises:
+        RuntimeError: In strict mode, if any operation is invalid
+    """
+    if VALIDATE_OPERATIONS == "off":
+        return {}
+    try:
+        index = schema_index()
+    except (OSError, ValueError) as e:
+        logger.warning("Cannot validate SOOT operations, schema unavailable: %s", e)
+        return {}
+    problems = {name: errors for name, errors in
+                ((name, validate_document(operation.document, index)) for name, operation in OPERATIONS.items())
+                if errors}
+    for name, errors in problems.items():
+        logger.error("SOOT operation %s does not match the schema: %s", name, "; ".join(errors))
+    if problems and VALIDATE_OPERATIONS == "strict":
+        raise RuntimeError(f"SOOT operations do not match schema.json: {', '.join(problems)}")
+    if not problems:
+        logger.info("Validated %s SOOT operations against the schema", len(OPERATIONS))
+    return problems
+
+
+_persisted_supported = PERSISTED_QUERIES
+
+
+def _persisted_query_error(response: requests.Response) -> Optional[str]:
+    """
+    PERSISTED_QUERY_NOT_FOUND or PERSISTED_QUERY_NOT_SUPPORTED if the server
+    refused a hash-only request without running it, None for any other
+    response (including other errors, which are the caller's to handle)
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict) or body.get("data") is not None:
+        return None
+    for error in body.get("errors") or []:
+        code = (error.get("extensions") or {}).get("code") or error.get("message") or ""
+        code = code.upper().replace("_", "").replace(" ", "")
+        if "PERSISTEDQUERYNOTFOUND" in code:
+            return "PERSISTED_QUERY_NOT_FOUND"
+        if "PERSISTEDQUERYNOTSUPPORTED" in code or "PERSISTEDQUERIESARENOTSUPPORTED" in code:
+            return "PERSISTED_QUERY_NOT_SUPPORTED"
+    return None
+
+
+def post_operation(name: str, variables: Optional[Dict] = None, timeout: Optional[float] = None) -> requests.Response:
+    """
+    Send a registered operation to SOOT
+
+    With SOOT_PERSISTED_QUERIES only the operation's hash is sent. If the
+    server does not know the hash yet, the full document is sent with it so
+    the server can register it; if the server does not support persisted
+    queries at all, they are turned off for the rest of the process. Only
+    those two errors are retried, since the server ran nothing; any other
+    response is returned as is, so a mutation is never sent twice.
+
+    Args:
+        name: Registered operation name
+        variables: Operation variables
+        timeout: Request timeout in seconds
+
+    Returns:
+        The HTTP response
+    """
+    global _persisted_supported
+    operation = OPERATIONS[name]
+    body: Dict[str, Any] = {"operationName": operation.name, "variables": variables or {}}
+    if _persisted_supported:
+        body["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": operation.sha256}}
+        response = requests.post(SOOT_API_URL, json=body, headers=HEADERS, timeout=timeout)
+        error = _persisted_query_error(response)
+        if error is None:
+            PERSISTED_QUERY_REQUESTS.inc(result="hit")
+            return response
+        if error == "PERSISTED_QUERY_NOT_FOUND":
+            PERSISTED_QUERY_REQUESTS.inc(result="registered")
+        else:
+            PERSISTED_QUERY_REQUESTS.inc(result="unsupported")
+            logger.warning("SOOT does not accept persisted queries (%s), sending full documents", error)
+            _persisted_supported = False
+            del body["extensions"]
+    body["query"] = operation.document
+    return requests.post(SOOT_API_URL, json=body, headers=HEADERS, timeout=timeout)
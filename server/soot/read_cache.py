@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from utils.log import get_logger
+from utils.metrics import counter, gauge
+from utils.tracing import bind_context
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+SOOT_CACHE_ENABLED = os.getenv("SOOT_CACHE", "1") not in ("0", "false", "False")
+# Seconds each query's result is served without asking SOOT again
+SOOT_CACHE_TTLS = os.getenv("SOOT_CACHE_TTLS", "viewerSpaces=300,getSpaceById=60,getSpacePublicationById=3600")
+# Seconds past the TTL a result is still served while it is refreshed in the background
+SOOT_CACHE_STALE_SECONDS = float(os.getenv("SOOT_CACHE_STALE_SECONDS", "600"))
+SOOT_CACHE_MAX_ENTRIES = int(os.getenv("SOOT_CACHE_MAX_ENTRIES", "4096"))
+
+SOOT_CACHE_LOOKUPS = counter("soot_cache_total", "SOOT read cache lookups by operation and result (hit, stale, miss, coalesced)",
+                             ["operation", "result"])
+SOOT_CACHE_REFRESHES = counter("soot_cache_refreshes_total", "Background refreshes of stale SOOT results", ["outcome"])
+SOOT_CACHE_INVALIDATIONS = counter("soot_cache_invalidations_total", "SOOT cache entries dropped by invalidation", ["reason"])
+
+
+def parse_ttls(spec: str) -> Dict[str, float]:
+    """Parse "operation=seconds,..." into a dict"""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        operation, _, seconds = item.partition("=")
+        ttls[operation.strip()] = float(seconds)
+    return ttls
+
+
+class _Entry:
+    __slots__ = ("value", "fetched_at", "refreshing")
+
+    def __init__(self, value: Any, fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.refreshing = False
+
+
+class ReadCache:
+    """
+    Read-through cache for SOOT queries, keyed by operation and argument.
+
+    A result is served as is for its operation's TTL. For up to
+    stale_seconds after that it is still served, while a single background
+    refresh fetches a new one (stale-while-revalidate). Anything older is
+    fetched before returning, with concurrent callers sharing one fetch.
+
+    Cached results are shared between callers and must not be modified.
+    """
+
+    def __init__(self, ttls: Dict[str, float], stale_seconds: float, max_entries: int = 4096,
+                 enabled: bool = True, clock: Callable[[], float] = time.monotonic):
+        self.ttls = ttls
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.clock = clock
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._loading: Dict[Tuple[str, str], Future] = {}
+        # Set from _counter on invalidation, so a fetch that started before it is not stored. Keys
+        # neither cached nor loading are forgotten once there are too many; they read as _floor,
+        # which is raised past every version handed out so far, so their pending fetches are not stored
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._counter = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, operation: str, key: str, load: Callable[[], Any],
+            cacheable: Callable[[Any], bool] = lambda value: True) -> Any:
+        """
+        Cached result of a query, fetching it if missing or expired
+
+        Args:
+            operation: Query name (selects the TTL)
+            key: Query argument (e.g. the space ID)
+            load: Fetches the result from SOOT
+            cacheable: Whether a fetched result may be cached (errors are not)
+
+        Returns:
+            The (possibly stale) result
+        """
+        ttl = self.ttls.get(operation, 0)
+        if not self.enabled or ttl <= 0:
+            return load()
+        cache_key = (operation, key)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                age = now - entry.fetched_at
+                if age < ttl:
+                    self._entries.move_to_end(cache_key)
+                    SOOT_CACHE_LOOKUPS.inc(operation=operation, result="hit")
+                    return entry.value
+                if age < ttl + self.stale_seconds:
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        threading.Thread(target=bind_context(self._refresh), args=(cache_key, load, cacheable),
+                                         name="soot-cache-refresh", daemon=True).start()
+                    SOOT_CACHE_LOOKUPS.inc(operation=operation, result="stale")
+                    return entry.value
+            future = self._loading.get(cache_key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._loading[cache_key] = future
+                version = self._version_locked(cache_key)
+        SOOT_CACHE_LOOKUPS.inc(operation=operation, result="miss" if leader else "coalesced")
+        if not leader:
+            return future.result()
+
+        try:
+            value = load()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            if cacheable(value):
+                self.put(*cache_key, value, version)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(cache_key, None)
+
+    def _refresh(self, cache_key: Tuple[str, str], load: Callable[[], Any], cacheable: Callable[[Any], bool]):
+        with self._lock:
+            version = self._version_locked(cache_key)
+        try:
+            value = load()
+        except Exception as e:
+            # Keep serving the stale result until it expires for good
+            logger.warning("Refreshing SOOT %s %s failed: %s", cache_key[0], cache_key[1][:8], e)
+            value = None
+        if value is not None and cacheable(value):
+            self.put(*cache_key, value, version)
+            SOOT_CACHE_REFRESHES.inc(outcome="ok")
+            return
+        SOOT_CACHE_REFRESHES.inc(outcome="error")
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                entry.refreshing = False
+
+    def peek(self, operation: str, key: str) -> Optional[Any]:
+        """A result still within its TTL, without fetching (None if there is none)"""
+        ttl = self.ttls.get(operation, 0)
+        if not self.enabled or ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get((operation, key))
+            if entry is None or self.clock() - entry.fetched_at >= ttl:
+                return None
+        SOOT_CACHE_LOOKUPS.inc(operation=operation, result="hit")
+        return entry.value
+
+    def version(self, operation: str, key: str) -> int:
+        """Current version of a key; pass it to put() for a result fetched from now on"""
+        with self._lock:
+            return self._version_locked((operation, key))
+
+    def _version_locked(self, cache_key: Tuple[str, str]) -> int:
+        version = self._versions.setdefault(cache_key, self._floor)
+        if len(self._versions) > 2 * self.max_entries:
+            self._prune_versions_locked()
+            version = self._versions.setdefault(cache_key, self._floor)
+        return version
+
+    def _prune_versions_locked(self):
+        for cache_key in list(self._versions):
+            if cache_key not in self._entries and cache_key not in self._loading:
+                del self._versions[cache_key]
+        self._counter += 1
+        self._floor = self._counter
+
+    def put(self, operation: str, key: str, value: Any, version: int):
+        """Store a result, unless the key was invalidated since `version` was read"""
+        if not self.enabled:
+            return
+        cache_key = (operation, key)
+        with self._lock:
+            if self._versions.get(cache_key, self._floor) != version:
+                return
+            self._entries[cache_key] = _Entry(value, self.clock())
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, operation: Optional[str] = None, key: Optional[str] = None, reason: str = "explicit") -> int:
+        """
+        Drop cached results so the next read fetches them again
+
+        Args:
+            operation: Only this query (all queries if None)
+            key: Only this argument (all arguments if None)
+            reason: Label for the invalidation metric
+
+        Returns:
+            Number of entries dropped
+        """
+        with self._lock:
+            # Every reader's key is in _versions (see version()), so this also covers reads nothing is cached for
+            matching = {cache_key for cache_key in list(self._versions) + list(self._entries) + list(self._loading)
+                        if (operation is None or cache_key[0] == operation) and (key is None or cache_key[1] == key)}
+            if operation is not None and key is not None:
+                matching.add((operation, key))
+            dropped = 0
+            for cache_key in matching:
+                self._counter += 1
+                self._versions[cache_key] = self._counter
+                if self._entries.pop(cache_key, None) is not None:
+                    dropped += 1
+            if len(self._versions) > 2 * self.max_entries:
+                self._prune_versions_locked()
+        if dropped:
+            SOOT_CACHE_INVALIDATIONS.inc(dropped, reason=reason)
+        return dropped
+
+
+read_cache = ReadCache(parse_ttls(SOOT_CACHE_TTLS), SOOT_CACHE_STALE_SECONDS, SOOT_CACHE_MAX_ENTRIES, SOOT_CACHE_ENABLED)
+
+gauge("soot_cache_entries", "SOOT query results held by the read cache", callback=lambda: len(read_cache))
@@ -1,12 +1,15 @@
 from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
 
 from .connector import (
+    SOOT_PAGE_SIZE,
     get_user_spaces,
     get_space_items,
-    get_publication_snapshot_url
- 
-   
+    get_publication_snapshot_url,
+    stream_space_items_json,
 )
+from .upload_tracker import upload_tracker
+from mash.prefetch import snapshot_prefetcher
 
 router = APIRouter()
 
@@ -15,8 +18,9 @@ def list_spaces():
     return get_user_spaces()
 
 @router.get("/spaces/{space_id}/items")
-def list_space_items(space_id: str):
-    return get_space_items(space_id)
+def list_space_items(space_id: str, page_size: int = Query(SOOT_PAGE_SIZE, ge=1, le=1000)):
+    """Publications of a space, streamed page by page in the getSpaceById response shape"""
+    return StreamingResponse(stream_space_items_json(space_id, page_size), media_type="application/json")
 
 
 @router.get("/publications/{publication_id}/snapshot")
@@ -24,6 +28,12 @@ def get_publication_snapshot(publication_id: str):
     return get_publication_snapshot_url(publication_id)
 
 
+@router.get("/uploads/{intent_id}")
+def get_upload_status(intent_id: str):
+    """Whether an upload made by this server has landed in its space yet"""
+    return upload_tracker.status(intent_id) or {"error": "Unknown upload intent"}
+
+
 @router.get("/snapshots")
 def list_snapshots(space_id: str = Query(...)):
     """
@@ -47,4 +57,6 @@ def list_snapshots(space_id: str = Query(...)):
         if "snapshot_url" in snapshot:
             snapshots.append(snapshot)
 
+    # Listed snapshots are usually pasted into mash next; download them before they are
+    snapshot_prefetcher.schedule(space_id, snapshots)
     return snapshots
\ No newline at end of file
@@ -0,0 +1,43 @@
+import os
+from typing import Callable, Dict, Optional
+
+from dotenv import load_dotenv
+from utils.metrics import counter
+from .subscriptions import SubscriptionClient
+
+load_dotenv()
+
+SOOT_CACHE_WATCH = os.getenv("SOOT_CACHE_WATCH", "1") not in ("0", "false", "False")
+
+SPACE_EVENTS = counter("soot_space_events_total", "watchSpaceDerivedState events received by type", ["event"])
+
+class SpaceWatcher:
+    """
+    Subscribes to watchSpaceDerivedState for every space whose items are
+    cached, over the shared subscription connection, and calls
+    on_change(space_id, event_type) for each event.
+
+    If the connection drops, events may have been missed, so every watched
+    space is reported as changed ("Reconnected") once it is back.
+    """
+
+    def __init__(self, client: SubscriptionClient, on_change: Callable[[str, str], None]):
+        self.client = client
+        self.on_change = on_change
+
+    @property
+    def available(self) -> bool:
+        return self.client.available
+
+    def watch(self, space_id: str):
+        """Start receiving change events for a space (no-op if already watched)"""
+        self.client.subscribe(f"space:{space_id}", "WatchSpaceDerivedState", {"request": {"space": space_id}},
+                              lambda data: self._on_event(space_id, data))
+
+    def _on_event(self, space_id: str, data: Optional[Dict]):
+        if data is None:
+            event_type = "Reconnected"
+        else:
+            event_type = (data.get("watchSpaceDerivedState") or {}).get("__typename", "unknown")
+            SPACE_EVENTS.inc(event=event_type)
+        self.on_change(space_id, event_type)
@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from utils.log import get_logger
+from utils.metrics import gauge
+from .operations import get_operation
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+# Without websocket-client callers fall back to reading state (TTLs, polling)
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+SOOT_API_URL = os.getenv("SOOT_API_URL") or ""
+SOOT_ACCESS_TOKEN = os.getenv("SOOT_ACCESS_TOKEN")
+# GraphQL subscriptions endpoint (graphql-transport-ws); defaults to the API URL over ws(s)://
+SOOT_WS_URL = os.getenv("SOOT_WS_URL") or SOOT_API_URL.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+RECONNECT_MAX_SECONDS = 60
+
+# Called with an event's data, or None when events may have been missed (reconnect, subscription error)
+EventHandler = Callable[[Optional[Dict]], None]
+
+
+class SubscriptionClient:
+    """
+    Runs every SOOT subscription of the process over one multiplexed
+    graphql-transport-ws connection, opened on the first subscribe().
+
+    Each subscription is identified by a caller-chosen key. If the
+    connection drops, every subscription is renewed once it is back and
+    its handler is called with None, since events may have been missed.
+    """
+
+    def __init__(self, url: str, token: Optional[str]):
+        self.url = url
+        self.token = token
+        # key -> (subscription ID, operation name, variables, handler)
+        self._subscriptions: Dict[str, Tuple[str, str, Dict, EventHandler]] = {}
+        self._socket = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._fallback_logged = False
+
+    @property
+    def available(self) -> bool:
+        return websocket is not None and bool(self.url)
+
+    @property
+    def connected(self) -> bool:
+        return self._socket is not None
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def warn_if_unavailable(self):
+        """Log (once) that subscribers fall back to polling when there is no connection to open"""
+        if self.available or self._fallback_logged:
+            return
+        self._fallback_logged = True
+        logger.warning("SOOT subscriptions unavailable (%s), polling uploads and relying on cache TTLs instead",
+                       "websocket-client is not installed" if websocket is None else "SOOT_WS_URL is not set")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._subscriptions
+
+    def subscribe(self, key: str, operation: str, variables: Dict, on_event: EventHandler) -> bool:
+        """
+        Start a subscription (no-op if the key is already subscribed)
+
+        Args:
+            key: Caller-chosen identity of the subscription (e.g. "space:<id>")
+            operation: Registered subscription operation name
+            variables: Operation variables
+            on_event: Called with each event's data, or None if events may have been missed
+
+        Returns:
+            Whether events will be delivered (False without websocket support)
+        """
+        if not self.available:
+            self.warn_if_unavailable()
+            return False
+        with self._lock:
+            if key in self._subscriptions:
+                return True
+            self._subscriptions[key] = (str(uuid.uuid4()), operation, variables, on_event)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="soot-subscriptions", daemon=True)
+                self._thread.start()
+            socket = self._socket
+        if socket is not None:
+            self._subscribe(socket, key)
+        return True
+
+    def unsubscribe(self, key: str):
+        """Stop a subscription (no-op if it is not active)"""
+        with self._lock:
+            subscription = self._subscriptions.pop(key, None)
+            socket = self._socket
+        if subscription is not None and socket is not None:
+            try:
+                self._send(socket, {"id": subscription[0], "type": "complete"})
+            except Exception as e:
+                logger.debug("Could not complete subscription %s: %s", key, e)
+
+    def handle_message(self, message: Dict):
+        """Dispatch one graphql-transport-ws message (public so a stand-in can drive it)"""
+        message_type = message.get("type")
+        if message_type == "ping":
+            self._send(self._socket, {"type": "pong"})
+            return
+        if message_type not in ("next", "error", "complete"):
+            return
+        with self._lock:
+            key = next((key for key, subscription in self._subscriptions.items() if subscription[0] == message.get("id")), None)
+            subscription = self._subscriptions.get(key) if key is not None else None
+            if subscription is not None and message_type != "next":
+                # The server ended it; the handler re-reads state and may subscribe again
+                del self._subscriptions[key]
+        if subscription is None:
+            return
+        if message_type == "error":
+            logger.warning("Subscription %s failed: %s", key, message.get("payload"))
+        if message_type == "next":
+            subscription[3]((message.get("payload") or {}).get("data") or {})
+        else:
+            subscription[3](None)
+
+    def _send(self, socket, message: Dict):
+        if socket is not None:
+            socket.send(json.dumps(message))
+
+    def _subscribe(self, socket, key: str):
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+        if subscription is None:
+            return
+        subscription_id, operation, variables, _ = subscription
+        try:
+            self._send(socket, {"id": subscription_id, "type": "subscribe",
+                                "payload": get_operation(operation).payload(variables)})
+        except Exception as e:
+            logger.warning("Could not subscribe to %s: %s", key, e)
+
+    def _connect(self):
+        socket = websocket.create_connection(self.url, subprotocols=["graphql-transport-ws"], timeout=30)
+        self._send(socket, {"type": "connection_init", "payload": {"Authorization": f"Bearer {self.token}"}})
+        ack = json.loads(socket.recv())
+        if ack.get("type") != "connection_ack":
+            socket.close()
+            raise ConnectionError(f"Unexpected reply to connection_init: {ack.get('type')}")
+        socket.settimeout(None)
+        return socket
+
+    def _run(self):
+        backoff = 1.0
+        connected_before = False
+        while True:
+            try:
+                socket = self._connect()
+            except Exception as e:
+                logger.warning("Cannot connect to SOOT subscriptions at %s: %s (retrying in %.0fs)", self.url, e, backoff)
+                time.sleep(backoff)
+                backoff = min(RECONNECT_MAX_SECONDS, backoff * 2)
+                continue
+            backoff = 1.0
+            with self._lock:
+                self._socket = socket
+                subscriptions = list(self._subscriptions.items())
+            for key, subscription in subscriptions:
+                self._subscribe(socket, key)
+                if connected_before:
+                    subscription[3](None)
+            connected_before = True
+            try:
+                while True:
+                    self.handle_message(json.loads(socket.recv()))
+            except Exception as e:
+                logger.warning("SOOT subscription connection lost: %s", e)
+            finally:
+                with self._lock:
+                    self._socket = None
+                try:
+                    socket.close()
+                except Exception:
+                    pass
+
+
+subscriptions = SubscriptionClient(SOOT_WS_URL, SOOT_ACCESS_TOKEN)
+
+gauge("soot_subscriptions_active", "Subscriptions multiplexed over the SOOT websocket connection",
+      callback=lambda: len(subscriptions))
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import pytest
+
+from soot import connector
+from soot.connector import SootQueryError, iter_space_publications, stream_space_items_json
+
+
+class _Response:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def _serve(monkeypatch, total, fail_after=None):
+    """Fake SOOT serving `total` publications in cursor pages; returns the requested cursors"""
+    requests = []
+
+    def post_operation(name, variables=None):
+        after = variables["filter"]["after"]
+        requests.append(after)
+        start = int(after or 0)
+        if fail_after is not None and start >= fail_after:
+            return _Response({"data": None, "errors": [{"message": "boom"}]})
+        end = min(start + variables["filter"]["first"], total)
+        edges = [{"node": {"id": f"p{k}"}} for k in range(start, end)]
+        page_info = {"hasNextPage": end < total, "endCursor": str(end)}
+        return _Response({"data": {"getSpaceById": {"space": {"publications": {"edges": edges, "pageInfo": page_info}}}}})
+
+    monkeypatch.setattr(connector, "post_operation", post_operation)
+    monkeypatch.setattr(connector, "SOOT_CACHE_WATCH", False)
+    return requests
+
+
+def _stream(space_id, page_size):
+    async def collect():
+        return "".join([chunk async for chunk in stream_space_items_json(space_id, page_size)])
+    return json.loads(asyncio.run(collect()))
+
+
+def test_pages_follow_the_cursor(monkeypatch):
+    requests = _serve(monkeypatch, total=5)
+    pages = list(iter_space_publications("space", page_size=2))
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert requests == [None, "2", "4"]
+
+
+def test_a_repeated_cursor_ends_paging(monkeypatch):
+    def post_operation(name, variables=None):
+        page = {"edges": [{"node": {"id": "p0"}}], "pageInfo": {"hasNextPage": True, "endCursor": "same"}}
+        return _Response({"data": {"getSpaceById": {"space": {"publications": page}}}})
+
+    monkeypatch.setattr(connector, "post_operation", post_operation)
+    assert len(list(iter_space_publications("space", page_size=1))) == 2
+
+
+def test_errors_raise_with_the_upstream_errors(monkeypatch):
+    _serve(monkeypatch, total=5, fail_after=2)
+    pages = iter_space_publications("space", page_size=2)
+    next(pages)
+    with pytest.raises(SootQueryError) as error:
+        next(pages)
+    assert error.value.errors == [{"message": "boom"}]
+
+
+def test_streamed_items_are_one_json_document_and_cached(monkeypatch):
+    requests = _serve(monkeypatch, total=5)
+    data = _stream("streamed-space", page_size=2)
+    edges = data["data"]["getSpaceById"]["space"]["publications"]["edges"]
+    assert [edge["node"]["id"] for edge in edges] == [f"p{k}" for k in range(5)]
+    assert _stream("streamed-space", page_size=2) == data
+    assert len(requests) == 3  # The second stream was served from the cache
+
+
+def test_a_failed_stream_ends_with_errors_and_is_not_cached(monkeypatch):
+    requests = _serve(monkeypatch, total=5, fail_after=2)
+    data = _stream("failing-space", page_size=2)
+    assert len(data["data"]["getSpaceById"]["space"]["publications"]["edges"]) == 2
+    assert data["errors"] == [{"message": "boom"}]
+    _stream("failing-space", page_size=2)
+    assert requests.count(None) == 2
+
+
+def test_large_spaces_are_streamed_but_not_cached(monkeypatch):
+    requests = _serve(monkeypatch, total=5)
+    monkeypatch.setattr(connector, "SOOT_CACHE_MAX_EDGES", 3)
+    _stream("large-space", page_size=2)
+    _stream("large-space", page_size=2)
+    assert requests.count(None) == 2
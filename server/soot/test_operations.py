@@ -0,0 +1,110 @@
+import pytest
+
+from soot import operations
+from soot.operations import OPERATIONS, build_schema_index, validate_document
+
+INDEX = {
+    "roots": {"query": "Query", "mutation": "Mutation", "subscription": None},
+    "types": {
+        "Query": {"kind": "OBJECT", "fields": {
+            "space": {"type": "Space", "args": {"id": "ID!"}},
+        }},
+        "Mutation": {"kind": "OBJECT", "fields": {
+            "rename": {"type": "Space!", "args": {"request": "RenameRequest!"}},
+        }},
+        "Space": {"kind": "OBJECT", "fields": {
+            "id": {"type": "ID!", "args": {}},
+            "name": {"type": "String", "args": {}},
+        }},
+        "RenameRequest": {"kind": "INPUT_OBJECT", "inputFields": {"id": "ID!", "name": "String!"}},
+        "ID": {"kind": "SCALAR"},
+        "String": {"kind": "SCALAR"},
+    },
+}
+
+
+def test_valid_operation_has_no_problems():
+    assert validate_document("query Space($id: ID!) { space(id: $id) { id name } }", INDEX) == []
+    assert validate_document("mutation Rename($request: RenameRequest!) { rename(request: $request) { id } }", INDEX) == []
+
+
+@pytest.mark.parametrize("document, problem", [
+    ("query Q($id: ID!) { space(id: $id) { id owner } }", "Space has no field owner"),
+    ("query Q { space { id } }", "required argument id is missing"),
+    ("query Q($id: String) { space(id: $id) { id } }", "$id is String, expected ID!"),
+    ("query Q($id: ID!, $unused: ID) { space(id: $id) { id } }", "$unused is declared but never used"),
+    ("query Q($id: ID!) { space(id: $id) }", "Space needs a selection of fields"),
+    ("query Q($id: ID!) { space(id: $id) { id { value } } }", "ID is a leaf"),
+    ("subscription Q { space { id } }", "Schema has no subscription type"),
+    ("query Q { space(id: ", "Expected"),
+])
+def test_invalid_operations_are_reported(document, problem):
+    problems = validate_document(document, INDEX)
+    assert any(problem in p for p in problems), problems
+
+
+def test_registered_operations_match_the_bundled_schema(tmp_path, monkeypatch):
+    monkeypatch.setattr(operations, "SCHEMA_INDEX_PATH", str(tmp_path / "index.json"))
+    monkeypatch.setattr(operations, "_schema_index", None)
+    index = operations.schema_index()
+    assert {name: validate_document(operation.document, index) for name, operation in OPERATIONS.items()
+            if validate_document(operation.document, index)} == {}
+
+
+def test_schema_index_is_built_from_introspection():
+    introspection = {"data": {"__schema": {
+        "queryType": {"name": "Query"}, "mutationType": None, "subscriptionType": None,
+        "types": [
+            {"name": "Query", "kind": "OBJECT", "fields": [
+                {"name": "hello", "type": {"kind": "NON_NULL", "ofType": {"kind": "SCALAR", "name": "String"}},
+                 "args": [{"name": "times", "type": {"kind": "SCALAR", "name": "Int"}}]},
+            ]},
+            {"name": "__Schema", "kind": "OBJECT", "fields": []},
+        ],
+    }}}
+    index = build_schema_index(introspection)
+    assert index["roots"]["query"] == "Query"
+    assert index["types"] == {"Query": {"kind": "OBJECT", "fields": {"hello": {"type": "String!", "args": {"times": "Int"}}}}}
+
+
+class _Response:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def _post_replies(monkeypatch, *replies):
+    sent = []
+
+    def post(url, json=None, headers=None, timeout=None):
+        sent.append(dict(json))
+        return _Response(replies[len(sent) - 1])
+
+    monkeypatch.setattr(operations.requests, "post", post)
+    monkeypatch.setattr(operations, "_persisted_supported", True)
+    return sent
+
+
+def test_unknown_hash_is_sent_again_with_the_document(monkeypatch):
+    sent = _post_replies(monkeypatch, {"errors": [{"message": "PersistedQueryNotFound"}]}, {"data": {"ok": True}})
+    assert operations.post_operation("CompleteUploadIntent", {"request": {}}).json() == {"data": {"ok": True}}
+    assert "query" not in sent[0] and "query" in sent[1]
+    assert operations._persisted_supported
+
+
+def test_other_errors_are_returned_without_resending(monkeypatch):
+    error = {"data": None, "errors": [{"message": "Upload intent already completed"}]}
+    sent = _post_replies(monkeypatch, error)
+    assert operations.post_operation("CompleteUploadIntent", {"request": {}}).json() == error
+    assert len(sent) == 1
+    assert operations._persisted_supported
+
+
+def test_unsupported_persisted_queries_are_turned_off(monkeypatch):
+    sent = _post_replies(monkeypatch, {"errors": [{"extensions": {"code": "PERSISTED_QUERY_NOT_SUPPORTED"}}]},
+                         {"data": {"ok": True}})
+    operations.post_operation("CompleteUploadIntent", {"request": {}})
+    assert "extensions" not in sent[1]
+    assert not operations._persisted_supported
@@ -0,0 +1,79 @@
+import time
+
+from soot.read_cache import ReadCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _cache(**kwargs):
+    clock = Clock()
+    return ReadCache({"getSpaceById": 60}, stale_seconds=30, clock=clock, **kwargs), clock
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_serves_within_ttl_then_fetches_again():
+    cache, clock = _cache()
+    loads = []
+    load = lambda: loads.append(1) or len(loads)
+    assert cache.get("getSpaceById", "a", load) == 1
+    clock.now = 59
+    assert cache.get("getSpaceById", "a", load) == 1
+    clock.now = 60 + 30
+    assert cache.get("getSpaceById", "a", load) == 2
+    assert cache.get("viewerSpaces", "", load) == 3  # No TTL: never cached
+
+
+def test_stale_result_is_served_while_refreshing():
+    cache, clock = _cache()
+    cache.get("getSpaceById", "a", lambda: "old")
+    clock.now = 70
+    assert cache.get("getSpaceById", "a", lambda: "new") == "old"
+    _wait_until(lambda: cache.peek("getSpaceById", "a") == "new")
+
+
+def test_uncacheable_results_are_not_stored():
+    cache, _ = _cache()
+    cache.get("getSpaceById", "a", lambda: {"error": "boom"}, cacheable=lambda value: "error" not in value)
+    assert cache.peek("getSpaceById", "a") is None
+
+
+def test_invalidation_rejects_results_read_before_it():
+    cache, _ = _cache()
+    version = cache.version("getSpaceById", "a")
+    # Nothing is cached or loading for the key, e.g. a streamed read
+    cache.invalidate("getSpaceById", "a")
+    cache.put("getSpaceById", "a", "stale", version)
+    assert cache.peek("getSpaceById", "a") is None
+
+    version = cache.version("getSpaceById", "b")
+    cache.invalidate("getSpaceById")
+    cache.put("getSpaceById", "b", "stale", version)
+    assert cache.peek("getSpaceById", "b") is None
+
+    version = cache.version("getSpaceById", "a")
+    cache.put("getSpaceById", "a", "fresh", version)
+    assert cache.peek("getSpaceById", "a") == "fresh"
+
+
+def test_versions_stay_bounded_without_accepting_stale_writes():
+    cache, _ = _cache(max_entries=2)
+    version = cache.version("getSpaceById", "pending")
+    for i in range(10):
+        cache.version("getSpaceById", f"key{i}")
+    assert len(cache._versions) <= 2 * cache.max_entries + 1
+    cache.put("getSpaceById", "pending", "maybe stale", version)
+    assert cache.peek("getSpaceById", "pending") is None
+    cache.put("getSpaceById", "pending", "fresh", cache.version("getSpaceById", "pending"))
+    assert cache.peek("getSpaceById", "pending") == "fresh"
@@ -0,0 +1,147 @@
+import pytest
+
+from soot import upload_tracker as tracker_module
+from soot.upload_tracker import COMPLETED, FAILED, IN_PROGRESS, NOT_FOUND, PENDING, TIMED_OUT, UploadTracker
+
+
+class _Subscriptions:
+    """Stands in for the websocket SubscriptionClient"""
+
+    def __init__(self, available=True):
+        self.available = available
+        self.handlers = {}
+        self.unsubscribed = []
+
+    def subscribe(self, key, operation, variables, on_event):
+        if not self.available:
+            return False
+        self.handlers[key] = on_event
+        return True
+
+    def unsubscribe(self, key):
+        self.handlers.pop(key, None)
+        self.unsubscribed.append(key)
+
+    def __contains__(self, key):
+        return key in self.handlers
+
+
+class _Response:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def _completed(files=1):
+    return {"state": {"__typename": "UploadIntentCompletedState", "filesUploaded": files}}
+
+
+def _in_progress(percent):
+    return {"state": {"__typename": "UploadIntentInProgressState", "percentUploaded": percent, "uploadedFiles": 0}}
+
+
+@pytest.fixture
+def soot(monkeypatch):
+    """Fake SOOT: intentId -> UploadIntent (None if unknown), and the polls made"""
+    intents, polls, invalidated = {}, [], []
+
+    def post_operation(name, variables, timeout=None):
+        polls.append([request["id"] for request in variables.values()])
+        data = {}
+        for i, request in enumerate(variables.values()):
+            intent = intents.get(request["id"])
+            data[f"r{i}"] = {"__typename": "GetUploadIntentByIdResult", "uploadIntent": intent} if intent else {}
+        return _Response({"data": data})
+
+    monkeypatch.setattr(tracker_module, "post_operation", post_operation)
+    monkeypatch.setattr(tracker_module, "invalidate_space", lambda space_id, reason: invalidated.append(space_id))
+    return intents, polls, invalidated
+
+
+def _tracker(client, **kwargs):
+    options = {"poll_seconds": 3600, "batch_size": 2, "track_seconds": 600}
+    options.update(kwargs)
+    return UploadTracker(client, **options)
+
+
+def test_subscription_events_finish_the_upload(soot):
+    _, _, invalidated = soot
+    client, updates = _Subscriptions(), []
+    tracker = _tracker(client)
+    assert tracker.track("i1", "space", updates.append)["state"] == PENDING
+    handler = client.handlers["upload:i1"]
+    handler({"watchUploadIntent": {"uploadIntent": _in_progress(50.0)}})
+    handler({"watchUploadIntent": {"uploadIntent": _completed()}})
+    assert [update["state"] for update in updates] == [IN_PROGRESS, COMPLETED]
+    assert tracker.status("i1")["state"] == COMPLETED and len(tracker) == 0
+    assert client.unsubscribed == ["upload:i1"]
+    assert invalidated == ["space"]
+
+
+def test_finished_intents_are_reported_without_subscribing_again(soot):
+    client = _Subscriptions()
+    tracker = _tracker(client)
+    tracker.track("i1", "space")
+    client.handlers["upload:i1"]({"watchUploadIntent": {"uploadIntent": _completed(files=0)}})
+    updates = []
+    assert tracker.track("i1", "space", updates.append)["state"] == FAILED
+    assert [update["state"] for update in updates] == [FAILED]
+    assert "upload:i1" not in client
+
+
+def test_intents_without_a_subscription_are_polled_in_batches(soot):
+    intents, polls, _ = soot
+    tracker = _tracker(_Subscriptions(available=False))
+    for intent_id in ("i1", "i2", "i3"):
+        tracker.track(intent_id, "space")
+    intents.update({"i1": _completed(), "i2": _in_progress(10.0)})
+    assert tracker.poll() == 3
+    assert polls == [["i1", "i2"], ["i3"]]
+    assert [tracker.status(i)["state"] for i in ("i1", "i2", "i3")] == [COMPLETED, IN_PROGRESS, NOT_FOUND]
+    assert tracker.poll() == 1  # Only the unfinished, unsubscribed intent is read again
+    assert polls[-1] == ["i2"]
+
+
+def test_subscribed_intents_are_polled_once_then_left_to_events(soot):
+    intents, polls, _ = soot
+    client = _Subscriptions()
+    tracker = _tracker(client)
+    tracker.track("i1", "space")
+    intents["i1"] = _in_progress(10.0)
+    assert tracker.poll() == 1
+    assert tracker.poll() == 0
+    client.handlers["upload:i1"](None)  # Events may have been missed: read it again
+    assert tracker.poll() == 1
+    assert polls == [["i1"], ["i1"]]
+
+
+def test_uploads_time_out(soot):
+    tracker = _tracker(_Subscriptions(), track_seconds=0)
+    updates = []
+    tracker.track("i1", "space", updates.append)
+    tracker.poll()
+    assert tracker.status("i1")["state"] == TIMED_OUT
+    assert [update["state"] for update in updates] == [TIMED_OUT]
+
+
+def test_disabled_tracker_follows_nothing(soot):
+    client = _Subscriptions()
+    tracker = _tracker(client, enabled=False)
+    assert tracker.track("i1", "space", lambda status: None)["state"] == PENDING
+    assert tracker.status("i1") is None and not client.handlers
+
+
+def test_an_intent_finishing_while_subscribing_is_unsubscribed(soot):
+    class _Racing(_Subscriptions):
+        def subscribe(self, key, operation, variables, on_event):
+            super().subscribe(key, operation, variables, on_event)
+            on_event({"watchUploadIntent": {"uploadIntent": _completed()}})
+            return True
+
+    client = _Racing()
+    tracker = _tracker(client)
+    tracker.track("i1", "space")
+    assert tracker.status("i1")["state"] == COMPLETED
+    assert "upload:i1" not in client
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from utils.log import get_logger
+from utils.metrics import counter, gauge, histogram
+from utils.tracing import bind_context
+from .connector import invalidate_space
+from .operations import batch_operation, post_operation
+from .subscriptions import SubscriptionClient, subscriptions
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+SOOT_UPLOAD_TRACKING = os.getenv("SOOT_UPLOAD_TRACKING", "1") not in ("0", "false", "False")
+# Seconds between batched getUploadIntentById polls, for intents no subscription reports on
+SOOT_UPLOAD_POLL_SECONDS = float(os.getenv("SOOT_UPLOAD_POLL_SECONDS", "5"))
+# Upload intents read per polling request
+SOOT_UPLOAD_POLL_BATCH = int(os.getenv("SOOT_UPLOAD_POLL_BATCH", "25"))
+# Give up on an upload that has not completed after this many seconds
+SOOT_UPLOAD_TRACK_SECONDS = float(os.getenv("SOOT_UPLOAD_TRACK_SECONDS", "600"))
+SOOT_UPLOAD_HISTORY = 1000
+
+PENDING, IN_PROGRESS = "pending", "in_progress"
+COMPLETED, FAILED, NOT_FOUND, TIMED_OUT = "completed", "failed", "not_found", "timed_out"
+FINAL_STATES = (COMPLETED, FAILED, NOT_FOUND, TIMED_OUT)
+
+UPLOAD_OUTCOMES = counter("soot_upload_intents_total", "Tracked upload intents by final state", ["state"])
+UPLOAD_POLLS = counter("soot_upload_intent_polls_total", "Batched upload intent polls by outcome", ["outcome"])
+UPLOAD_LANDING_SECONDS = histogram("soot_upload_landing_seconds",
+                                   "Time from completeUploadIntent until SOOT reported the upload completed")
+
+# Called with a copy of an upload's status whenever it changes
+UploadListener = Callable[[Dict], None]
+
+
+def upload_state(upload_intent: Optional[Dict]) -> Dict:
+    """
+    Status fields for an UploadIntent as returned by UploadIntentState or
+    WatchUploadIntent (None if SOOT does not know the intent)
+    """
+    if upload_intent is None:
+        return {"state": NOT_FOUND}
+    state = upload_intent.get("state") or {}
+    if state.get("__typename") == "UploadIntentCompletedState":
+        files = state.get("filesUploaded") or 0
+        return {"state": COMPLETED if files else FAILED, "filesUploaded": files, "percentUploaded": 100.0,
+                "elapsedMilliseconds": state.get("elapsedMilliseconds")}
+    rejected = sum(state.get(field) or 0 for field in ("erroredFiles", "unsupportedFiles",
+                                                        "rejectedAsDuplicateFiles", "rejectedDueToSpaceSizeFiles"))
+    return {"state": IN_PROGRESS, "filesUploaded": state.get("uploadedFiles") or 0,
+            "percentUploaded": state.get("percentUploaded"), "rejectedFiles": rejected}
+
+
+class UploadTracker:
+    """
+    Follows upload intents from completeUploadIntent until SOOT reports the
+    files as uploaded, so callers learn when (and whether) an upload landed
+    without polling the space.
+
+    Every intent is watched with watchUploadIntent over the shared
+    subscription connection. Intents without a live subscription (no
+    websocket support, a failed subscription, or a reconnect that may have
+    missed events) are read by a background poller, many per request.
+    Newly tracked intents are polled once as well, in case they completed
+    before their subscription started.
+    """
+
+    def __init__(self, client: SubscriptionClient, poll_seconds: float, batch_size: int, track_seconds: float,
+                 enabled: bool = True):
+        self.client = client
+        self.poll_seconds = poll_seconds
+        self.batch_size = max(1, batch_size)
+        self.track_seconds = track_seconds
+        self.enabled = enabled
+        self._active: Dict[str, Dict] = {}  # intentId -> status
+        self._finished: "OrderedDict[str, Dict]" = OrderedDict()
+        self._listeners: Dict[str, List[UploadListener]] = {}
+        self._subscribed = set()
+        self._due = set()  # intents to read at the next poll
+        self._newly_finished: List[str] = []  # listeners not told yet
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def track(self, intent_id: str, space_id: str, on_update: Optional[UploadListener] = None) -> Dict:
+        """
+        Follow an upload intent until it completes, fails or times out
+
+        Args:
+            intent_id: Completed upload intent
+            space_id: Destination space (its cached reads are dropped once the upload lands)
+            on_update: Called with the status whenever it changes (also for an already finished intent)
+
+        Returns:
+            The current status
+        """
+        with self._lock:
+            status = self._active.get(intent_id) or self._finished.get(intent_id)
+            if status is None:
+                status = {"intentId": intent_id, "spaceId": space_id, "state": PENDING,
+                          "trackedAt": time.time(), "updatedAt": time.time()}
+                if self.enabled:
+                    self._active[intent_id] = status
+                    self._due.add(intent_id)
+            finished = status["state"] in FINAL_STATES
+            if on_update is not None and self.enabled and not finished:
+                self._listeners.setdefault(intent_id, []).append(bind_context(on_update))
+            snapshot = dict(status)
+            if self.enabled and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="soot-upload-tracker", daemon=True)
+                self._thread.start()
+        if on_update is not None and finished:
+            on_update(snapshot)
+        if self.enabled and not finished and self.client.subscribe(f"upload:{intent_id}", "WatchUploadIntent",
+                                                                   {"request": {"id": intent_id}},
+                                                                   lambda data: self._on_event(intent_id, data)):
+            with self._lock:
+                active = intent_id in self._active
+                if active:
+                    self._subscribed.add(intent_id)
+            if not active:
+                # It finished while subscribing, after _notify_finished unsubscribed it
+                self.client.unsubscribe(f"upload:{intent_id}")
+        return snapshot
+
+    def status(self, intent_id: str) -> Optional[Dict]:
+        """Latest known status of a tracked upload intent (None if it was never tracked)"""
+        with self._lock:
+            status = self._active.get(intent_id) or self._finished.get(intent_id)
+            return dict(status) if status else None
+
+    def poll(self) -> int:
+        """
+        Read every intent that is due, in batches of batch_size
+
+        Returns:
+            Number of intents read
+        """
+        now = time.time()
+        with self._lock:
+            for intent_id, status in list(self._active.items()):
+                if now - status["trackedAt"] > self.track_seconds:
+                    self._due.discard(intent_id)
+                    self._finish_locked(intent_id, {"state": TIMED_OUT})
+            due = [intent_id for intent_id in self._active if intent_id in self._due or intent_id not in self._subscribed]
+            self._due.difference_update(due)
+        read = 0
+        for start in range(0, len(due), self.batch_size):
+            read += self._poll_batch(due[start:start + self.batch_size])
+        self._notify_finished()
+        return read
+
+    def _poll_batch(self, intent_ids: List[str]) -> int:
+        operation = batch_operation("UploadIntentState", len(intent_ids))
+        variables = {f"request{i}": {"id": intent_id} for i, intent_id in enumerate(intent_ids)}
+        try:
+            data = post_operation(operation.name, variables, timeout=30).json()
+        except Exception as e:
+            data = {"errors": [{"message": str(e)}]}
+        results = data.get("data") or {}
+        if data.get("errors") and not results:
+            UPLOAD_POLLS.inc(outcome="error")
+            logger.warning("Polling %s upload intents failed: %s", len(intent_ids), data["errors"])
+            with self._lock:
+                self._due.update(intent_ids)  # Try them again at the next poll
+            return 0
+        UPLOAD_POLLS.inc(outcome="ok")
+        for i, intent_id in enumerate(intent_ids):
+            result = results.get(f"r{i}") or {}
+            self._apply(intent_id, result.get("uploadIntent") if result.get("__typename") == "GetUploadIntentByIdResult" else None)
+        return len(intent_ids)
+
+    def _on_event(self, intent_id: str, data: Optional[Dict]):
+        if data is None:
+            # Events may have been missed, or the subscription ended: read the intent instead
+            with self._lock:
+                self._due.add(intent_id)
+                if f"upload:{intent_id}" not in self.client:
+                    # The server ended the subscription; poll this intent from now on
+                    self._subscribed.discard(intent_id)
+            self._wakeup.set()
+            return
+        event = data.get("watchUploadIntent") or {}
+        if event.get("uploadIntent"):
+            self._apply(intent_id, event["uploadIntent"])
+            self._notify_finished()
+
+    def _apply(self, intent_id: str, upload_intent: Optional[Dict]):
+        fields = upload_state(upload_intent)
+        with self._lock:
+            status = self._active.get(intent_id)
+            if status is None:
+                return
+            if fields["state"] in FINAL_STATES:
+                self._finish_locked(intent_id, fields)
+                return
+            if all(status.get(key) == value for key, value in fields.items()):
+                return
+            status.update(fields, updatedAt=time.time())
+            snapshot, listeners = dict(status), list(self._listeners.get(intent_id, ()))
+        for listener in listeners:
+            self._call(listener, snapshot)
+
+    def _finish_locked(self, intent_id: str, fields: Dict):
+        status = self._active.pop(intent_id)
+        status.update(fields, updatedAt=time.time())
+        self._subscribed.discard(intent_id)
+        self._finished[intent_id] = status
+        while len(self._finished) > SOOT_UPLOAD_HISTORY:
+            self._finished.popitem(last=False)
+        UPLOAD_OUTCOMES.inc(state=status["state"])
+        if status["state"] == COMPLETED:
+            UPLOAD_LANDING_SECONDS.observe(status["updatedAt"] - status["trackedAt"])
+        self._newly_finished.append(intent_id)
+
+    def _notify_finished(self):
+        """Tell listeners about intents that finished, outside the lock"""
+        with self._lock:
+            notices = [(dict(self._finished[intent_id]), self._listeners.pop(intent_id, []))
+                       for intent_id in self._newly_finished if intent_id in self._finished]
+            self._newly_finished.clear()
+        for status, listeners in notices:
+            self.client.unsubscribe(f"upload:{status['intentId']}")
+            if status["state"] == COMPLETED:
+                # The publication exists now; drop reads cached while it was still arriving
+                invalidate_space(status["spaceId"], reason="upload_completed")
+            else:
+                logger.warning("Upload intent %s ended %s", status["intentId"][:8], status["state"])
+            for listener in listeners:
+                self._call(listener, dict(status))
+
+    def _call(self, listener: UploadListener, status: Dict):
+        try:
+            listener(status)
+        except Exception as e:
+            logger.exception("Upload listener for %s failed: %s", status["intentId"][:8], e)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                logger.exception("Upload polling failed: %s", e)
+
+
+upload_tracker = UploadTracker(subscriptions, SOOT_UPLOAD_POLL_SECONDS, SOOT_UPLOAD_POLL_BATCH,
+                               SOOT_UPLOAD_TRACK_SECONDS, SOOT_UPLOAD_TRACKING)
+
+gauge("soot_upload_intents_tracked", "Upload intents not yet completed, failed or timed out",
+      callback=lambda: len(upload_tracker))
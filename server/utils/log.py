@@ -0,0 +1,105 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+# Logging configuration (overridable from the environment)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+# Fraction of per-item messages (loggers ending in ".items") that are kept
+LOG_ITEM_SAMPLE_RATE = float(os.getenv("LOG_ITEM_SAMPLE_RATE", "0.1"))
+
+ITEM_LOGGER_SUFFIX = ".items"
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class ItemSamplingFilter(logging.Filter):
+    """Keep only a sample of per-item messages; warnings and errors always pass"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not record.name.endswith(ITEM_LOGGER_SUFFIX):
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyJson:
+    """Defers json.dumps until the message is actually formatted"""
+
+    def __init__(self, value, **kwargs):
+        self.value = value
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, default=str, **self.kwargs)
+
+
+def configure_logging():
+    """
+    Route all loggers through a non-blocking queue handler; a single listener
+    thread formats records and writes them to stdout.
+    """
+    global _configured
+
+    with _configure_lock:
+        if _configured:
+            return
+
+        if LOG_FORMAT == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(formatter)
+
+        log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # Sample before enqueueing so dropped messages cost nothing downstream
+        queue_handler.addFilter(ItemSamplingFilter(LOG_ITEM_SAMPLE_RATE))
+
+        listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(queue_handler)
+        _configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def get_item_logger(name: str) -> logging.Logger:
+    """Logger for per-item messages (one per image, score, upload step); these are sampled"""
+    configure_logging()
+    return logging.getLogger(name + ITEM_LOGGER_SUFFIX)
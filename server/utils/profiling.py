@@ -0,0 +1,165 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Opt-in: enables the sampling profiler and the other /debug reports (locks, traces)
+PROFILER_ENABLED = os.getenv("MASH_PROFILER_ENABLED", "0") in ("1", "true", "True")
+ADMIN_TOKEN = os.getenv("MASH_ADMIN_TOKEN")  # If set, required in the X-Admin-Token header
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_MIN_INTERVAL = 0.001
+
+_profile_lock = threading.Lock()  # One profile at a time
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.01) -> Counter:
+    """
+    Sample the stacks of every thread for a fixed time
+
+    Args:
+        seconds: How long to sample (capped at PROFILE_MAX_SECONDS)
+        interval: Seconds between samples
+
+    Returns:
+        Counter of collapsed stacks ("thread;outer;...;inner") to sample counts
+
+    Raises:
+        ProfilerBusyError: If another profile is already running
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("A profile is already running")
+    try:
+        seconds = min(max(seconds, interval), PROFILE_MAX_SECONDS)
+        interval = max(interval, PROFILE_MIN_INTERVAL)
+        own_thread = threading.get_ident()
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                # Group pool threads by prefix (e.g. "gemini_3" -> "gemini")
+                thread_name = names.get(thread_id, str(thread_id)).rsplit("_", 1)[0]
+                stacks[";".join([thread_name] + labels[::-1])] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    """Render stacks in the collapsed format read by flamegraph.pl and speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class _LockStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, waited: Optional[float], held: float):
+        with self._lock:
+            self.acquisitions += 1
+            if waited is not None:
+                self.contended += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            self.hold_seconds += held
+            self.max_hold_seconds = max(self.max_hold_seconds, held)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "acquisitions": self.acquisitions,
+                "contended": self.contended,
+                "contentionRate": round(self.contended / self.acquisitions, 4) if self.acquisitions else 0.0,
+                "waitSeconds": round(self.wait_seconds, 6),
+                "maxWaitMs": round(self.max_wait_seconds * 1000, 3),
+                "holdSeconds": round(self.hold_seconds, 6),
+                "maxHoldMs": round(self.max_hold_seconds * 1000, 3),
+            }
+
+
+_lock_stats: Dict[str, _LockStats] = {}
+_lock_stats_guard = threading.Lock()
+
+
+class InstrumentedLock:
+    """
+    threading.Lock replacement that records contention and hold times.
+
+    Locks created with the same name share one set of statistics (e.g. all
+    per-session locks are reported together).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self._waited: Optional[float] = None
+        with _lock_stats_guard:
+            self._stats = _lock_stats.setdefault(name, _LockStats(name))
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(blocking=False):
+            waited = None
+        else:
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not self._lock.acquire(timeout=timeout):
+                return False
+            waited = time.perf_counter() - start
+        self._waited = waited
+        self._acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        waited = self._waited
+        self._lock.release()
+        self._stats.record(waited, held)
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def lock_report() -> List[Dict]:
+    """Contention statistics of every instrumented lock, most waited-on first"""
+    with _lock_stats_guard:
+        stats = list(_lock_stats.values())
+    return sorted((s.to_dict() for s in stats), key=lambda s: s["waitSeconds"], reverse=True)
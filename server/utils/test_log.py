@@ -0,0 +1,30 @@
+import json
+import logging
+
+from utils.log import ITEM_LOGGER_SUFFIX, ItemSamplingFilter, JsonFormatter, LazyJson
+
+
+def _record(name, level=logging.INFO, message="hello"):
+    return logging.LogRecord(name, level, __file__, 1, message, (), None)
+
+
+def test_item_messages_are_sampled_but_warnings_always_pass():
+    item = "mash.processor" + ITEM_LOGGER_SUFFIX
+    assert not ItemSamplingFilter(0).filter(_record(item))
+    assert ItemSamplingFilter(1).filter(_record(item))
+    assert ItemSamplingFilter(0).filter(_record(item, logging.WARNING))
+    assert ItemSamplingFilter(0).filter(_record("mash.processor"))
+
+
+def test_json_lines_carry_level_logger_and_message():
+    entry = json.loads(JsonFormatter().format(_record("mash.jobs", logging.ERROR, "boom")))
+    assert (entry["level"], entry["logger"], entry["message"]) == ("ERROR", "mash.jobs", "boom")
+
+
+def test_lazy_json_only_serializes_when_formatted():
+    class Explodes:
+        def __str__(self):
+            raise AssertionError("serialized too early")
+
+    LazyJson({"value": Explodes()})  # A message below the level is never formatted
+    assert str(LazyJson({"a": 1})) == '{"a": 1}'
@@ -0,0 +1,55 @@
+import pytest
+
+from utils.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counters_render_per_label_set():
+    requests = Counter("requests_total", "Requests", ["route"])
+    requests.inc(route="/a")
+    requests.inc(2, route='/"b"')
+    assert requests.value(route="/a") == 1
+    assert requests.render() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{route="/\\"b\\""} 2',
+        'requests_total{route="/a"} 1',
+    ]
+
+
+def test_callback_gauges_are_sampled_at_render_time():
+    value = [1]
+    depth = Gauge("queue_depth", "Depth", callback=lambda: value[0])
+    value[0] = 5
+    assert depth.render()[-1] == "queue_depth 5"
+
+
+def test_histogram_buckets_are_cumulative():
+    latency = Histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        latency.observe(value)
+    samples = latency.render()[2:]
+    assert samples == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]
+
+
+def test_timed_blocks_record_their_outcome():
+    stage = Histogram("stage_seconds", "Stage", ["outcome"])
+    with stage.time():
+        pass
+    with pytest.raises(ValueError), stage.time():
+        raise ValueError()
+    rendered = "\n".join(stage.render())
+    assert 'stage_seconds_count{outcome="ok"} 1' in rendered
+    assert 'stage_seconds_count{outcome="error"} 1' in rendered
+
+
+def test_registering_a_name_twice_keeps_the_first_metric():
+    registry = Registry()
+    first = registry.register(Counter("jobs_total", "Jobs"))
+    assert registry.register(Counter("jobs_total", "Jobs")) is first
+    assert registry.render().count("# TYPE jobs_total counter") == 1
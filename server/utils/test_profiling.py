@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from utils import profiling
+from utils.profiling import InstrumentedLock, ProfilerBusyError, collapsed, lock_report, sample_stacks
+
+
+def _stats(name):
+    return next(s for s in lock_report() if s["name"] == name)
+
+
+def test_uncontended_lock_counts_acquisitions_only():
+    lock = InstrumentedLock("test-uncontended")
+    for _ in range(3):
+        with lock:
+            pass
+    stats = _stats("test-uncontended")
+    assert (stats["acquisitions"], stats["contended"], stats["contentionRate"]) == (3, 0, 0.0)
+
+
+def test_contended_lock_records_wait():
+    lock = InstrumentedLock("test-contended")
+
+    def wait_for_lock():
+        with lock:
+            pass
+
+    lock.acquire()
+    waiter = threading.Thread(target=wait_for_lock)
+    waiter.start()
+    time.sleep(0.05)
+    lock.release()
+    waiter.join()
+    stats = _stats("test-contended")
+    assert (stats["acquisitions"], stats["contended"]) == (2, 1)
+    assert stats["maxWaitMs"] >= 20
+
+
+def test_locks_with_one_name_share_statistics():
+    for _ in range(2):
+        with InstrumentedLock("test-shared"):
+            pass
+    assert _stats("test-shared")["acquisitions"] == 2
+
+
+def test_non_blocking_acquire_fails_when_held():
+    lock = InstrumentedLock("test-nonblocking")
+    with lock:
+        assert lock.acquire(blocking=False) is False
+    assert not lock.locked()
+
+
+def test_sample_stacks_sees_other_threads():
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait, name="sleeper_1")
+    worker.start()
+    try:
+        stacks = sample_stacks(0.05, interval=0.01)
+    finally:
+        stop.set()
+        worker.join()
+    assert any(stack.startswith("sleeper;") for stack in stacks)
+    assert collapsed(stacks).splitlines()[0].rsplit(" ", 1)[1].isdigit()
+
+
+def test_one_profile_at_a_time():
+    profiling._profile_lock.acquire()
+    try:
+        with pytest.raises(ProfilerBusyError):
+            sample_stacks(0.01)
+    finally:
+        profiling._profile_lock.release()
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from utils import tracing
+from utils.tracing import bind_context, current_trace_id, get_trace, new_trace_id, span, traced
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_ENABLED", True)
+
+
+def test_child_spans_join_the_current_trace():
+    trace_id = new_trace_id()
+    with span("request", trace_id=trace_id) as root:
+        with span("match", instanceId="abc"):
+            pass
+    spans = get_trace(trace_id)
+    assert [s["name"] for s in spans] == ["request", "match"]
+    assert spans[1]["parentSpanId"] == root.span_id
+    assert spans[1]["attributes"] == {"instanceId": "abc"}
+
+
+def test_errors_mark_the_span():
+    trace_id = new_trace_id()
+
+    @traced("generate")
+    def fails():
+        raise ValueError("no image")
+
+    with pytest.raises(ValueError), span("request", trace_id=trace_id):
+        fails()
+    assert [(s["name"], s["status"]) for s in get_trace(trace_id)] == [("request", "error"), ("generate", "error")]
+
+
+def test_bound_functions_keep_the_trace_in_other_threads():
+    trace_id = new_trace_id()
+    seen = []
+    with span("request", trace_id=trace_id):
+        thread = threading.Thread(target=bind_context(lambda: seen.append(current_trace_id())))
+    thread.start()
+    thread.join()
+    assert seen == [trace_id]
+
+
+def test_spans_per_trace_are_capped_but_the_root_is_kept(monkeypatch):
+    monkeypatch.setattr(tracing, "_store", tracing._TraceStore(max_traces=10, max_spans=3))
+    trace_id = new_trace_id()
+    with span("request", trace_id=trace_id):
+        for _ in range(5):
+            with span("item"):
+                pass
+    assert len(get_trace(trace_id)) == 4
+    assert tracing.dropped_spans(trace_id) == 2
+    assert get_trace(trace_id)[0]["name"] == "request"
@@ -0,0 +1,306 @@
+import contextvars
+import functools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import requests
+from dotenv import load_dotenv
+
+from utils.log import get_logger
+from utils.metrics import counter
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") not in ("0", "false", "False")
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", "200"))  # Finished traces kept for /debug/traces
+# Spans kept per trace; a mash-all job would otherwise keep hundreds (root spans are always kept)
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "256"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")  # JSON lines, one span per line
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")  # e.g. http://localhost:4318/v1/traces
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "soot-mash")
+TRACE_HEADER = "X-Trace-Id"
+TRACE_EXPORT_BATCH = 64
+TRACE_EXPORT_QUEUE_SIZE = 4096
+
+SPANS_DROPPED = counter("trace_spans_dropped_total", "Finished spans not kept because their trace hit TRACE_MAX_SPANS")
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed pipeline stage; spans of the same request share a trace_id"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = dict(attributes)
+        self.status = "ok"
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict:
+        end_ns = self.end_ns or time.time_ns()
+        return {
+            "name": self.name,
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "start": self.start_ns / 1e9,
+            "durationMs": round((end_ns - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    trace_id = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _TraceStore:
+    """
+    Finished spans of the most recent traces, oldest traces evicted first,
+    at most max_spans per trace (plus its root span)
+    """
+
+    def __init__(self, max_traces: int, max_spans: int = TRACE_MAX_SPANS):
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self._traces: "OrderedDict[str, List[Span]]" = OrderedDict()
+        self._dropped: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    evicted, _ = self._traces.popitem(last=False)
+                    self._dropped.pop(evicted, None)
+            if len(spans) >= self.max_spans and span.parent_id is not None:
+                self._dropped[span.trace_id] = self._dropped.get(span.trace_id, 0) + 1
+                SPANS_DROPPED.inc()
+                return
+            spans.append(span)
+
+    def dropped(self, trace_id: str) -> int:
+        with self._lock:
+            return self._dropped.get(trace_id, 0)
+
+    def get(self, trace_id: str) -> Optional[List[Span]]:
+        with self._lock:
+            spans = self._traces.get(trace_id)
+            return list(spans) if spans is not None else None
+
+    def recent(self, limit: int) -> List[List[Span]]:
+        with self._lock:
+            return [list(spans) for spans in reversed(list(self._traces.values())[-limit:])]
+
+
+class _Exporter:
+    """Background export of finished spans to a JSON-lines file and/or an OTLP/HTTP collector"""
+
+    def __init__(self, path: Optional[str], otlp_endpoint: Optional[str]):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+        if path or otlp_endpoint:
+            threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True).start()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.otlp_endpoint)
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass  # Tracing must never slow the pipeline down
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < TRACE_EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.path:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        for span in batch:
+                            f.write(json.dumps(span.to_dict(), default=str) + "\n")
+                if self.otlp_endpoint:
+                    requests.post(self.otlp_endpoint, json=_otlp_payload(batch), timeout=5)
+            except Exception as e:
+                logger.warning("Failed to export %s span(s): %s", len(batch), e)
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(spans: List[Span]) -> Dict:
+    """OTLP/HTTP JSON encoding of a batch of spans"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "soot-mash"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                    "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+                    "status": {"code": 2 if span.status == "error" else 1},
+                } for span in spans],
+            }],
+        }]
+    }
+
+
+_store = _TraceStore(TRACE_MAX_TRACES)
+_exporter = _Exporter(TRACE_EXPORT_FILE, TRACE_OTLP_ENDPOINT)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+@contextmanager
+def span(name: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[Any]:
+    """
+    Time a pipeline stage as a child of the current span
+
+    Args:
+        name: Stage name
+        trace_id: Start a new trace with this ID instead of joining the current one
+        **attributes: Span attributes (e.g. instanceId, command type, bytes sent)
+
+    Yields:
+        The span, so attributes known only later can be added with set_attribute()
+    """
+    if not TRACE_ENABLED:
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    if trace_id is None and parent is not None:
+        current = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        current = Span(name, trace_id or new_trace_id(), None, attributes)
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set_attribute("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_ns = time.time_ns()
+        _store.add(current)
+        if _exporter.enabled:
+            _exporter.export(current)
+
+
+def traced(name: Optional[str] = None, **attributes: Any) -> Callable:
+    """Decorator running every call of the function in its own span (named after the function by default)"""
+
+    def decorator(fn: Callable) -> Callable:
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_span() -> Any:
+    """The innermost active span (a no-op span outside any trace)"""
+    return _current_span.get() or _NOOP_SPAN
+
+
+def current_trace_id() -> Optional[str]:
+    active = _current_span.get()
+    return active.trace_id if active else None
+
+
+def bind_context(fn: Callable) -> Callable:
+    """
+    Wrap fn so it runs under the caller's current span when called from
+    another thread (thread pools and threading.Thread do not carry it over)
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # Each call gets its own copy so the wrapper can run in several threads at once
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def dropped_spans(trace_id: str) -> int:
+    """Spans of a trace that were not kept (see TRACE_MAX_SPANS)"""
+    return _store.dropped(trace_id)
+
+
+def get_trace(trace_id: str) -> Optional[List[Dict]]:
+    """Spans of a finished or in-progress trace, in start order"""
+    spans = _store.get(trace_id)
+    if spans is None:
+        return None
+    return [span.to_dict() for span in sorted(spans, key=lambda s: s.start_ns)]
+
+
+def recent_traces(limit: int = 20) -> List[Dict]:
+    """Summaries of the most recent traces, newest first"""
+    summaries = []
+    for spans in _store.recent(limit):
+        root = next((s for s in spans if s.parent_id is None), spans[0])
+        summaries.append({
+            "traceId": root.trace_id,
+            "name": root.name,
+            "start": root.start_ns / 1e9,
+            "durationMs": root.to_dict()["durationMs"],
+            "spans": len(spans),
+            "status": "error" if any(s.status == "error" for s in spans) else "ok",
+        })
+    return summaries